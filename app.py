@@ -1,45 +1,107 @@
 import os
+import sys
 import hashlib
+import pickle
 import time
 import random
-from flask import Flask, render_template, request, url_for, send_file, jsonify, redirect
+from flask import Flask, render_template, request, url_for, send_file, send_from_directory, jsonify, redirect, Response, stream_with_context, has_request_context
+from markupsafe import Markup
 from reportlab.pdfgen import canvas
 from flask_sqlalchemy import SQLAlchemy
 from authlib.integrations.flask_client import OAuth
 from flask_session import Session
 import logging
-from google.oauth2 import id_token  # ✅ Import this
-from google.auth.transport import requests as google_requests
+from google.auth import jwt as google_jwt
+import requests
 from flask import session
 from datetime import datetime
 from datetime import datetime, timedelta
 
-from sqlalchemy import func, cast, Date
+from sqlalchemy import func, cast, Date, case, and_, or_, not_, insert, literal
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from azure.storage.blob import BlobServiceClient
+from azure.core.exceptions import ResourceNotFoundError
 from io import BytesIO
 from werkzeug.utils import secure_filename
+from itsdangerous import BadSignature, URLSafeSerializer
 
 
 from dotenv import load_dotenv
+import gzip
+import json
+from build_assets import BUNDLES as ASSET_BUNDLES
+import threading
+import secrets
+import hmac
+import re
+import csv
+import math
+import tempfile
+import asyncio
+import sqlite3
+import click
+from io import StringIO
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+from functools import wraps
+
+try:
+    import orjson  # Faster serializer for the large polling feeds
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from openpyxl import Workbook  # Only needed for .xlsx exports
+except ImportError:
+    Workbook = None
+
+try:
+    import httpx  # Async model client for the ASGI entrypoint (asgi.py)
+except ImportError:
+    httpx = None
+
+try:
+    import redis  # Shared sessions, caches, rate limits and task queue for scale-out deployments
+except ImportError:
+    redis = None
 
 app = Flask(__name__)
 load_dotenv()
 
+# Scale-out mode: with REDIS_URL set, sessions, caches, rate limits and the
+# task queue are shared by every worker on every node (each can still be
+# pointed elsewhere with its own *_REDIS_URL).
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL and redis is None:
+    raise ValueError("REDIS_URL is set but the redis package is not installed.")
 
 
 # ✅ Configure Logging
+LOG_FILE = os.getenv("LOG_FILE", "app.log")  # "-" = stdout, for containers and log collectors
 logging.basicConfig(
-    filename="app.log",
-    level=logging.DEBUG,
+    **({"stream": sys.stdout} if LOG_FILE == "-" else {"filename": LOG_FILE}),
+    level=os.getenv("LOG_LEVEL", "DEBUG"),
     format="%(asctime)s - %(levelname)s - %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", REDIS_URL)
+
 app.config["SESSION_PERMANENT"] = True
-app.config["SESSION_TYPE"] = "filesystem"  # Stores session data
+if SESSION_REDIS_URL:
+    app.config["SESSION_TYPE"] = "redis"  # Any worker can serve any user
+    app.config["SESSION_REDIS"] = redis.Redis.from_url(SESSION_REDIS_URL)
+else:
+    app.config["SESSION_TYPE"] = "filesystem"  # Stores session data
 app.config["SESSION_COOKIE_SECURE"] = True  # Force HTTPS only
 app.config["SESSION_COOKIE_HTTPONLY"] = True  # Prevent JavaScript access
 app.config["SESSION_COOKIE_SAMESITE"] = "Lax"  # Protect against CSRF attacks
@@ -70,6 +132,74 @@ CONTAINER_MAPPING = {
 }
 
 
+# ✅ File Store (generated PDFs, receipts and spooled uploads)
+class LocalFileStore:
+    """Files under a local directory; shared across nodes only if the directory is."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, name):
+        return os.path.join(self.root, *name.split("/"))
+
+    def put(self, name, data):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def get(self, name):
+        with open(self._path(name), "rb") as f:
+            return f.read()
+
+    def exists(self, name):
+        return os.path.exists(self._path(name))
+
+    def delete(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+
+class BlobFileStore:
+    """Files in one Azure Blob container, reachable from every node."""
+
+    def __init__(self, client, container):
+        self.client = client
+        self.container = container
+
+    def _blob(self, name):
+        return self.client.get_blob_client(container=self.container, blob=name)
+
+    def put(self, name, data):
+        self._blob(name).upload_blob(data, overwrite=True)
+
+    def get(self, name):
+        try:
+            return self._blob(name).download_blob().readall()
+        except ResourceNotFoundError:
+            raise FileNotFoundError(name)
+
+    def exists(self, name):
+        return self._blob(name).exists()
+
+    def delete(self, name):
+        try:
+            self._blob(name).delete_blob()
+        except ResourceNotFoundError:
+            pass
+
+
+FILE_STORE_CONTAINER = os.getenv("FILE_STORE_CONTAINER")  # Set for scale-out; unset = FILE_STORE_DIR
+FILE_STORE_DIR = os.getenv("FILE_STORE_DIR", os.path.join(app.instance_path, "files"))
+
+if FILE_STORE_CONTAINER:
+    file_store = BlobFileStore(BLOB_SERVICE_CLIENT, FILE_STORE_CONTAINER)
+else:
+    file_store = LocalFileStore(FILE_STORE_DIR)
+
+
 
 
 # ✅ Database Configuration (Using ODBC)
@@ -79,7 +209,9 @@ DB_USERNAME = os.getenv("DB_USERNAME")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_DRIVER = os.getenv("DB_DRIVER", "ODBC Driver 18 for SQL Server")
 
-DATABASE_URL = f"mssql+pyodbc://{DB_USERNAME}:{DB_PASSWORD}@{DB_SERVER}/{DB_NAME}?driver={DB_DRIVER.replace(' ', '+')}"
+DATABASE_URL = os.getenv("DATABASE_URL") or (  # Override for local runs and tests, e.g. sqlite:///dev.db
+    f"mssql+pyodbc://{DB_USERNAME}:{DB_PASSWORD}@{DB_SERVER}/{DB_NAME}?driver={DB_DRIVER.replace(' ', '+')}"
+)
 
 app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URL
 
@@ -89,12 +221,783 @@ app.secret_key = 'secret_key'
 db = SQLAlchemy(app)
 
 
+# ✅ JSON Response Layer (compression + ETag for polled endpoints)
+COMPRESS_MIN_SIZE = 1024  # Bytes; smaller bodies aren't worth compressing
+
+
+def dumps_json(data):
+    """Serialize data to UTF-8 JSON bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def compress_response(response):
+    """Compress a response body with brotli or gzip based on Accept-Encoding."""
+    response.vary.add("Accept-Encoding")
+
+    if response.status_code != 200 or response.direct_passthrough or "Content-Encoding" in response.headers:
+        return response
+
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        response.set_data(brotli.compress(body, quality=5))
+        response.headers["Content-Encoding"] = "br"
+    elif accepted["gzip"]:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers["Content-Encoding"] = "gzip"
+
+    return response
+
+
+def json_response(data, max_age=0, private=True):
+    """Build a JSON response with an ETag, conditional GET and compression.
+
+    Clients that send a matching If-None-Match get an empty 304, so an
+    unchanged feed costs neither the body transfer nor the compression.
+    """
+    body = dumps_json(data)
+    response = app.response_class(body, mimetype="application/json")
+
+    response.set_etag(hashlib.sha1(body).hexdigest(), weak=True)
+    response.cache_control.private = private
+    response.cache_control.public = not private
+    if max_age:
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True  # Always revalidate via ETag
+
+    response.make_conditional(request)
+    return compress_response(response)
+
+
+# ✅ Fingerprinted Static Assets (built by build_assets.py)
+ASSET_DIST_DIR = os.path.join(app.root_path, "static", "dist")
+ASSET_MAX_AGE = 365 * 24 * 3600  # Content-hashed names never change, cache for a year
+
+
+def load_asset_manifest():
+    try:
+        with open(os.path.join(ASSET_DIST_DIR, "manifest.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        logging.warning("⚠️ No asset manifest found, serving unbundled static files.")
+        return {}
+
+
+ASSET_MANIFEST = load_asset_manifest()
+
+
+@app.template_global()
+def asset_tags(bundle):
+    """Render the <link>/<script> tags for a bundle.
+
+    Uses the fingerprinted bundle from the manifest when it has been built,
+    otherwise falls back to the individual source files.
+    """
+    if bundle in ASSET_MANIFEST:
+        urls = [url_for("serve_asset", filename=ASSET_MANIFEST[bundle])]
+    else:
+        urls = [f"/static/{path}" for path in ASSET_BUNDLES[bundle]]
+
+    if bundle.endswith(".css"):
+        tags = [f'<link rel="stylesheet" href="{url}">' for url in urls]
+    else:
+        tags = [f'<script src="{url}"></script>' for url in urls]
+    return Markup("\n    ".join(tags))
+
+
+@app.route("/assets/<path:filename>")
+def serve_asset(filename):
+    """Serve built bundles with immutable caching and precompressed variants."""
+    filename = secure_filename(filename)
+    mimetype = "text/css" if filename.endswith(".css") else "application/javascript"
+
+    encoding = None
+    accepted = request.accept_encodings
+    for name, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if accepted[name] and os.path.exists(os.path.join(ASSET_DIST_DIR, filename + suffix)):
+            encoding, filename = name, filename + suffix
+            break
+
+    response = send_from_directory(ASSET_DIST_DIR, filename, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+
+# ✅ TTL Caches (in memory per process, or shared through Redis via make_cache)
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, ttl, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (ttl or self.ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def get_or_set(self, key, loader, ttl=None):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            self.set(key, value, ttl)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_MISSING = object()
+
+
+class RedisTTLCache:
+    """TTLCache with the same interface, shared by every worker through Redis.
+
+    Values are pickled; Redis handles expiry and eviction, so `max_size`
+    is ignored.
+    """
+
+    def __init__(self, client, namespace, ttl):
+        self.client = client
+        self.prefix = f"cache:{namespace}:"
+        self.ttl = ttl
+
+    def _key(self, key):
+        return f"{self.prefix}{key}"
+
+    def get(self, key, default=None):
+        data = self.client.get(self._key(key))
+        return default if data is None else pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self._key(key), pickle.dumps(value), ex=max(1, math.ceil(ttl or self.ttl)))
+
+    def get_or_set(self, key, loader, ttl=None):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            self.set(key, value, ttl)
+        return value
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=f"{self.prefix}*", count=500))
+        if keys:
+            self.client.delete(*keys)
+
+
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", REDIS_URL)
+cache_redis = redis.Redis.from_url(CACHE_REDIS_URL) if CACHE_REDIS_URL else None
+
+
+def make_cache(namespace, ttl, max_size=1024):
+    """Cache for state other workers must see (invalidations, entitlements...)."""
+    if cache_redis is not None:
+        return RedisTTLCache(cache_redis, namespace, ttl)
+    return TTLCache(ttl=ttl, max_size=max_size)
+
+
+# ✅ Background Tasks (persisted jobs with retries and priorities, off the request thread)
+TASK_DB_PATH = os.getenv("TASK_DB_PATH", os.path.join(app.instance_path, "tasks.sqlite3"))
+TASK_WORKERS = int(os.getenv("TASK_WORKERS", "4"))  # 0 = only enqueue; run `flask run-tasks` separately
+TASK_POLL_INTERVAL = 1.0  # Seconds an idle worker waits before checking the broker again
+TASK_LEASE_SECONDS = 900  # A running task whose worker died is picked up again after this
+TASK_RETRY_BASE_DELAY = 5  # Seconds before the first retry; doubles on each attempt
+TASK_RESULT_TTL_DAYS = 7
+
+
+class SQLiteTaskBroker:
+    """Durable priority queue stored in a local SQLite file.
+
+    Claims run inside BEGIN IMMEDIATE transactions, so worker threads and
+    `flask run-tasks` processes on the same host never start the same task
+    twice.
+    """
+
+    ERRORS = (sqlite3.Error,)
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            args TEXT NOT NULL,
+            kwargs TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            run_after REAL NOT NULL,
+            owner TEXT,
+            result TEXT,
+            error TEXT,
+            locked_by TEXT,
+            lease_expires REAL,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS ix_tasks_queue ON tasks (status, priority DESC, run_after, created_at);
+        CREATE INDEX IF NOT EXISTS ix_tasks_finished ON tasks (finished_at);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connect().executescript(self.SCHEMA)
+
+    def __str__(self):
+        return f"SQLite queue at {self.path}"
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, callback):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = callback(conn)
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def put(self, name, args, kwargs, priority, max_attempts, owner):
+        task_id = secrets.token_hex(16)
+        now = time.time()
+        self._connect().execute(
+            "INSERT INTO tasks (id, name, args, kwargs, priority, max_attempts, run_after, owner, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (task_id, name, json.dumps(args), json.dumps(kwargs), priority, max_attempts, now, owner, now),
+        )
+        return task_id
+
+    def claim(self, worker_id, lease_seconds):
+        """Mark the highest-priority due task as running and return it (or None)."""
+        def claim_next(conn):
+            now = time.time()
+            # Requeue tasks whose worker disappeared mid-run (or fail them when out of attempts)
+            conn.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END, "
+                "error = 'Worker lease expired', locked_by = NULL, "
+                "finished_at = CASE WHEN attempts >= max_attempts THEN ? ELSE NULL END "
+                "WHERE status = 'running' AND lease_expires < ?",
+                (now, now),
+            )
+            row = conn.execute(
+                "SELECT * FROM tasks WHERE status = 'queued' AND run_after <= ? "
+                "ORDER BY priority DESC, run_after, created_at LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE tasks SET status = 'running', attempts = attempts + 1, locked_by = ?, "
+                "lease_expires = ?, started_at = ? WHERE id = ?",
+                (worker_id, now + lease_seconds, now, row["id"]),
+            )
+            task = dict(row)
+            task["attempts"] += 1
+            return task
+
+        return self._transaction(claim_next)
+
+    def complete(self, task_id, result):
+        self._connect().execute(
+            "UPDATE tasks SET status = 'succeeded', result = ?, error = NULL, locked_by = NULL, finished_at = ? WHERE id = ?",
+            (json.dumps(result, default=str), time.time(), task_id),
+        )
+
+    def fail(self, task_id, error, retry_delay=None):
+        now = time.time()
+        if retry_delay is None:
+            self._connect().execute(
+                "UPDATE tasks SET status = 'failed', error = ?, locked_by = NULL, finished_at = ? WHERE id = ?",
+                (error, now, task_id),
+            )
+        else:
+            self._connect().execute(
+                "UPDATE tasks SET status = 'queued', error = ?, locked_by = NULL, run_after = ? WHERE id = ?",
+                (error, now + retry_delay, task_id),
+            )
+
+    def get(self, task_id):
+        row = self._connect().execute("SELECT * FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        return dict(row) if row else None
+
+    def list(self, status=None, limit=100):
+        if status:
+            rows = self._connect().execute(
+                "SELECT * FROM tasks WHERE status = ? ORDER BY created_at DESC LIMIT ?", (status, limit)
+            )
+        else:
+            rows = self._connect().execute("SELECT * FROM tasks ORDER BY created_at DESC LIMIT ?", (limit,))
+        return [dict(row) for row in rows]
+
+    def prune(self, older_than_days):
+        cutoff = time.time() - older_than_days * 86400
+        return self._connect().execute(
+            "DELETE FROM tasks WHERE status IN ('succeeded', 'failed') AND finished_at < ?", (cutoff,)
+        ).rowcount
+
+
+class RedisTaskBroker:
+    """SQLiteTaskBroker's interface on Redis, so workers on any node share one queue.
+
+    Each task is a hash; sorted sets index it by state. Claims run as one
+    Lua script, so two workers never start the same task.
+    """
+
+    ERRORS = (redis.RedisError,) if redis is not None else ()
+    INT_FIELDS = ("priority", "attempts", "max_attempts")
+    FLOAT_FIELDS = ("run_after", "lease_expires", "created_at", "started_at", "finished_at")
+    PRIORITY_WEIGHT = 1e12  # Ready score = run_after - priority * weight: priority first, then due time
+
+    CLAIM_SCRIPT = """
+    local prefix, now, worker, lease, weight = ARGV[1], tonumber(ARGV[2]), ARGV[3], tonumber(ARGV[4]), tonumber(ARGV[5])
+    local scheduled, ready, running, finished = prefix .. 'scheduled', prefix .. 'ready', prefix .. 'running', prefix .. 'finished'
+
+    for _, id in ipairs(redis.call('ZRANGEBYSCORE', running, '-inf', now)) do
+        local key = prefix .. 'task:' .. id
+        redis.call('ZREM', running, id)
+        redis.call('HSET', key, 'error', 'Worker lease expired')
+        redis.call('HDEL', key, 'locked_by')
+        if tonumber(redis.call('HGET', key, 'attempts')) >= tonumber(redis.call('HGET', key, 'max_attempts')) then
+            redis.call('HSET', key, 'status', 'failed', 'finished_at', now)
+            redis.call('ZADD', finished, now, id)
+        else
+            redis.call('HSET', key, 'status', 'queued')
+            redis.call('ZADD', scheduled, now, id)
+        end
+    end
+
+    for _, id in ipairs(redis.call('ZRANGEBYSCORE', scheduled, '-inf', now)) do
+        local key = prefix .. 'task:' .. id
+        local priority = tonumber(redis.call('HGET', key, 'priority')) or 0
+        local run_after = tonumber(redis.call('HGET', key, 'run_after')) or now
+        redis.call('ZREM', scheduled, id)
+        redis.call('ZADD', ready, run_after - priority * weight, id)
+    end
+
+    local id = redis.call('ZRANGE', ready, 0, 0)[1]
+    if not id then
+        return nil
+    end
+    local key = prefix .. 'task:' .. id
+    redis.call('ZREM', ready, id)
+    redis.call('HINCRBY', key, 'attempts', 1)
+    redis.call('HSET', key, 'status', 'running', 'locked_by', worker, 'lease_expires', now + lease, 'started_at', now)
+    redis.call('ZADD', running, now + lease, id)
+    return redis.call('HGETALL', key)
+    """
+
+    def __init__(self, url, prefix="tasks:"):
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self._claim = self.client.register_script(self.CLAIM_SCRIPT)
+
+    def __str__(self):
+        conn = self.client.connection_pool.connection_kwargs  # Not the URL: it may carry a password
+        where = conn.get("path") or f"{conn.get('host')}:{conn.get('port')}"
+        return f"Redis queue at {where}/{conn.get('db', 0)} ({self.prefix}*)"
+
+    def _task_key(self, task_id):
+        return f"{self.prefix}task:{task_id}"
+
+    def _decode(self, data):
+        if not data:
+            return None
+        task = {field: data.get(field) for field in (
+            "id", "name", "args", "kwargs", "status", "owner", "result", "error", "locked_by",
+            *self.INT_FIELDS, *self.FLOAT_FIELDS,
+        )}
+        for field in self.INT_FIELDS:
+            task[field] = int(task[field] or 0)
+        for field in self.FLOAT_FIELDS:
+            task[field] = float(task[field]) if task[field] is not None else None
+        return task
+
+    def put(self, name, args, kwargs, priority, max_attempts, owner):
+        task_id = secrets.token_hex(16)
+        now = time.time()
+        fields = {
+            "id": task_id, "name": name, "args": json.dumps(args), "kwargs": json.dumps(kwargs),
+            "priority": priority, "status": "queued", "attempts": 0, "max_attempts": max_attempts,
+            "run_after": now, "created_at": now,
+        }
+        if owner:
+            fields["owner"] = owner
+        pipe = self.client.pipeline()
+        pipe.hset(self._task_key(task_id), mapping=fields)
+        pipe.zadd(f"{self.prefix}scheduled", {task_id: now})
+        pipe.zadd(f"{self.prefix}all", {task_id: now})
+        pipe.execute()
+        return task_id
+
+    def claim(self, worker_id, lease_seconds):
+        """Mark the highest-priority due task as running and return it (or None)."""
+        flat = self._claim(args=[self.prefix, time.time(), worker_id, lease_seconds, self.PRIORITY_WEIGHT])
+        if not flat:
+            return None
+        return self._decode(dict(zip(flat[::2], flat[1::2])))
+
+    def complete(self, task_id, result):
+        now = time.time()
+        pipe = self.client.pipeline()
+        pipe.hset(self._task_key(task_id), mapping={
+            "status": "succeeded", "result": json.dumps(result, default=str), "finished_at": now,
+        })
+        pipe.hdel(self._task_key(task_id), "error", "locked_by")
+        pipe.zrem(f"{self.prefix}running", task_id)
+        pipe.zadd(f"{self.prefix}finished", {task_id: now})
+        pipe.execute()
+
+    def fail(self, task_id, error, retry_delay=None):
+        now = time.time()
+        pipe = self.client.pipeline()
+        pipe.hdel(self._task_key(task_id), "locked_by")
+        pipe.zrem(f"{self.prefix}running", task_id)
+        if retry_delay is None:
+            pipe.hset(self._task_key(task_id), mapping={"status": "failed", "error": error, "finished_at": now})
+            pipe.zadd(f"{self.prefix}finished", {task_id: now})
+        else:
+            pipe.hset(self._task_key(task_id), mapping={"status": "queued", "error": error, "run_after": now + retry_delay})
+            pipe.zadd(f"{self.prefix}scheduled", {task_id: now + retry_delay})
+        pipe.execute()
+
+    def get(self, task_id):
+        return self._decode(self.client.hgetall(self._task_key(task_id)))
+
+    def list(self, status=None, limit=100):
+        found, offset, page = [], 0, max(limit, 100)
+        while len(found) < limit:
+            ids = self.client.zrevrange(f"{self.prefix}all", offset, offset + page - 1)
+            if not ids:
+                break
+            pipe = self.client.pipeline()
+            for task_id in ids:
+                pipe.hgetall(self._task_key(task_id))
+            for data in pipe.execute():
+                task = self._decode(data)
+                if task and (not status or task["status"] == status):
+                    found.append(task)
+            offset += page
+        return found[:limit]
+
+    def prune(self, older_than_days):
+        cutoff = time.time() - older_than_days * 86400
+        ids = self.client.zrangebyscore(f"{self.prefix}finished", "-inf", cutoff)
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            pipe = self.client.pipeline()
+            pipe.delete(*(self._task_key(task_id) for task_id in chunk))
+            pipe.zrem(f"{self.prefix}finished", *chunk)
+            pipe.zrem(f"{self.prefix}all", *chunk)
+            pipe.execute()
+        return len(ids)
+
+
+class TaskRunner:
+    """Runs registered functions from the broker on a pool of worker threads.
+
+    Register with @tasks.task(...), enqueue with func.delay(*args, **kwargs)
+    (arguments must be JSON-serializable) and read progress from
+    /tasks/<task_id>. Failed attempts are retried with exponential backoff
+    until max_attempts is reached.
+    """
+
+    def __init__(self, broker, workers):
+        self.broker = broker
+        self.workers = workers
+        self.registry = {}
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+
+    def task(self, max_attempts=3, priority=0):
+        def decorator(func):
+            self.registry[func.__name__] = (func, max_attempts, priority)
+            func.delay = lambda *args, **kwargs: self.enqueue(func.__name__, *args, **kwargs)
+            return func
+        return decorator
+
+    def enqueue(self, name, *args, **kwargs):
+        _, max_attempts, priority = self.registry[name]
+        owner = session.get("email") if has_request_context() else None
+        task_id = self.broker.put(name, list(args), kwargs, priority, max_attempts, owner)
+        self.start()
+        self._wakeup.set()
+        return task_id
+
+    def start(self, workers=None):
+        """Start the worker threads once per process (no-op with TASK_WORKERS=0)."""
+        workers = self.workers if workers is None else workers
+        if self._pid == os.getpid() or not workers:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Threads don't survive fork(), so a pool started in a preloading
+            # master (gunicorn --preload) is started again in each worker
+            self._threads = []
+            for index in range(workers):
+                thread = threading.Thread(target=self._work, args=(f"{os.getpid()}-{index}",), name=f"task-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+
+    def _work(self, worker_id):
+        while True:
+            try:
+                task = self.broker.claim(worker_id, TASK_LEASE_SECONDS)
+            except self.broker.ERRORS:
+                logging.exception("❌ Task broker unavailable")
+                task = None
+
+            if task is None:
+                self._wakeup.wait(TASK_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            self.execute(task)
+
+    def execute(self, task):
+        entry = self.registry.get(task["name"])
+        if entry is None:
+            self.broker.fail(task["id"], f"Unknown task {task['name']}")
+            return
+
+        func = entry[0]
+        with app.app_context():
+            try:
+                result = func(*json.loads(task["args"]), **json.loads(task["kwargs"]))
+                self.broker.complete(task["id"], result)
+            except Exception as e:
+                db.session.rollback()
+                retry = task["attempts"] < task["max_attempts"]
+                delay = TASK_RETRY_BASE_DELAY * 2 ** (task["attempts"] - 1) if retry else None
+                self.broker.fail(task["id"], f"{type(e).__name__}: {e}", delay)
+                logging.exception(f"❌ Task {task['name']} ({task['id']}) failed on attempt {task['attempts']}")
+            finally:
+                db.session.remove()
+
+
+TASK_REDIS_URL = os.getenv("TASK_REDIS_URL", REDIS_URL)  # Unset = SQLite queue local to this host
+
+tasks = TaskRunner(RedisTaskBroker(TASK_REDIS_URL) if TASK_REDIS_URL else SQLiteTaskBroker(TASK_DB_PATH), TASK_WORKERS)
+
+
+def task_to_dict(task):
+    def timestamp(value):
+        return datetime.utcfromtimestamp(value).strftime("%Y-%m-%d %H:%M:%S") if value else None
+
+    return {
+        "id": task["id"],
+        "name": task["name"],
+        "status": task["status"],
+        "priority": task["priority"],
+        "attempts": task["attempts"],
+        "max_attempts": task["max_attempts"],
+        "result": json.loads(task["result"]) if task["result"] else None,
+        "error": task["error"],
+        "created_at": timestamp(task["created_at"]),
+        "started_at": timestamp(task["started_at"]),
+        "finished_at": timestamp(task["finished_at"]),
+    }
+
+
+
+# ✅ Rate Limiting (token buckets per user and per IP)
+class MemoryRateLimitStore:
+    """Per-process token buckets; fine for a single worker."""
+
+    MAX_KEYS = 100000
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        # Buckets idle for an hour have refilled completely; forget them
+        self._buckets = {key: item for key, item in self._buckets.items() if now - item[1] < 3600}
+
+    def take(self, key, rate, burst):
+        """Try to take one token. Returns (allowed, retry_after_seconds)."""
+        now = time.monotonic()
+        with self._lock:
+            if len(self._buckets) > self.MAX_KEYS:
+                self._prune(now)
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return True, 0
+            self._buckets[key] = (tokens, now)
+            return False, (1 - tokens) / rate
+
+
+class RedisRateLimitStore:
+    """Token buckets shared by every worker, updated atomically in Redis."""
+
+    TAKE_SCRIPT = """
+    local tokens = tonumber(redis.call('HGET', KEYS[1], 't') or ARGV[2])
+    local updated = tonumber(redis.call('HGET', KEYS[1], 'u') or ARGV[3])
+    local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 't', tokens, 'u', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url)
+        self._take = self.client.register_script(self.TAKE_SCRIPT)
+
+    def take(self, key, rate, burst):
+        allowed, tokens = self._take(keys=[f"ratelimit:{key}"], args=[rate, burst, time.time()])
+        if allowed:
+            return True, 0
+        return False, (1 - float(tokens)) / rate
+
+
+def parse_rate(value):
+    """'30/60' -> (0.5 tokens per second, burst of 30)."""
+    count, seconds = value.split("/")
+    return int(count) / float(seconds), int(count)
+
+
+# Requests allowed per window for each user; IPs get RATE_LIMIT_IP_MULTIPLIER
+# times as much to leave room for shared NATs. Override with RATE_LIMIT_<NAME>.
+RATE_LIMITS = {
+    name: parse_rate(os.getenv(f"RATE_LIMIT_{name.upper()}", default))
+    for name, default in {
+        "send_message": "30/60",
+        "ask_question": "10/60",
+        "answer_question": "20/60",
+        "ask_expert": "5/60",
+        "log_activity": "60/60",
+        "generate_flashcard_pdf": "10/60",
+        "upload_blob": "20/60",
+        "resource_download": "30/60",
+        "generate": "20/60",
+        "enroll": "30/60",
+    }.items()
+}
+RATE_LIMIT_IP_MULTIPLIER = int(os.getenv("RATE_LIMIT_IP_MULTIPLIER", "3"))
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", REDIS_URL)
+if RATE_LIMIT_REDIS_URL and redis is None:  # Per-process buckets would silently multiply every limit
+    raise ValueError("RATE_LIMIT_REDIS_URL is set but the redis package is not installed.")
+
+if RATE_LIMIT_REDIS_URL:
+    rate_limit_store = RedisRateLimitStore(RATE_LIMIT_REDIS_URL)
+else:
+    rate_limit_store = MemoryRateLimitStore()
+
+
+def check_rate_limit(name):
+    """Take a token for the current request; returns a 429 response if it's over RATE_LIMITS[name]."""
+    rate, burst = RATE_LIMITS[name]
+    buckets = [(f"{name}:ip:{request.remote_addr}", rate * RATE_LIMIT_IP_MULTIPLIER, burst * RATE_LIMIT_IP_MULTIPLIER)]
+    if session.get("email"):
+        buckets.append((f"{name}:user:{session['email']}", rate, burst))
+
+    for key, bucket_rate, bucket_burst in buckets:
+        allowed, retry_after = rate_limit_store.take(key, bucket_rate, bucket_burst)
+        if not allowed:
+            logging.warning(f"🚦 Rate limit hit: {key}")
+            response = jsonify({"error": "Too many requests", "retry_after": math.ceil(retry_after)})
+            response.status_code = 429
+            response.headers["Retry-After"] = str(math.ceil(retry_after))
+            return response
+    return None
+
+
+def rate_limit(name):
+    """Route decorator enforcing RATE_LIMITS[name] per user and per IP."""
+    RATE_LIMITS[name]  # Fail at import time on a typo
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            return check_rate_limit(name) or view(*args, **kwargs)
+        return wrapper
+    return decorator
+
 
 # ✅ Hash Generation Function for PayU
 def generate_payu_hash(txnid, amount, productinfo, firstname, email):
     hash_sequence = f"{MERCHANT_KEY}|{txnid}|{amount}|{productinfo}|{firstname}|{email}|||||||||||{MERCHANT_SALT}"
     return hashlib.sha512(hash_sequence.encode('utf-8')).hexdigest().lower()
 
+
+def verify_payu_response_hash(form):
+    """Check the reverse hash PayU sends back to surl/furl.
+
+    sha512(SALT|status||||||udf5|udf4|udf3|udf2|udf1|email|firstname|productinfo|amount|txnid|key),
+    prefixed with additionalCharges| when PayU adds charges.
+    """
+    fields = [
+        MERCHANT_SALT, form.get("status", ""), "", "", "", "", "",
+        form.get("udf5", ""), form.get("udf4", ""), form.get("udf3", ""), form.get("udf2", ""), form.get("udf1", ""),
+        form.get("email", ""), form.get("firstname", ""), form.get("productinfo", ""),
+        form.get("amount", ""), form.get("txnid", ""), MERCHANT_KEY,
+    ]
+    if form.get("additionalCharges"):
+        fields.insert(0, form["additionalCharges"])
+
+    expected = hashlib.sha512("|".join(fields).encode("utf-8")).hexdigest().lower()
+    return hmac.compare_digest(expected, form.get("hash", "").lower())
+
+
+def generate_txnid():
+    """Collision-free transaction ID: millisecond timestamp plus 32 random bits."""
+    return f"TXN{int(time.time() * 1000)}{secrets.token_hex(4).upper()}"
+
 # ✅ Define User Model (With Picture)
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -121,9 +1024,14 @@ class Payment(db.Model):
     plan_name = db.Column(db.String(50), nullable=False)  # Subscription Plan
     amount = db.Column(db.Float, nullable=False)  # Amount Paid
     txnid = db.Column(db.String(50), unique=True, nullable=False)  # Transaction ID
-    payment_status = db.Column(db.String(20), nullable=False, default="Pending")  # Success, Failed, Pending
+    payment_status = db.Column(db.String(20), nullable=False, default="Pending")  # Success, Failed, Pending, Expired
     created_at = db.Column(db.DateTime, default=datetime.utcnow)  # Timestamp
 
+    __table_args__ = (
+        db.Index("ix_payment_email_status", "email", "payment_status"),
+        db.Index("ix_payment_status_id", "payment_status", "id"),  # Reconciler pages through Pending rows
+    )
+
     def __init__(self, email, name, plan_name, amount, txnid, payment_status="Pending"):
         self.email = email
         self.name = name
@@ -162,7 +1070,7 @@ class Question(db.Model):
 class Answer(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    question_id = db.Column(db.Integer, db.ForeignKey("question.id"), nullable=False)
+    question_id = db.Column(db.Integer, db.ForeignKey("question.id"), nullable=False, index=True)
     answer_text = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
@@ -192,7 +1100,7 @@ class FounderMessage(db.Model):
 
 class ExpertQuestion(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
     username = db.Column(db.String(100), nullable=False)
     question_text = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
@@ -210,6 +1118,197 @@ class Batch(db.Model):
     end_date = db.Column(db.Date, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # ✅ Interval index for "active on date" / overlap range queries
+    __table_args__ = (
+        db.Index("ix_batch_start_end", "start_date", "end_date"),
+        db.Index("ix_batch_end", "end_date"),
+    )
+
+
+
+class Entitlement(db.Model):
+    """Materialized subscription state per user, maintained by payment transitions."""
+    id = db.Column(db.Integer, primary_key=True)
+    email = db.Column(db.String(100), unique=True, nullable=False)
+    plan_name = db.Column(db.String(50), nullable=True)
+    status = db.Column(db.String(20), nullable=False, default="Inactive")  # Active, Inactive
+    txnid = db.Column(db.String(50), nullable=True)  # Payment that granted the plan
+    expires_at = db.Column(db.DateTime, nullable=True)  # NULL = never expires
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class ExpertTicket(db.Model):
+    """Queue state for an ExpertQuestion (status, priority, assignee lease)."""
+    id = db.Column(db.Integer, primary_key=True)
+    expert_question_id = db.Column(db.Integer, db.ForeignKey("expert_question.id"), unique=True, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="open")  # open, claimed, answered
+    priority = db.Column(db.Integer, nullable=False, default=0)  # Higher is served first
+    assignee_email = db.Column(db.String(100), nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+    answer_text = db.Column(db.Text, nullable=True)
+    answered_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    question = db.relationship("ExpertQuestion", backref=db.backref("ticket", uselist=False))
+
+    __table_args__ = (
+        db.Index("ix_expert_ticket_queue", "status", "priority", "created_at"),
+        db.Index("ix_expert_ticket_assignee", "assignee_email", "status"),
+    )
+
+
+class UserCounter(db.Model):
+    """Per-user contribution counters, kept in step with the writes that create content."""
+    __tablename__ = "user_counters"
+
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    chat_messages = db.Column(db.Integer, nullable=False, default=0)
+    forum_posts = db.Column(db.Integer, nullable=False, default=0)
+    qa_answers = db.Column(db.Integer, nullable=False, default=0)
+    expert_questions = db.Column(db.Integer, nullable=False, default=0)
+    activities = db.Column(db.Integer, nullable=False, default=0)
+    contributions = db.Column(db.Integer, nullable=False, default=0)  # forum_posts + qa_answers
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_user_counters_contributions", "contributions"),
+        db.Index("ix_user_counters_activities", "activities"),
+    )
+
+
+class Resource(db.Model):
+    """Shared library of generated worksheets/flashcard decks, keyed by normalized topic and age group."""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # worksheet, flashcard
+    topic_key = db.Column(db.String(255), nullable=False)  # Lowercased, whitespace-collapsed
+    age_key = db.Column(db.String(50), nullable=False)
+    item_count = db.Column(db.Integer, nullable=False, default=0)  # Worksheet questions; 0 for flashcards
+    topic = db.Column(db.String(255), nullable=False)  # As first requested, for display
+    age_group = db.Column(db.String(50), nullable=False)
+    content = db.Column(db.Text, nullable=False)  # Generated JSON
+    blob_url = db.Column(db.String(1024), nullable=True)  # Rendered PDF in blob storage
+    download_count = db.Column(db.Integer, nullable=False, default=0)
+    last_downloaded_at = db.Column(db.DateTime, nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True)  # Who generated it first
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_resource_key", "kind", "topic_key", "age_key", "item_count", unique=True),
+        db.Index("ix_resource_downloads", "download_count", "last_downloaded_at"),
+    )
+
+
+class ResourceDownload(db.Model):
+    """Who has downloaded a library resource; only each user's first download counts towards popularity."""
+    id = db.Column(db.Integer, primary_key=True)
+    resource_id = db.Column(db.Integer, db.ForeignKey("resource.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_resource_download_user_resource", "user_id", "resource_id", unique=True),
+    )
+
+
+class ForumChange(db.Model):
+    """Append-only change feed for the Q&A forum; the highest id is the forum version."""
+    __tablename__ = "forum_changes"
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # question, answer, reset
+    question_id = db.Column(db.Integer, db.ForeignKey("question.id"), nullable=True)  # NULL for reset
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class Notification(db.Model):
+    """Per-user notification inbox with read state."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # founder, reply
+    message = db.Column(db.Text, nullable=False)
+    is_read = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_notification_unread", "user_id", "is_read"),
+        db.Index("ix_notification_inbox", "user_id", "id"),
+    )
+
+
+class Event(db.Model):
+    """A scheduled session users can enroll in, optionally part of a Batch."""
+    id = db.Column(db.Integer, primary_key=True)
+    batch_id = db.Column(db.Integer, db.ForeignKey("batch.id", ondelete="SET NULL"), nullable=True, index=True)
+    title = db.Column(db.String(200), nullable=False)
+    starts_at = db.Column(db.DateTime, nullable=False)
+    ends_at = db.Column(db.DateTime, nullable=True)
+    link = db.Column(db.String(500), nullable=True)
+    price = db.Column(db.Float, nullable=False, default=0)  # 0 = free; paid events are bought per event via /pay
+    capacity = db.Column(db.Integer, nullable=True)  # NULL = unlimited
+    enrolled_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_event_starts_at", "starts_at"),
+    )
+
+
+class Enrollment(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    event_id = db.Column(db.Integer, db.ForeignKey("event.id"), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_enrollment_user_event", "user_id", "event_id", unique=True),
+    )
+
+
+class EventPayment(db.Model):
+    """The event a checkout pays for; such payments enroll the buyer instead of granting a plan."""
+    id = db.Column(db.Integer, primary_key=True)
+    txnid = db.Column(db.String(50), unique=True, nullable=False)  # Payment.txnid
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    event_id = db.Column(db.Integer, db.ForeignKey("event.id"), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_event_payment_user_event", "user_id", "event_id"),
+    )
+
+
+# ✅ Archive Tables (rows moved out of the hot tables by archive_history)
+class ActivityLogArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # Keeps the original ActivityLog id
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    action = db.Column(db.String(255), nullable=False)
+    resource_type = db.Column(db.String(50), nullable=False)
+    resource_name = db.Column(db.String(255), nullable=True)
+    date = db.Column(db.DateTime, index=True)
+    source = db.Column(db.String(50))
+    pdf_base64 = db.Column(db.Text, nullable=True)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class MessageArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # Keeps the original Message id
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    username = db.Column(db.String(100), nullable=False)
+    room = db.Column(db.String(50), nullable=False, index=True)
+    message = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class AccountDeletionJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)  # No FK: the user row is deleted at the end
+    status = db.Column(db.String(20), nullable=False, default="Pending")  # Pending, Running, Completed, Failed
+    current_table = db.Column(db.String(50), nullable=True)
+    rows_reassigned = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
 
@@ -229,6 +1328,75 @@ app.config["GOOGLE_DISCOVERY_URL"] = "https://accounts.google.com/.well-known/op
 
 
 
+# ✅ Google ID Token Verification (cached certs, pooled HTTP session)
+GOOGLE_CERTS_URL = os.getenv("GOOGLE_CERTS_URL", "https://www.googleapis.com/oauth2/v1/certs")
+GOOGLE_ISSUERS = set(os.getenv("GOOGLE_ISSUERS", "accounts.google.com,https://accounts.google.com").split(","))
+
+
+class GoogleTokenVerifier:
+    """Verifies Google ID tokens locally against cached signing certs.
+
+    Certs are refetched only when their Cache-Control max-age runs out (or
+    an unknown key id shows up after a rotation), and recently verified
+    tokens are remembered briefly so retries don't redo the RSA check.
+    """
+
+    DEFAULT_CERTS_MAX_AGE = 3600
+    VERIFIED_TOKEN_TTL = 60
+
+    def __init__(self, audience, certs_url=GOOGLE_CERTS_URL, issuers=GOOGLE_ISSUERS):
+        self.audience = audience
+        self.certs_url = certs_url
+        self.issuers = issuers
+        self.http = requests.Session()  # Keeps the TLS connection to Google alive
+        self._certs = None
+        self._certs_expire_at = 0
+        self._lock = threading.Lock()
+        self._verified = TTLCache(ttl=self.VERIFIED_TOKEN_TTL, max_size=4096)
+
+    def _fetch_certs(self):
+        response = self.http.get(self.certs_url, timeout=5)
+        response.raise_for_status()
+
+        match = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+        max_age = int(match.group(1)) if match else self.DEFAULT_CERTS_MAX_AGE
+
+        self._certs = response.json()
+        self._certs_expire_at = time.monotonic() + max_age
+
+    def get_certs(self, force_refresh=False):
+        with self._lock:
+            if force_refresh or self._certs is None or time.monotonic() >= self._certs_expire_at:
+                self._fetch_certs()
+            return self._certs
+
+    def verify(self, token):
+        """Return the token's claims, or raise ValueError if it is invalid."""
+        token_hash = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        claims = self._verified.get(token_hash)
+        if claims is not None:
+            return claims
+
+        try:
+            claims = google_jwt.decode(token, certs=self.get_certs(), audience=self.audience, clock_skew_in_seconds=10)
+        except ValueError as e:
+            if "Certificate for key id" not in str(e):
+                raise
+            # Google rotated its keys before our cached copy expired
+            claims = google_jwt.decode(token, certs=self.get_certs(force_refresh=True), audience=self.audience, clock_skew_in_seconds=10)
+
+        if claims.get("iss") not in self.issuers:
+            raise ValueError(f"Wrong issuer: {claims.get('iss')}")
+
+        ttl = min(self.VERIFIED_TOKEN_TTL, claims.get("exp", 0) - time.time())
+        if ttl > 0:
+            self._verified.set(token_hash, claims, ttl=ttl)
+        return claims
+
+
+google_token_verifier = GoogleTokenVerifier(GOOGLE_CLIENT_ID)
+
+
 oauth = OAuth(app)
 
 google = oauth.register(
@@ -244,8 +1412,8 @@ google = oauth.register(
 )
 
 
-ADMIN_EMAILS = {"msamiksha1607@gmail.com", "snaik0704@gmail.com"}  # Add more admins as needed
-  # Add more if needed
+# Comma-separated; set the same value on every worker
+ADMIN_EMAILS = set(filter(None, os.getenv("ADMIN_EMAILS", "msamiksha1607@gmail.com,snaik0704@gmail.com").split(",")))
 
 
 
@@ -254,8 +1422,6 @@ ADMIN_EMAILS = {"msamiksha1607@gmail.com", "snaik0704@gmail.com"}  # Add more ad
 def home():
     return render_template("index.html")
 
-import secrets
-
 
 @app.route("/login")
 def login():
@@ -283,6 +1449,55 @@ def login():
     return google.authorize_redirect(
         redirect_url, state=session["oauth_state"]  # ✅ Include CSRF state
     )
+
+
+@tasks.task(max_attempts=3)
+def sync_user_profile(user_id, google_id, name, picture):
+    """Refresh a returning user's Google profile fields if they changed."""
+    changed = (
+        User.query
+        .filter(User.id == user_id)
+        .filter((User.google_id != google_id) | (User.name != name) | (User.picture != picture) | (User.picture.is_(None)))
+        .update({"google_id": google_id, "name": name, "picture": picture}, synchronize_session=False)
+    )
+    db.session.commit()
+    if changed:
+        invalidate_user_directory()
+        counter = UserCounter.query.get(user_id)
+        if counter and counter.contributions:
+            record_forum_change("reset")  # Forum shows the old name/picture
+            db.session.commit()
+            invalidate_forum_version()
+        logging.info(f"🔄 Synced Google profile for user {user_id}")
+
+
+def upsert_user(google_id, email, name, picture):
+    """Ensure a User row exists for this Google account and return its id.
+
+    New users are inserted in a single commit. Returning users cost one
+    indexed lookup; their name/picture refresh is deferred to the background.
+    """
+    user_id = db.session.query(User.id).filter(User.email == email).scalar()
+    if user_id is not None:
+        sync_user_profile.delay(user_id, google_id, name, picture)
+        return user_id
+
+    logging.info(f"🆕 Creating new user in DB: {email}")
+    user = User(google_id=google_id, email=email, name=name, picture=picture)
+    db.session.add(user)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Lost a race with a concurrent login, or the Google account changed email
+        db.session.rollback()
+        user = User.query.filter((User.google_id == google_id) | (User.email == email)).first()
+        sync_user_profile.delay(user.id, google_id, name, picture)
+        return user.id
+
+    invalidate_user_directory()
+    return user.id
+
+
 @app.route("/auth/callback")
 def auth_callback():
     logging.info("🔄 Google OAuth callback hit!")
@@ -302,13 +1517,18 @@ def auth_callback():
             logging.error("❌ No token received from Google!")
             return "Authentication failed", 400
 
-        # ✅ Get user info from Google
-        resp = google.get("https://www.googleapis.com/oauth2/v3/userinfo")
-        if resp.status_code != 200:
-            logging.error(f"❌ Google API Error: {resp.status_code} - {resp.text}")
-            return "Error retrieving user info", 400
+        # ✅ Read identity claims from the ID token (verified locally, no userinfo round trip)
+        if token.get("userinfo"):
+            user_info = token["userinfo"]  # Already validated by authlib
+        elif token.get("id_token"):
+            user_info = google_token_verifier.verify(token["id_token"])
+        else:
+            resp = google.get("https://www.googleapis.com/oauth2/v3/userinfo")
+            if resp.status_code != 200:
+                logging.error(f"❌ Google API Error: {resp.status_code} - {resp.text}")
+                return "Error retrieving user info", 400
+            user_info = resp.json()
 
-        user_info = resp.json()
         google_id = user_info.get("sub")
         email = user_info.get("email")
         name = user_info.get("name", "User")
@@ -323,26 +1543,8 @@ def auth_callback():
         session["name"] = name
         session["picture"] = picture
 
-        logging.info(f"📌 Session Data After Login: {dict(session)}")
-
-        # ✅ Store user details in database
-        with app.app_context():
-            user = User.query.filter((User.google_id == google_id) | (User.email == email)).first()
-            if user:
-                logging.info(f"🔄 User {email} exists. Updating info.")
-                user.name = name
-                user.picture = picture
-            else:
-                logging.info(f"🆕 Creating new user in DB: {email}")
-                user = User(google_id=google_id, email=email, name=name, picture=picture)
-                db.session.add(user)
-                db.session.commit()  # ✅ Ensure user is saved BEFORE logging activity
-
-            
-
-
-            db.session.commit()
-            logging.info(f"✅ User {email} saved/updated in database with login activity.")
+        # ✅ Store user details in database (profile refresh happens off the request path)
+        upsert_user(google_id, email, name, picture)
 
         # ✅ Redirect user based on role
         if email in ADMIN_EMAILS:
@@ -370,7 +1572,7 @@ def save_email():
     token = request.json.get('token')
     try:
         # Verify the token using Google ID Token verification
-        info = id_token.verify_oauth2_token(token, google_requests.Request(), GOOGLE_CLIENT_ID)
+        info = google_token_verifier.verify(token or "")
 
         google_id = info.get('sub')  # ✅ Extract Google ID
         email = info.get('email')
@@ -378,23 +1580,7 @@ def save_email():
         picture = info.get('picture')  # ✅ Store profile picture (optional)
 
         if email and google_id:
-            with app.app_context():
-                user = User.query.filter_by(email=email).first()
-
-                if user:
-                    # ✅ If user exists, update details
-                    logging.info(f"🔄 User {email} already exists. Updating info.")
-                    user.name = name
-                    user.google_id = google_id  # ✅ Ensure correct Google ID is stored
-                    user.picture = picture
-                else:
-                    # ✅ Create a new user with the correct Google ID
-                    logging.info(f"🆕 Creating new user in DB: {email}")
-                    new_user = User(google_id=google_id, email=email, name=name, picture=picture)
-                    db.session.add(new_user)
-
-                db.session.commit()
-                logging.info(f"✅ User {email} saved/updated in database.")
+            upsert_user(google_id, email, name, picture)
 
             return jsonify({"success": True})
 
@@ -412,7 +1598,7 @@ def save_email():
 @app.route("/chatbot")
 def chatbot():
     email = session.get("email")
-    logging.info(f"📌 DEBUG: Session Data - {dict(session)}")
+    logging.debug(f"📌 Chatbot requested by {email}")
 
     if not email:
         logging.warning("🚫 No user session found! Redirecting to login.")
@@ -427,10 +1613,9 @@ def chatbot():
     # ✅ Only check for payment IF user came from "Subscribe"
     next_url = session.pop("next_url", None)
     if next_url == "pay":
-        payment = Payment.query.filter_by(email=email, payment_status="Success").first()
-        if not payment:
-            logging.warning(f"🚫 Access Denied: {email} has NOT paid! Redirecting to home.")
-            return redirect(url_for("home"))  # Redirect unpaid users
+        denied = check_entitlement()  # Redirects unpaid users home
+        if denied:
+            return denied
 
     # ✅ Normal login users get direct access
     return render_template("chatbot.html", name=user.name, email=user.email, picture=user.picture)
@@ -461,20 +1646,24 @@ def admin_dashboard():
     total_worksheets = ActivityLog.query.filter_by(resource_type="Worksheet").count()
     total_flashcards = ActivityLog.query.filter_by(resource_type="Flashcard").count()
 
-    users = User.query.all()
+    # ✅ Filtering, sorting and paging happen in SQL (same params as /admin/api/users)
+    try:
+        users, matching = search_admin_users(request.args)
+        page, per_page = admin_page(request.args)
+    except ValueError:
+        return "Invalid filter value", 400
     user_data = [
-        {
-            "profile_picture": user.picture or "/static/images/default.png",
-            "name": user.name,
-            "email": user.email,
-            "worksheets_used": ActivityLog.query.filter_by(user_id=user.id, resource_type="Worksheet").count(),
-            "flashcards_used": ActivityLog.query.filter_by(user_id=user.id, resource_type="Flashcard").count(),
-            "subscription": "Paid" if Payment.query.filter_by(email=user.email, payment_status="Success").first() else "Free",
-        }
+        dict(user, profile_picture=user["picture"] or "/static/images/default.png")
         for user in users
     ]
+    pagination = {
+        "page": page,
+        "pages": max(math.ceil(matching / per_page), 1),
+        "matching": matching,
+        "filters": {name: value for name, value in request.args.items() if name != "page"},
+    }
 
-    return render_template("admin_dashboard.html", total_users=total_users, total_worksheets=total_worksheets, total_flashcards=total_flashcards, users=user_data)
+    return render_template("admin_dashboard.html", total_users=total_users, total_worksheets=total_worksheets, total_flashcards=total_flashcards, users=user_data, pagination=pagination)
 
 @app.route("/admin_logout")
 def admin_logout():
@@ -484,7 +1673,124 @@ def admin_logout():
 
 
 
+# ✅ Per-User Contribution Counters
+COUNTER_COLUMNS = ("chat_messages", "forum_posts", "qa_answers", "expert_questions", "activities")
+
+
+def bump_counters(user_id, **deltas):
+    """Add deltas to a user's counters inside the caller's transaction.
+
+    Call before the caller's commit so the counter moves together with the
+    row it counts.
+    """
+    if "forum_posts" in deltas or "qa_answers" in deltas:
+        deltas.setdefault("contributions", deltas.get("forum_posts", 0) + deltas.get("qa_answers", 0))
+    leaderboards.mark_dirty()
+
+    values = {name: getattr(UserCounter, name) + delta for name, delta in deltas.items()}
+    if UserCounter.query.filter_by(user_id=user_id).update(values, synchronize_session=False):
+        return
+
+    try:
+        with db.session.begin_nested():  # First counter for this user
+            db.session.add(UserCounter(user_id=user_id, **_initial_counters(deltas)))
+    except IntegrityError:
+        # Another request created it first; apply our delta to that row instead
+        UserCounter.query.filter_by(user_id=user_id).update(values, synchronize_session=False)
+
+
+def _initial_counters(deltas):
+    counters = {name: 0 for name in COUNTER_COLUMNS + ("contributions",)}
+    counters.update(deltas)
+    return counters
+
+
+def counters_to_dict(counter):
+    return {name: getattr(counter, name, 0) or 0 for name in COUNTER_COLUMNS}
+
+
+def count_by_user(*models, user_ids=None):
+    """Row counts per user_id summed over the given tables (optionally only for user_ids)."""
+    totals = defaultdict(int)
+    for model in models:
+        query = db.session.query(model.user_id, func.count(model.id))
+        if user_ids is not None:
+            query = query.filter(model.user_id.in_(user_ids))
+        for user_id, count in query.group_by(model.user_id):
+            totals[user_id] += count
+    return totals
+
+
+@tasks.task(max_attempts=1)
+def reconcile_user_counters(chunk_size=500):
+    """Recompute every user's counters from the source tables and fix drift.
+
+    Works through users a chunk at a time: each chunk's counters are read,
+    recounted and corrected in one short transaction, and the correction is
+    applied as a difference (counted - current) through bump_counters, so
+    increments that land while the job runs are kept rather than overwritten.
+    """
+    columns = COUNTER_COLUMNS + ("contributions",)
+    repaired, last_id = 0, 0
+    while True:
+        user_ids = [
+            user_id for (user_id,) in
+            db.session.query(User.id).filter(User.id > last_id).order_by(User.id).limit(chunk_size)
+        ]
+        if not user_ids:
+            break
+        last_id = user_ids[-1]
+
+        current = {
+            row.user_id: row for row in
+            db.session.query(UserCounter.user_id, *(getattr(UserCounter, name) for name in columns))
+            .filter(UserCounter.user_id.in_(user_ids))
+        }
+        actual = {
+            "chat_messages": count_by_user(Message, MessageArchive, user_ids=user_ids),
+            "forum_posts": count_by_user(Question, user_ids=user_ids),
+            "qa_answers": count_by_user(Answer, user_ids=user_ids),
+            "expert_questions": count_by_user(ExpertQuestion, user_ids=user_ids),
+            "activities": count_by_user(ActivityLog, ActivityLogArchive, user_ids=user_ids),
+        }
+
+        for user_id in user_ids:
+            expected = {name: actual[name].get(user_id, 0) for name in COUNTER_COLUMNS}
+            expected["contributions"] = expected["forum_posts"] + expected["qa_answers"]
+
+            counter = current.get(user_id)
+            deltas = {
+                name: value - ((getattr(counter, name) or 0) if counter else 0)
+                for name, value in expected.items()
+            }
+            if any(deltas.values()):  # Pass every column so contributions gets its own correction
+                bump_counters(user_id, **deltas)
+                repaired += 1
+
+        db.session.commit()
+
+    leaderboards.mark_dirty()
+    logging.info(f"✅ Counter reconciliation repaired {repaired} users")
+    return repaired
+
+
+@app.cli.command("reconcile-counters")
+def reconcile_counters_command():
+    """Repair drift in the user_counters table."""
+    print(f"Repaired {reconcile_user_counters()} users")
+
+
+@app.route("/admin/reconcile_counters", methods=["POST"])
+def admin_reconcile_counters():
+    if not session.get("is_admin"):
+        return jsonify({"error": "Unauthorized"}), 403
+
+    task_id = reconcile_user_counters.delay()
+    return jsonify({"message": "Counter reconciliation started", "task_id": task_id}), 202
+
+
 @app.route("/log_activity", methods=["POST"])
+@rate_limit("log_activity")
 def log_activity():
     if "email" not in session:
         return jsonify({"error": "Unauthorized"}), 401
@@ -527,6 +1833,7 @@ def log_activity():
         pdf_base64=pdf_base64
     )
     db.session.add(new_log)
+    bump_counters(user.id, activities=1)
     db.session.commit()
 
     return jsonify({"message": "Activity logged successfully"})
@@ -555,32 +1862,198 @@ def table():
 
 
 
-@app.route("/pay", methods=["GET", "POST"])
-def pay():
-    if "email" not in session:
-        return redirect(url_for("login"))  # Ensure user is logged in
+# ✅ Payment State Machine
+PAYMENT_TRANSITIONS = {
+    "Pending": {"Success", "Failed", "Expired"},
+    "Expired": {"Success"},  # A late, verified success still counts
+}
+ENTITLEMENT_DAYS = int(os.getenv("ENTITLEMENT_DAYS", "0"))  # 0 = plans never expire
 
-    email = session.get("email")
-    name = session.get("name", "User")
+entitlement_cache = make_cache("entitlement", ttl=300, max_size=4096)
 
-    if request.method == "POST":  # Payment initiated via form submission
-        txnid = str(int(time.time()))  # Unique transaction ID
-        amount = request.form.get("amount", "0.00")
-        productinfo = request.form.get("productinfo", "Subscription Plan")
 
-    else:  # If request is GET (from a button click)
-        plan = request.args.get("plan")
-        amount = request.args.get("amount")
-        txnid = "TXN" + str(int(time.time() * 1000)) + str(random.randint(1000, 9999))  # Unique txnid
-        productinfo = plan if plan else "Subscription Plan"
+def entitlement_to_dict(entitlement):
+    return {
+        "plan": entitlement.plan_name,
+        "status": entitlement.status,
+        "expires_at": entitlement.expires_at,
+    }
 
-    # ✅ Generate PayU Hash
-    hash_value = generate_payu_hash(txnid, amount, productinfo, name, email)
 
-    # ✅ Store transaction in DB (status: "Pending")
-    payment = Payment(email=email, name=name, amount=amount, plan_name=productinfo, txnid=txnid, payment_status="Pending")
-    db.session.add(payment)
-    db.session.commit()
+def load_entitlement(email):
+    """Read the materialized entitlement, backfilling it from Payment once."""
+    entitlement = Entitlement.query.filter_by(email=email).first()
+    if not entitlement:
+        payment = (
+            Payment.query.filter_by(email=email, payment_status="Success")
+            .filter(~Payment.txnid.in_(db.session.query(EventPayment.txnid)))  # Event tickets aren't plans
+            .order_by(Payment.created_at.desc())
+            .first()
+        )
+        entitlement = Entitlement(email=email, status="Inactive")
+        if payment:
+            apply_payment_to_entitlement(entitlement, payment)
+        entitlement = add_entitlement(entitlement)
+        db.session.commit()
+    return entitlement_to_dict(entitlement)
+
+
+def add_entitlement(entitlement):
+    """Insert a new Entitlement row, or return the one a concurrent request inserted first."""
+    try:
+        with db.session.begin_nested():
+            db.session.add(entitlement)
+        return entitlement
+    except IntegrityError:
+        return Entitlement.query.filter_by(email=entitlement.email).one()
+
+
+def get_entitlement(email):
+    return entitlement_cache.get_or_set(email, lambda: load_entitlement(email))
+
+
+def is_entitled(entitlement):
+    if entitlement["status"] != "Active":
+        return False
+    return entitlement["expires_at"] is None or entitlement["expires_at"] > datetime.utcnow()
+
+
+def has_paid(email):
+    """Cached subscription check; served from memory on repeat calls."""
+    return is_entitled(get_entitlement(email))
+
+
+def check_entitlement(api=False):
+    """Gate the current request on an active subscription; returns a response if it's denied.
+
+    Pages redirect (to login, or home when unpaid); API routes (api=True)
+    answer 401/402 JSON instead.
+    """
+    email = session.get("email")
+    if not email:
+        return (jsonify({"error": "Unauthorized"}), 401) if api else redirect(url_for("login"))
+    if not has_paid(email):
+        logging.warning(f"🚫 Access Denied: {email} has NOT paid!")
+        if api:
+            return jsonify({"error": "An active subscription is required"}), 402
+        return redirect(url_for("home"))
+    return None
+
+
+def requires_entitlement(api=False):
+    """Route decorator: only users with an active subscription get through (see check_entitlement)."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            return check_entitlement(api) or view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def apply_payment_to_entitlement(entitlement, payment):
+    entitlement.plan_name = payment.plan_name
+    entitlement.status = "Active"
+    entitlement.txnid = payment.txnid
+    entitlement.expires_at = (
+        (payment.created_at or datetime.utcnow()) + timedelta(days=ENTITLEMENT_DAYS) if ENTITLEMENT_DAYS else None
+    )
+
+
+def update_entitlement(payment):
+    """Reflect a payment transition in the user's entitlement record.
+
+    A failed payment never revokes an active plan; it only materializes an
+    'Inactive' row so later checks don't fall back to scanning Payment.
+    """
+    entitlement = Entitlement.query.filter_by(email=payment.email).first()
+    if not entitlement:
+        entitlement = add_entitlement(Entitlement(email=payment.email, status="Inactive"))
+
+    if payment.payment_status == "Success":
+        apply_payment_to_entitlement(entitlement, payment)
+
+    db.session.commit()
+    entitlement_cache.delete(payment.email)
+
+
+def apply_payment(payment):
+    """Hand over what a payment transition paid for: a seat for event payments, otherwise the plan.
+
+    Called once per transition, so this is also where the receipt gets rendered.
+    """
+    event_payment = EventPayment.query.filter_by(txnid=payment.txnid).first()
+    if event_payment is None:
+        update_entitlement(payment)
+    elif payment.payment_status == "Success":
+        settle_event_payment(event_payment)
+
+    if payment.payment_status == "Success":
+        render_receipt.delay(payment.txnid, payment.plan_name, f"{payment.amount:.2f}")
+
+
+def payment_sources(new_status):
+    return [state for state, targets in PAYMENT_TRANSITIONS.items() if new_status in targets]
+
+
+def transition_payment(txnid, new_status):
+    """Move a payment out of Pending exactly once.
+
+    Uses a conditional UPDATE so duplicate or concurrent callbacks can't
+    apply the same transition twice. Returns (payment, changed).
+    """
+    changed = (
+        Payment.query
+        .filter(Payment.txnid == txnid, Payment.payment_status.in_(payment_sources(new_status)))
+        .update({"payment_status": new_status}, synchronize_session=False)
+    )
+    db.session.commit()
+
+    payment = Payment.query.filter_by(txnid=txnid).first()
+    if payment and changed:
+        apply_payment(payment)
+    return payment, bool(changed)
+
+
+@app.route("/pay", methods=["GET", "POST"])
+def pay():
+    if "email" not in session:
+        return redirect(url_for("login"))  # Ensure user is logged in
+
+    email = session.get("email")
+    name = session.get("name", "User")
+    txnid = generate_txnid()
+    event = None
+
+    if request.values.get("event_id"):  # Paying for one event: price and description come from the Event row
+        event = Event.query.get(request.values.get("event_id", type=int) or 0)
+        user_id = current_user_id()
+        if event is None or not event.price or user_id is None:
+            return "Event not found", 404
+        if event.id in get_enrolled_event_ids(user_id):
+            return "Already enrolled in this event", 409
+        if event.capacity is not None and event.enrolled_count >= event.capacity:
+            return "This event is full", 409
+        amount = f"{event.price:.2f}"
+        productinfo = f"Event: {event.title}"[:50]
+
+    elif request.method == "POST":  # Payment initiated via form submission
+        amount = request.form.get("amount", "0.00")
+        productinfo = request.form.get("productinfo", "Subscription Plan")
+
+    else:  # If request is GET (from a button click)
+        plan = request.args.get("plan")
+        amount = request.args.get("amount")
+        productinfo = plan if plan else "Subscription Plan"
+
+    # ✅ Generate PayU Hash
+    hash_value = generate_payu_hash(txnid, amount, productinfo, name, email)
+
+    # ✅ Store transaction in DB (status: "Pending")
+    payment = Payment(email=email, name=name, amount=amount, plan_name=productinfo, txnid=txnid, payment_status="Pending")
+    db.session.add(payment)
+    if event:
+        db.session.add(EventPayment(txnid=txnid, user_id=user_id, event_id=event.id))
+    db.session.commit()
 
     # ✅ Prepare PayU Data
     payu_data = {
@@ -603,43 +2076,75 @@ def pay():
 @app.route('/success', methods=['GET', 'POST'])
 def success():
     if request.method == 'POST' and 'txnid' in request.form:
-        print(request.form)  # Debug: Print PayU's response in logs
-        txnid = request.form.get('txnid', 'Unknown')
-        plan = request.form.get('productinfo', 'N/A')
-        amount = request.form.get('amount', '0.00')
-    else:  # Use GET as a fallback
-        print(request.args)  # Debug: Print if PayU sends GET
+        # ✅ PayU callback: only trust it once the reverse hash checks out
+        if not verify_payu_response_hash(request.form):
+            logging.warning(f"🚨 PayU hash mismatch on success callback - TXN: {request.form.get('txnid')}")
+            return "Invalid payment response", 400
+
+        txnid = request.form['txnid']
+        if request.form.get('status') != 'success':
+            transition_payment(txnid, "Failed")
+            return render_template('payment_failed.html')
+
+        payment = Payment.query.filter_by(txnid=txnid).first()
+        try:
+            paid_amount = float(request.form.get('amount', 0))
+        except ValueError:
+            paid_amount = -1
+        if not payment or abs(payment.amount - paid_amount) > 0.005:
+            logging.warning(f"🚨 PayU amount/txnid mismatch on success callback - TXN: {txnid}")
+            return "Invalid payment response", 400
+
+        payment, changed = transition_payment(txnid, "Success")
+        if changed:
+            logging.info(f"✅ Payment Success for {payment.email} - TXN: {txnid}")
+    else:
+        # Plain GET redirects are unsigned, so only show what the DB already confirms
         txnid = request.args.get('txnid', 'Unknown')
-        plan = request.args.get('productinfo', 'N/A')
-        amount = request.args.get('amount', '0.00')
-
-    print(f"Received Payment Data -> Transaction ID: {txnid}, Plan: {plan}, Amount: {amount}")
+        payment = Payment.query.filter_by(txnid=txnid).first()
 
-    # ✅ Update payment status in database
-    payment = Payment.query.filter_by(txnid=txnid).first()
-    if payment:
-        payment.payment_status = "Success"
-        db.session.commit()
-        logging.info(f"✅ Payment Success for {payment.email} - TXN: {txnid}")
+    if not payment or payment.payment_status != "Success":
+        return redirect(url_for('home'))
 
-    # ✅ Generate Receipt PDF
-    pdf_path = f"receipt_{txnid}.pdf"
-    generate_pdf(txnid, plan, amount, pdf_path)
+    plan, amount = payment.plan_name, f"{payment.amount:.2f}"
 
-    return render_template('payment_success.html', txnid=txnid, plan=plan, amount=amount, pdf_path=pdf_path)
+    # ✅ The receipt PDF was queued by the Pending -> Success transition; /generate_receipt covers a slow render
+    pdf_path = receipt_name(txnid)
+    return render_template('payment_success.html', txnid=txnid, plan=plan, amount=amount, pdf_path=pdf_path, name=payment.name)
 
 
 
 @app.route('/generate_receipt/<txnid>')
 def generate_receipt(txnid):
-    plan = request.args.get('plan')
-    amount = request.args.get('amount')
-    pdf_path = f"receipt_{txnid}.pdf"
-    generate_pdf(txnid, plan, amount, pdf_path)
-    return send_file(pdf_path, as_attachment=True)
-
-def generate_pdf(txnid, plan, amount, pdf_path):
-    c = canvas.Canvas(pdf_path)
+    if "email" not in session:
+        return redirect(url_for("login"))
+
+    # ✅ Receipts only for the payer's own successful payments, with values from the DB
+    payment = Payment.query.filter_by(txnid=txnid, email=session["email"], payment_status="Success").first()
+    if not payment:
+        return "Receipt not found", 404
+
+    pdf_path = receipt_name(txnid)
+    if not file_store.exists(pdf_path):  # The background render hasn't finished yet
+        file_store.put(pdf_path, generate_pdf(txnid, payment.plan_name, f"{payment.amount:.2f}"))
+    return send_file(
+        BytesIO(file_store.get(pdf_path)), mimetype="application/pdf", as_attachment=True, download_name=f"receipt_{txnid}.pdf"
+    )
+
+
+def receipt_name(txnid):
+    return f"receipts/receipt_{secure_filename(txnid)}.pdf"
+
+
+@tasks.task(max_attempts=3, priority=10)  # The user is waiting on this one
+def render_receipt(txnid, plan, amount):
+    pdf_path = receipt_name(txnid)
+    file_store.put(pdf_path, generate_pdf(txnid, plan, amount))
+    return {"pdf_path": pdf_path}
+
+def generate_pdf(txnid, plan, amount):
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer)
     
     c.setFont("Helvetica-Bold", 16)
     c.drawString(200, 800, "Payment Receipt")
@@ -651,46 +2156,224 @@ def generate_pdf(txnid, plan, amount, pdf_path):
     
     c.drawString(100, 680, "Thank you for your purchase!")
     c.save()
+    return buffer.getvalue()
 
 # ✅ Failure Route (Update Payment Status)
-@app.route('/failure')
+@app.route('/failure', methods=['GET', 'POST'])
 def failure():
-    txnid = request.args.get("txnid")
-    payment = Payment.query.filter_by(txnid=txnid).first()
-    
-    if payment:
-        payment.payment_status = "Failed"
-        db.session.commit()
-        logging.warning(f"🚨 Payment Failed for {payment.email} - TXN: {txnid}")
-    
-    return render_template('payment_failure.html')
-    
+    if request.method == 'POST' and 'txnid' in request.form:
+        if not verify_payu_response_hash(request.form):
+            logging.warning(f"🚨 PayU hash mismatch on failure callback - TXN: {request.form.get('txnid')}")
+            return "Invalid payment response", 400
 
+        payment, changed = transition_payment(request.form['txnid'], "Failed")
+        if changed:
+            logging.warning(f"🚨 Payment Failed for {payment.email} - TXN: {payment.txnid}")
 
-@app.route('/get_questions', methods=['GET'])
-def get_questions():
-    try:
-        questions = Question.query.order_by(Question.created_at.desc()).all()
+    return render_template('payment_failed.html')
+
+
+# ✅ Payment Reconciliation (settles Pending rows whose PayU redirect never arrived)
+PAYU_VERIFY_URL = os.getenv("PAYU_VERIFY_URL", "https://info.payu.in/merchant/postservice.php?form=2")  # "local" = LocalPaymentVerifier
+PAYU_LOCAL_STATUS_FILE = os.getenv("PAYU_LOCAL_STATUS_FILE")  # {txnid: {"status": ..., "amt": ...}} for the local verifier
+RECONCILE_MIN_AGE_MINUTES = int(os.getenv("RECONCILE_MIN_AGE_MINUTES", "15"))  # Leave checkouts still in progress alone
+PAYMENT_EXPIRE_AFTER_HOURS = int(os.getenv("PAYMENT_EXPIRE_AFTER_HOURS", "24"))
+RECONCILE_PAGE_SIZE = 500  # Pending rows read per query
+RECONCILE_VERIFY_BATCH = 25  # txnids per verify call
+
+PAYU_FAILED_STATUSES = {"failure", "failed", "dropped", "bounced", "usercancelled"}
+
+
+class PayUVerifier:
+    """Looks up a batch of transactions with PayU's verify_payment command."""
+
+    def __init__(self, url, key, salt, timeout=15):
+        self.url = url
+        self.key = key
+        self.salt = salt
+        self.timeout = timeout
+
+    def verify(self, txnids):
+        """Return {txnid: {"status": ..., "amt": ...}} for every txnid asked about."""
+        command, var1 = "verify_payment", "|".join(txnids)
+        hash_value = hashlib.sha512(f"{self.key}|{command}|{var1}|{self.salt}".encode("utf-8")).hexdigest().lower()
+        response = requests.post(
+            self.url, data={"key": self.key, "command": command, "var1": var1, "hash": hash_value}, timeout=self.timeout
+        )
+        response.raise_for_status()
+        details = response.json().get("transaction_details") or {}
+        return {txnid: details.get(txnid) or {"status": "Not Found"} for txnid in txnids}
+
+
+class LocalPaymentVerifier:
+    """Stand-in for PayU in development and tests (PAYU_VERIFY_URL=local).
+
+    Answers from `statuses` and the optional JSON file; any other txnid is
+    reported "Not Found", like a checkout that never reached the gateway.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.statuses = {}
+
+    def verify(self, txnids):
+        statuses = dict(self.statuses)
+        if self.path and os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                statuses = {**json.load(f), **statuses}
+        return {txnid: statuses.get(txnid) or {"status": "Not Found"} for txnid in txnids}
+
+
+payment_verifier = (
+    LocalPaymentVerifier(PAYU_LOCAL_STATUS_FILE) if PAYU_VERIFY_URL == "local"
+    else PayUVerifier(PAYU_VERIFY_URL, MERCHANT_KEY, MERCHANT_SALT)
+)
 
-        return jsonify([
+
+def transition_payments(txnids, new_status):
+    """Bulk transition_payment: one conditional UPDATE for the whole batch."""
+    if not txnids:
+        return 0
+    changed = (
+        Payment.query
+        .filter(Payment.txnid.in_(txnids), Payment.payment_status.in_(payment_sources(new_status)))
+        .update({"payment_status": new_status}, synchronize_session=False)
+    )
+    db.session.commit()
+    return changed
+
+
+def reconcile_payment_batch(rows, expire_before, result):
+    """Verify one batch of Pending rows and apply the outcomes in bulk."""
+    details = payment_verifier.verify([row.txnid for row in rows])
+    succeeded, failed, expired = [], [], []
+
+    for row in rows:
+        detail = details.get(row.txnid) or {}
+        status = str(detail.get("status", "")).lower()
+        if status == "success":
+            try:
+                paid_amount = float(detail.get("amt", -1))
+            except (TypeError, ValueError):
+                paid_amount = -1
+            if abs(row.amount - paid_amount) > 0.005:
+                logging.warning(f"🚨 PayU amount mismatch during reconciliation - TXN: {row.txnid}")
+                result["mismatched"] += 1
+                continue
+            succeeded.append(row.txnid)
+        elif status in PAYU_FAILED_STATUSES:
+            failed.append(row.txnid)
+        elif row.created_at and row.created_at < expire_before:
+            expired.append(row.txnid)  # Abandoned: never paid and past the expiry window
+
+    result["succeeded"] += transition_payments(succeeded, "Success")
+    result["failed"] += transition_payments(failed, "Failed")
+    result["expired"] += transition_payments(expired, "Expired")
+
+    # ✅ Only the (few) newly paid rows touch entitlements and enrollments
+    if succeeded:
+        for payment in Payment.query.filter(Payment.txnid.in_(succeeded), Payment.payment_status == "Success"):
+            apply_payment(payment)
+
+
+@tasks.task(max_attempts=2)
+def reconcile_payments(expire_after_hours=None):
+    """Page through stale Pending payments and settle them against the gateway."""
+    now = datetime.utcnow()
+    settle_before = now - timedelta(minutes=RECONCILE_MIN_AGE_MINUTES)
+    expire_before = now - timedelta(hours=expire_after_hours or PAYMENT_EXPIRE_AFTER_HOURS)
+    result = {"checked": 0, "succeeded": 0, "failed": 0, "expired": 0, "mismatched": 0, "errors": 0}
+
+    last_id = 0
+    while True:
+        page = (
+            db.session.query(Payment.id, Payment.txnid, Payment.amount, Payment.created_at)
+            .filter(Payment.payment_status == "Pending", Payment.created_at < settle_before, Payment.id > last_id)
+            .order_by(Payment.id)
+            .limit(RECONCILE_PAGE_SIZE)
+            .all()
+        )
+        if not page:
+            break
+        last_id = page[-1].id
+
+        for i in range(0, len(page), RECONCILE_VERIFY_BATCH):
+            batch = page[i:i + RECONCILE_VERIFY_BATCH]
+            try:
+                reconcile_payment_batch(batch, expire_before, result)
+                result["checked"] += len(batch)
+            except (requests.RequestException, ValueError) as e:
+                db.session.rollback()
+                result["errors"] += 1
+                logging.error(f"❌ Payment verify failed for {len(batch)} transactions: {str(e)}")
+
+    logging.info(f"✅ Payment reconciliation finished: {result}")
+    return result
+
+
+@app.cli.command("reconcile-payments")
+@click.option("--expire-after-hours", type=int, default=None, help="Expire unpaid checkouts older than this.")
+def reconcile_payments_command(expire_after_hours):
+    """Settle stale Pending payments against PayU and expire abandoned ones."""
+    print(reconcile_payments(expire_after_hours))
+
+
+
+# ✅ Forum Delta Feed (clients poll for changes since their version)
+FORUM_DELTA_LIMIT = 200  # More changes than this and the client just reloads everything
+FORUM_VERSION_OVERLAP = 20  # Re-scan recent ids in case a lower id committed late
+
+forum_version_cache = make_cache("forum_version", ttl=1, max_size=1)
+
+
+def record_forum_change(kind, question_id=None):
+    """Append to the change feed; commit together with the write it describes."""
+    db.session.add(ForumChange(kind=kind, question_id=question_id))
+
+
+def invalidate_forum_version():
+    forum_version_cache.delete("version")
+
+
+def get_forum_version():
+    """Current forum version: one primary-key lookup, cached for a second across polls."""
+    return forum_version_cache.get_or_set("version", lambda: db.session.query(func.max(ForumChange.id)).scalar() or 0)
+
+
+def question_to_dict(q):
+    return {
+        'id': q.id,
+        'username': q.user.name if q.user else "Unknown User",
+        'user_picture': q.user.picture if q.user and q.user.picture else "/static/images/default-user.png",
+        'question_text': q.question_text,
+        'timestamp': q.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'answers': [
             {
-                'id': q.id,
-                'username': q.user.name if q.user else "Unknown User",
-                'user_picture': q.user.picture if q.user and q.user.picture else "/static/images/default-user.png",
-                'question_text': q.question_text,
-                'timestamp': q.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                'answers': [
-                    {
-                        'username': a.user.name,
-                        'user_picture': a.user.picture if a.user.picture else "/static/images/default-user.png",
-                        'answer_text': a.answer_text,
-                        'timestamp': a.created_at.strftime('%Y-%m-%d %H:%M:%S')
-                    }
-                    for a in q.answers
-                ]
+                'username': a.user.name,
+                'user_picture': a.user.picture if a.user.picture else "/static/images/default-user.png",
+                'answer_text': a.answer_text,
+                'timestamp': a.created_at.strftime('%Y-%m-%d %H:%M:%S')
             }
-            for q in questions
-        ])
+            for a in sorted(q.answers, key=lambda a: a.id)
+        ]
+    }
+
+
+def load_forum_questions(question_ids=None):
+    """Questions with their answers and authors, loaded in a fixed number of queries."""
+    query = Question.query.options(
+        joinedload(Question.user),
+        selectinload(Question.answers).joinedload(Answer.user),
+    )
+    if question_ids is not None:
+        query = query.filter(Question.id.in_(question_ids))
+    return [question_to_dict(q) for q in query.order_by(Question.created_at.desc()).all()]
+
+
+@app.route('/get_questions', methods=['GET'])
+def get_questions():
+    try:
+        return json_response(load_forum_questions())
 
     except Exception as e:
         import traceback
@@ -698,8 +2381,43 @@ def get_questions():
         return jsonify({'error': 'Internal Server Error', 'details': str(e)}), 500
 
 
+@app.route('/forum/changes', methods=['GET'])
+def get_forum_changes():
+    """Forum changes since `since` (the version from the previous response).
+
+    Returns 204 when nothing changed, without touching the Question/Answer
+    tables. Otherwise {"version", "reset", "questions"}: with reset=false the
+    questions are the ones that changed (new, answered or edited) and should
+    be merged by id; with reset=true they are the whole forum.
+    """
+    since = request.args.get('since', type=int)  # Omitted on the first poll
+    version = get_forum_version()
+    headers = {"X-Forum-Version": str(version)}
+
+    if since is not None and since >= version:
+        return Response(status=204, headers=headers)
+
+    reset = since is None
+    if not reset:
+        changes = (
+            db.session.query(ForumChange.kind, ForumChange.question_id)
+            .filter(ForumChange.id > max(since - FORUM_VERSION_OVERLAP, 0), ForumChange.id <= version)
+            .order_by(ForumChange.id)
+            .limit(FORUM_DELTA_LIMIT + 1)
+            .all()
+        )
+        reset = len(changes) > FORUM_DELTA_LIMIT or any(kind == "reset" for kind, _ in changes)
+        question_ids = {question_id for _, question_id in changes if question_id is not None}
+
+    questions = load_forum_questions() if reset else load_forum_questions(question_ids)
+    response = json_response({"version": version, "reset": reset, "questions": questions})
+    response.headers.update(headers)
+    return response
+
+
 
 @app.route('/ask_expert', methods=['POST'])
+@rate_limit("ask_expert")
 def ask_expert():
     if 'email' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
@@ -709,14 +2427,21 @@ def ask_expert():
         return jsonify({'error': 'User not found'}), 404
 
     data = request.get_json()
-    
+
+    # ✅ Subscribers are served first; resolve this before adding rows, since an
+    # entitlement cache miss commits the session
+    priority = 1 if has_paid(user.email) else 0
+
     # Store expert question with profile picture
     expert_question = ExpertQuestion(
-        user_id=user.id, 
-        username=user.name, 
+        user_id=user.id,
+        username=user.name,
         question_text=data['question']
     )
+    # Question, ticket and counter go in one commit
     db.session.add(expert_question)
+    db.session.add(ExpertTicket(question=expert_question, priority=priority))
+    bump_counters(user.id, expert_questions=1)
     db.session.commit()
 
     return jsonify({
@@ -726,6 +2451,209 @@ def ask_expert():
 
 
 
+# ✅ Expert Inbox (prioritized queue with claim leases)
+EXPERT_EMAILS = set(filter(None, os.getenv("EXPERT_EMAILS", "").split(",")))
+EXPERT_LEASE_MINUTES = 30
+EXPERT_MAX_CLAIM = 20
+
+
+def is_expert():
+    email = session.get("email")
+    return bool(email) and (email in EXPERT_EMAILS or email in ADMIN_EMAILS)
+
+
+def require_expert(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not is_expert():
+            return jsonify({"error": "Unauthorized"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def claimable_tickets_filter(now):
+    """Open tickets, plus claimed ones whose lease has run out."""
+    return or_(
+        ExpertTicket.status == "open",
+        and_(ExpertTicket.status == "claimed", ExpertTicket.lease_expires_at < now),
+    )
+
+
+def expert_ticket_to_dict(ticket, question):
+    return {
+        "id": ticket.id,
+        "question": question.question_text,
+        "username": question.username,
+        "asked_at": question.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+        "status": ticket.status,
+        "priority": ticket.priority,
+        "assignee": ticket.assignee_email,
+        "lease_expires_at": ticket.lease_expires_at.strftime("%Y-%m-%d %H:%M:%S") if ticket.lease_expires_at else None,
+        "answer": ticket.answer_text,
+    }
+
+
+def queue_query(now):
+    return (
+        db.session.query(ExpertTicket, ExpertQuestion)
+        .join(ExpertQuestion, ExpertQuestion.id == ExpertTicket.expert_question_id)
+        .filter(claimable_tickets_filter(now))
+        .order_by(ExpertTicket.priority.desc(), ExpertTicket.created_at.asc(), ExpertTicket.id.asc())
+    )
+
+
+def claim_expert_tickets(expert_email, limit):
+    """Lease up to `limit` tickets to an expert without double-assignment.
+
+    Candidates are read skipping rows other experts have locked, and each
+    claim is a conditional UPDATE that only succeeds while the ticket is
+    still claimable, so concurrent claimers can never both win.
+    """
+    now = datetime.utcnow()
+    lease_until = now + timedelta(minutes=EXPERT_LEASE_MINUTES)
+
+    candidates = queue_query(now).with_for_update(skip_locked=True).limit(limit * 2).all()
+
+    claimed = []
+    for ticket, question in candidates:
+        won = (
+            ExpertTicket.query
+            .filter(ExpertTicket.id == ticket.id, claimable_tickets_filter(now))
+            .update(
+                {"status": "claimed", "assignee_email": expert_email, "lease_expires_at": lease_until},
+                synchronize_session=False,
+            )
+        )
+        if won:
+            claimed.append((ticket.id, question))
+        if len(claimed) == limit:
+            break
+    db.session.commit()
+
+    tickets = {t.id: t for t in ExpertTicket.query.filter(ExpertTicket.id.in_([ticket_id for ticket_id, _ in claimed]))} if claimed else {}
+    return [expert_ticket_to_dict(tickets[ticket_id], question) for ticket_id, question in claimed]
+
+
+@app.route('/expert/inbox', methods=['GET'])
+@require_expert
+def expert_inbox():
+    """Peek at the next N unanswered questions, highest priority and oldest first."""
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+    rows = queue_query(datetime.utcnow()).limit(limit).all()
+    return jsonify([expert_ticket_to_dict(ticket, question) for ticket, question in rows])
+
+
+@app.route('/expert/inbox/mine', methods=['GET'])
+@require_expert
+def expert_my_claims():
+    rows = (
+        db.session.query(ExpertTicket, ExpertQuestion)
+        .join(ExpertQuestion, ExpertQuestion.id == ExpertTicket.expert_question_id)
+        .filter(ExpertTicket.assignee_email == session["email"], ExpertTicket.status == "claimed")
+        .order_by(ExpertTicket.lease_expires_at)
+        .all()
+    )
+    return jsonify([expert_ticket_to_dict(ticket, question) for ticket, question in rows])
+
+
+@app.route('/expert/inbox/claim', methods=['POST'])
+@require_expert
+def expert_claim():
+    try:
+        limit = min(max(int((request.get_json(silent=True) or {}).get('limit', 1)), 1), EXPERT_MAX_CLAIM)
+    except (TypeError, ValueError):
+        return jsonify({"error": "limit must be a number"}), 400
+    return jsonify({"claimed": claim_expert_tickets(session["email"], limit)})
+
+
+@app.route('/expert/inbox/<int:ticket_id>/answer', methods=['POST'])
+@require_expert
+def expert_answer(ticket_id):
+    answer_text = ((request.get_json(silent=True) or {}).get('answer') or '').strip()
+    if not answer_text:
+        return jsonify({"error": "Answer cannot be empty"}), 400
+
+    answered = (
+        ExpertTicket.query
+        .filter(ExpertTicket.id == ticket_id, ExpertTicket.status == "claimed", ExpertTicket.assignee_email == session["email"])
+        .update(
+            {"status": "answered", "answer_text": answer_text, "answered_at": datetime.utcnow(), "lease_expires_at": None},
+            synchronize_session=False,
+        )
+    )
+    db.session.commit()
+    if not answered:
+        return jsonify({"error": "Ticket is not claimed by you"}), 409
+    return jsonify({"message": "Answer saved"})
+
+
+@app.route('/expert/inbox/<int:ticket_id>/release', methods=['POST'])
+@require_expert
+def expert_release(ticket_id):
+    released = (
+        ExpertTicket.query
+        .filter(ExpertTicket.id == ticket_id, ExpertTicket.status == "claimed", ExpertTicket.assignee_email == session["email"])
+        .update({"status": "open", "assignee_email": None, "lease_expires_at": None}, synchronize_session=False)
+    )
+    db.session.commit()
+    if not released:
+        return jsonify({"error": "Ticket is not claimed by you"}), 409
+    return jsonify({"message": "Ticket released"})
+
+
+@app.cli.command("backfill-expert-tickets")
+def backfill_expert_tickets_command():
+    """Queue expert questions asked before the inbox existed."""
+    missing = (
+        db.session.query(ExpertQuestion.id)
+        .outerjoin(ExpertTicket, ExpertTicket.expert_question_id == ExpertQuestion.id)
+        .filter(ExpertTicket.id.is_(None))
+        .all()
+    )
+    db.session.bulk_insert_mappings(ExpertTicket, [{"expert_question_id": question_id, "status": "open", "priority": 0} for (question_id,) in missing])
+    db.session.commit()
+    print(f"✅ Queued {len(missing)} expert questions")
+
+
+@app.route('/my_expert_questions', methods=['GET'])
+def my_expert_questions():
+    """Paginated history of the current user's expert questions and answers."""
+    if 'email' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    user_id = db.session.query(User.id).filter(User.email == session['email']).scalar()
+    if user_id is None:
+        return jsonify({'error': 'User not found'}), 404
+
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 10, type=int), 1), 50)
+
+    rows = (
+        db.session.query(ExpertQuestion, ExpertTicket)
+        .outerjoin(ExpertTicket, ExpertTicket.expert_question_id == ExpertQuestion.id)
+        .filter(ExpertQuestion.user_id == user_id)
+        .order_by(ExpertQuestion.timestamp.desc(), ExpertQuestion.id.desc())
+        .offset((page - 1) * per_page)
+        .limit(per_page + 1)
+        .all()
+    )
+
+    return jsonify({
+        "questions": [
+            {
+                "question": question.question_text,
+                "asked_at": question.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+                "status": ticket.status if ticket else "open",
+                "answer": ticket.answer_text if ticket else None,
+                "answered_at": ticket.answered_at.strftime("%Y-%m-%d %H:%M:%S") if ticket and ticket.answered_at else None,
+            }
+            for question, ticket in rows[:per_page]
+        ],
+        "page": page,
+        "has_more": len(rows) > per_page,
+    })
+
+
 @app.route('/reports_data', methods=['GET'])
 def reports_data():
     try:
@@ -757,6 +2685,7 @@ def reports_data():
 
 
 @app.route('/ask_question', methods=['POST'])
+@rate_limit("ask_question")
 def ask_question():
     try:
         if 'email' not in session:
@@ -777,7 +2706,11 @@ def ask_question():
         new_question = Question(user_id=user.id, question_text=question_text, created_at=datetime.utcnow())
 
         db.session.add(new_question)
+        db.session.flush()
+        record_forum_change("question", new_question.id)
+        bump_counters(user.id, forum_posts=1)
         db.session.commit()
+        invalidate_forum_version()
 
         return jsonify({'message': 'Question posted successfully'})
 
@@ -790,6 +2723,7 @@ def ask_question():
 
 
 @app.route("/answer_question", methods=["POST"])
+@rate_limit("answer_question")
 def answer_question():
     try:
         if "email" not in session:
@@ -812,7 +2746,12 @@ def answer_question():
 
         new_answer = Answer(user_id=user.id, question_id=question_id, answer_text=answer_text)
         db.session.add(new_answer)
+        record_forum_change("answer", question.id)
+        if question.user_id != user.id:
+            notify(question.user_id, "reply", f"Reply from {user.email}: {answer_text}")
+        bump_counters(user.id, qa_answers=1)
         db.session.commit()
+        invalidate_forum_version()
 
         return jsonify({
             "message": "Answer posted successfully",
@@ -874,20 +2813,102 @@ def update_profile():
 
 
 
-def get_deleted_user():
-    """Ensure a default 'Deleted User' exists and return its ID."""
-    deleted_user = User.query.filter_by(email="deleted_user@system.com").first()
-    if not deleted_user:
-        deleted_user = User(
-            google_id="deleted_system_id",
-            name="Deleted User",
-            email="deleted_user@system.com",
-            picture="/static/images/default-user.png"
-        )
-        db.session.add(deleted_user)
+DELETED_USER_EMAIL = "deleted_user@system.com"
+ACCOUNT_DELETION_CHUNK = 500  # Rows reassigned per transaction
+
+_deleted_user_id = None
+_deleted_user_lock = threading.Lock()
+
+
+def get_deleted_user_id():
+    """Ensure a default 'Deleted User' exists and return its ID (cached per process)."""
+    global _deleted_user_id
+
+    if _deleted_user_id is not None:
+        return _deleted_user_id
+
+    with _deleted_user_lock:
+        if _deleted_user_id is None:
+            deleted_user = User.query.filter_by(email=DELETED_USER_EMAIL).first()
+            if not deleted_user:
+                deleted_user = User(
+                    google_id="deleted_system_id",
+                    name="Deleted User",
+                    email=DELETED_USER_EMAIL,
+                    picture="/static/images/default-user.png"
+                )
+                db.session.add(deleted_user)
+                db.session.commit()
+            _deleted_user_id = deleted_user.id
+    return _deleted_user_id
+
+
+def reassign_user_rows(job, model, deleted_user_id):
+    """Move one table's rows to the 'Deleted User' in bounded chunks.
+
+    Each chunk is its own short transaction so the hot tables are never
+    locked for the whole lifetime of a heavy user's data.
+    """
+    values = {"user_id": deleted_user_id}
+    if "username" in model.__table__.columns:
+        values["username"] = "Deleted User"
+
+    while True:
+        ids = [row.id for row in db.session.query(model.id).filter(model.user_id == job.user_id).limit(ACCOUNT_DELETION_CHUNK)]
+        if not ids:
+            return
+
+        db.session.query(model).filter(model.id.in_(ids)).update(values, synchronize_session=False)
+        job.rows_reassigned += len(ids)
+        db.session.commit()
+
+
+@tasks.task(max_attempts=1)  # Records its own failure on the job row
+def run_account_deletion(job_id):
+    job = AccountDeletionJob.query.get(job_id)
+    job.status = "Running"
+    db.session.commit()
+
+    try:
+        deleted_user_id = get_deleted_user_id()
+
+        # ✅ Every table with a user_id FK must be cleared before the user row goes: rows worth
+        # keeping move to the sentinel here, the rest (counters, notifications, enrollments,
+        # download markers) are handled below
+        for model in (
+            Question, Answer, ActivityLog, Message, ExpertQuestion, Resource, EventPayment,  # Payments stay on record
+            ActivityLogArchive, MessageArchive,
+        ):
+            job.current_table = model.__tablename__
+            db.session.commit()
+            reassign_user_rows(job, model, deleted_user_id)
+
+        # ✅ Hand the user's counters to the sentinel so leaderboards stay consistent
+        counter = UserCounter.query.get(job.user_id)
+        if counter:
+            moved = counters_to_dict(counter)
+            db.session.delete(counter)
+            bump_counters(deleted_user_id, **moved)
+
+        Notification.query.filter_by(user_id=job.user_id).delete(synchronize_session=False)  # Private, nothing to keep
+        # Dedupe markers only; the downloads stay counted on Resource.download_count
+        ResourceDownload.query.filter_by(user_id=job.user_id).delete(synchronize_session=False)
+        release_enrollments(job.user_id)
+        db.session.query(User).filter(User.id == job.user_id).delete(synchronize_session=False)
+        record_forum_change("reset")  # Their posts now show as "Deleted User"
+        job.status = "Completed"
+        job.current_table = None
         db.session.commit()
-    return deleted_user
+        invalidate_user_directory()
+        invalidate_forum_version()
+        logging.info(f"✅ Account deletion job {job.id} finished ({job.rows_reassigned} rows reassigned)")
 
+    except Exception as e:
+        db.session.rollback()
+        job.status = "Failed"
+        job.error = str(e)
+        db.session.commit()
+        logging.error(f"❌ Account deletion job {job.id} failed: {str(e)}")
 
 
 @app.route('/delete_account', methods=['POST'])
@@ -902,44 +2923,77 @@ def delete_account():
         return jsonify({"success": False, "error": "User not found"}), 404
 
     try:
-        deleted_user = get_deleted_user()  # Get or create the default 'Deleted User'
-
-        logging.info(f"Replacing user {user.id} with deleted user {deleted_user.id}")
-
-        # ✅ Replace user_id in all related tables instead of setting NULL
-        db.session.query(Question).filter(Question.user_id == user.id).update({"user_id": deleted_user.id})
-        db.session.query(Answer).filter(Answer.user_id == user.id).update({"user_id": deleted_user.id})
-        db.session.query(ActivityLog).filter(ActivityLog.user_id == user.id).update({"user_id": deleted_user.id})
-
-        db.session.delete(user)  # Now safe to delete the user
+        # ✅ Deactivate now, reassign rows and delete the user off the request path
+        user.is_active = False
+        job = AccountDeletionJob(user_id=user.id)
+        db.session.add(job)
         db.session.commit()
+        invalidate_user_directory()
+
+        run_account_deletion.delay(job.id)
 
         session.clear()  # Log the user out after deletion
-        logging.info(f"User {user.email} deleted their account")
+        logging.info(f"User {user.email} requested account deletion (job {job.id})")
 
-        return jsonify({"success": True})  # ✅ Ensure returning JSON
+        # The session is gone, so the signed token is what proves the job is theirs
+        status_token = account_deletion_serializer().dumps(job.id)
+        return jsonify({
+            "success": True,
+            "job_id": job.id,
+            "status_token": status_token,
+            "status_url": url_for("account_deletion_status", token=status_token),
+        }), 202
     except Exception as e:
         db.session.rollback()  # Rollback any partial changes
         logging.error(f"Error deleting account: {str(e)}")
-        print(f"Error deleting account: {str(e)}")  # Debug print
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+def account_deletion_serializer():
+    return URLSafeSerializer(app.secret_key, salt="account-deletion-status")
+
+
+@app.route('/account_deletion_status/<token>', methods=['GET'])
+def account_deletion_status(token):
+    """Progress of a deletion job, for the holder of the token /delete_account returned (admins may use the job id)."""
+    if session.get("is_admin") is True and token.isdigit():
+        job_id = int(token)
+    else:
+        try:
+            job_id = account_deletion_serializer().loads(token)
+        except BadSignature:
+            return jsonify({"error": "Job not found"}), 404
+
+    job = AccountDeletionJob.query.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+
+    return jsonify({
+        "job_id": job.id,
+        "status": job.status,
+        "current_table": job.current_table,
+        "rows_reassigned": job.rows_reassigned,
+    })
+
+
+def load_top_users():
+    top_users = (
+        db.session.query(User.name, User.email, UserCounter.activities.label("activity_count"))
+        .join(UserCounter, User.id == UserCounter.user_id)
+        .order_by(UserCounter.activities.desc())
+        .limit(5)
+        .all()
+    )
+    return [
+        {"name": user.name, "email": user.email, "activity_count": user.activity_count}
+        for user in top_users
+    ]
+
+
 @app.route("/get_top_users")
 def get_top_users():
     try:
-        top_users = (
-            db.session.query(User.name, User.email, db.func.count(ActivityLog.id).label("activity_count"))
-            .join(ActivityLog, User.id == ActivityLog.user_id)
-            .group_by(User.id, User.name, User.email)
-            .order_by(db.desc("activity_count"))
-            .limit(5)
-            .all()
-        )
-        return jsonify([
-            {"name": user.name, "email": user.email, "activity_count": user.activity_count} 
-            for user in top_users
-        ])
+        return leaderboards.response("top_users")
     except Exception as e:
         app.logger.error(f"Error fetching top users: {str(e)}")
         return jsonify({"error": "Internal Server Error", "details": str(e)}), 500
@@ -998,7 +3052,7 @@ def get_activity_logs():
             "pdf": log.pdf_base64
         } for log in logs.items]
 
-        return jsonify({
+        return json_response({
             "activities": activity_data,
             "total_pages": logs.pages,
             "current_page": logs.page
@@ -1073,6 +3127,13 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from flask import Flask, request, jsonify
 
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
+SMTP_SENDER = os.getenv("SMTP_SENDER", "snehafrankocean@gmail.com")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD", "sjgo tbpe ovow typt")  # Use App Password if 2FA is enabled
+BULK_EMAIL_CHUNK = 50  # Recipients per task
+
+
 @app.route("/send_bulk_email", methods=["POST"])
 def send_bulk_email():
     try:
@@ -1083,50 +3144,895 @@ def send_bulk_email():
         if not emails or not message:
             return jsonify({"message": "Invalid request. Please select recipients and enter a message."}), 400
 
-        sender_email = "snehafrankocean@gmail.com"
-        sender_password = "sjgo tbpe ovow typt"  # Use App Password if 2FA is enabled
+        # ✅ One task per chunk so a slow SMTP server never holds the request
+        task_ids = [
+            send_email_batch.delay(emails[i:i + BULK_EMAIL_CHUNK], "Bulk Email", message)
+            for i in range(0, len(emails), BULK_EMAIL_CHUNK)
+        ]
+        return jsonify({"message": f"Sending emails to {len(emails)} recipients.", "task_ids": task_ids}), 202
+
+    except Exception as e:
+        print(f"Error: {e}")  # Print the error for debugging
+        return jsonify({"message": f"Failed to send emails. Error: {str(e)}"}), 500
+
+
+@tasks.task(max_attempts=3)
+def send_email_batch(recipients, subject, message):
+    """Send one message to each recipient over a single SMTP connection.
 
-        # Setup the email server
-        server = smtplib.SMTP_SSL("smtp.gmail.com", 465)
-        server.login(sender_email, sender_password)
+    Connection/login errors raise (and are retried, nothing was sent yet);
+    per-recipient failures are reported in the result instead, so a retry
+    never sends anyone the same email twice.
+    """
+    server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT)
+    server.login(SMTP_SENDER, SMTP_PASSWORD)
 
-        # Compose and send the email
-        for recipient_email in emails:
+    sent, failed = 0, []
+    try:
+        for recipient_email in recipients:
             msg = MIMEMultipart()
-            msg["From"] = sender_email
+            msg["From"] = SMTP_SENDER
             msg["To"] = recipient_email
-            msg["Subject"] = "Bulk Email"
+            msg["Subject"] = subject
             msg.attach(MIMEText(message, "plain"))
 
-            server.sendmail(sender_email, recipient_email, msg.as_string())
-        
+            try:
+                server.sendmail(SMTP_SENDER, recipient_email, msg.as_string())
+                sent += 1
+            except smtplib.SMTPException as e:
+                failed.append({"email": recipient_email, "error": str(e)})
+    finally:
         server.quit()
-        return jsonify({"message": "Emails sent successfully!"})
 
-    except Exception as e:
-        print(f"Error: {e}")  # Print the error for debugging
-        return jsonify({"message": f"Failed to send emails. Error: {str(e)}"}), 500
+    return {"sent": sent, "failed": failed}
 
 
 
-#DOES NOT WORK
-@app.route('/update_user_status', methods=['POST'])
-def update_user_status():
-    data = request.get_json()
-    user_id = data.get("user_id")
-    new_status = data.get("status")
+# ✅ Admin User Management API
+ADMIN_USERS_PER_PAGE = 50
+ADMIN_USERS_MAX_PER_PAGE = 500
 
-    user = User.query.get(user_id)
-    if user:
-        user.is_active = new_status
-        db.session.commit()
-        return jsonify({"message": "Status updated successfully"}), 200
-    else:
-        return jsonify({"error": "User not found"}), 404
 
+def require_admin(view):
+    """Route decorator for admin-only JSON endpoints."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if session.get("is_admin") is not True:
+            return jsonify({"error": "Unauthorized"}), 403
+        return view(*args, **kwargs)
+    return wrapper
 
 
+def build_admin_user_query(filters):
+    """Build the filtered/sorted admin user query.
 
+    Usage counts come from one grouped pass over ActivityLog and paid status
+    from the materialized Entitlement table, so no per-user queries run.
+    Supported filters: q, subscription (paid/free), active (true/false),
+    min_worksheets, min_flashcards, sort, order.
+    """
+    usage = (
+        db.session.query(
+            ActivityLog.user_id.label("user_id"),
+            func.sum(case((ActivityLog.resource_type == "Worksheet", 1), else_=0)).label("worksheets"),
+            func.sum(case((ActivityLog.resource_type == "Flashcard", 1), else_=0)).label("flashcards"),
+        )
+        .group_by(ActivityLog.user_id)
+        .subquery()
+    )
+    worksheets_used = func.coalesce(usage.c.worksheets, 0)
+    flashcards_used = func.coalesce(usage.c.flashcards, 0)
+    is_paid = and_(
+        Entitlement.status == "Active",
+        or_(Entitlement.expires_at.is_(None), Entitlement.expires_at > datetime.utcnow()),
+    )
+
+    query = (
+        db.session.query(
+            User.id, User.name, User.email, User.picture, User.is_active,
+            worksheets_used.label("worksheets_used"),
+            flashcards_used.label("flashcards_used"),
+            case((is_paid, "Paid"), else_="Free").label("subscription"),
+        )
+        .outerjoin(usage, usage.c.user_id == User.id)
+        .outerjoin(Entitlement, Entitlement.email == User.email)
+    )
+
+    search = (filters.get("q") or "").strip()
+    if search:
+        query = query.filter(or_(User.name.ilike(f"%{search}%"), User.email.ilike(f"%{search}%")))
+
+    subscription = filters.get("subscription")
+    if subscription == "paid":
+        query = query.filter(is_paid)
+    elif subscription == "free":
+        query = query.filter(or_(Entitlement.id.is_(None), not_(is_paid)))
+
+    active = str(filters.get("active", "")).lower()
+    if active in ("true", "false"):
+        query = query.filter(User.is_active == (active == "true"))
+
+    if filters.get("min_worksheets"):
+        query = query.filter(worksheets_used >= int(filters["min_worksheets"]))
+    if filters.get("min_flashcards"):
+        query = query.filter(flashcards_used >= int(filters["min_flashcards"]))
+
+    sort_columns = {
+        "name": User.name,
+        "email": User.email,
+        "worksheets": worksheets_used,
+        "flashcards": flashcards_used,
+        "id": User.id,
+    }
+    sort_column = sort_columns.get(filters.get("sort"), User.id)
+    sort_column = sort_column.asc() if filters.get("order") == "asc" else sort_column.desc()
+    return query.order_by(sort_column, User.id.asc())
+
+
+def admin_user_to_dict(row):
+    return {
+        "id": row.id,
+        "name": row.name,
+        "email": row.email,
+        "picture": row.picture,
+        "is_active": bool(row.is_active),
+        "worksheets_used": int(row.worksheets_used),
+        "flashcards_used": int(row.flashcards_used),
+        "subscription": row.subscription,
+    }
+
+
+def admin_page(filters):
+    """(page, per_page) from the request, clamped; raises ValueError on junk."""
+    page = max(int(filters.get("page", 1)), 1)
+    per_page = min(max(int(filters.get("per_page", ADMIN_USERS_PER_PAGE)), 1), ADMIN_USERS_MAX_PER_PAGE)
+    return page, per_page
+
+
+def search_admin_users(filters):
+    """Return (users, total) for one page of the admin user list."""
+    page, per_page = admin_page(filters)
+
+    query = build_admin_user_query(filters)
+    total = query.order_by(None).count()
+    rows = query.offset((page - 1) * per_page).limit(per_page).all()
+    return [admin_user_to_dict(row) for row in rows], total
+
+
+def parse_user_ids(values):
+    """Client-supplied user ids as ints; raises ValueError on junk."""
+    if not isinstance(values, (list, tuple)):
+        raise ValueError("user_ids must be a list")
+    return [int(user_id) for user_id in values]
+
+
+def selected_user_ids(data):
+    """Subquery of user ids picked either explicitly or by a filter set; raises ValueError on junk ids."""
+    if data.get("user_ids"):
+        return parse_user_ids(data["user_ids"])
+
+    matches = build_admin_user_query(data.get("filters") or {}).order_by(None).with_entities(User.id.label("id")).subquery()
+    return db.select(matches.c.id)
+
+
+def stream_csv(filename, header, rows, flush_every=500):
+    """Stream rows as a CSV download without building the file in memory."""
+    def generate():
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(header)
+        for count, row in enumerate(rows, 1):
+            writer.writerow(row)
+            if count % flush_every == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+        yield buffer.getvalue()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+
+
+def send_xlsx(filename, header, rows):
+    """Write rows to a write-only workbook on disk and send it.
+
+    openpyxl's write-only mode keeps memory flat; the finished file is then
+    streamed from disk in chunks.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(header)
+    for row in rows:
+        sheet.append(row)
+
+    spool = tempfile.TemporaryFile(suffix=".xlsx")
+    workbook.save(spool)
+    spool.seek(0)
+    return send_file(
+        spool,
+        as_attachment=True,
+        download_name=filename,
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    )
+
+
+def export_rows(name, header, rows, fmt="csv"):
+    if fmt == "xlsx":
+        if Workbook is None:
+            return jsonify({"error": "XLSX export requires openpyxl"}), 501
+        return send_xlsx(f"{name}.xlsx", header, rows)
+    return stream_csv(f"{name}.csv", header, rows)
+
+
+@app.route('/update_user_status', methods=['POST'])
+@require_admin
+def update_user_status():
+    data = request.get_json()
+    user_id = data.get("user_id")
+    new_status = bool(data.get("status"))
+
+    updated = User.query.filter(User.id == user_id).update({"is_active": new_status}, synchronize_session=False)
+    db.session.commit()
+    if updated:
+        invalidate_user_directory()
+        return jsonify({"message": "Status updated successfully"}), 200
+    else:
+        return jsonify({"error": "User not found"}), 404
+
+
+@app.route('/admin/api/users', methods=['GET'])
+@require_admin
+def admin_list_users():
+    try:
+        users, total = search_admin_users(request.args)
+    except ValueError:
+        return jsonify({"error": "Invalid filter value"}), 400
+
+    return json_response({"users": users, "total": total, "page": admin_page(request.args)[0]})
+
+
+@app.route('/admin/api/users/bulk', methods=['POST'])
+@require_admin
+def admin_bulk_update_users():
+    """Activate/deactivate a selected set of users in a single UPDATE.
+
+    Body: {"action": "activate"|"deactivate", "user_ids": [...]} or
+    {"action": ..., "filters": {...same filters as /admin/api/users}}.
+    """
+    data = request.get_json() or {}
+    action = data.get("action")
+    if action not in ("activate", "deactivate"):
+        return jsonify({"error": "Unknown action"}), 400
+    if not data.get("user_ids") and not data.get("filters"):
+        return jsonify({"error": "Select users or provide filters"}), 400
+
+    try:
+        user_ids = selected_user_ids(data)
+    except (TypeError, ValueError):
+        return jsonify({"error": "user_ids must be a list of integers"}), 400
+
+    updated = (
+        User.query
+        .filter(User.id.in_(user_ids))
+        .update({"is_active": action == "activate"}, synchronize_session=False)
+    )
+    db.session.commit()
+    invalidate_user_directory()
+
+    logging.info(f"🛠️ Admin {session.get('email')} ran bulk {action} on {updated} users")
+    return jsonify({"message": f"{updated} users updated", "updated": updated})
+
+
+@app.route('/admin/api/users/export', methods=['GET', 'POST'])
+@require_admin
+def admin_export_users():
+    """Stream the selected users (ids or filters, as for bulk) as CSV/XLSX."""
+    if request.method == 'POST':
+        data = request.get_json() or {}
+    else:
+        data = {"filters": request.args, "user_ids": request.args.getlist("user_id")}
+
+    query = build_admin_user_query(data.get("filters") or {})
+    if data.get("user_ids"):
+        try:
+            query = query.filter(User.id.in_(parse_user_ids(data["user_ids"])))
+        except (TypeError, ValueError):
+            return jsonify({"error": "user_ids must be a list of integers"}), 400
+
+    header = ["id", "name", "email", "is_active", "worksheets_used", "flashcards_used", "subscription"]
+    rows = (
+        [row.id, row.name, row.email, row.is_active, row.worksheets_used, row.flashcards_used, row.subscription]
+        for row in query.yield_per(1000)
+    )
+    return export_rows("users", header, rows, data.get("format") or request.args.get("format", "csv"))
+
+
+def parse_date_range(args):
+    """Read optional start/end (YYYY-MM-DD) args; end is inclusive."""
+    start = datetime.strptime(args["start"], "%Y-%m-%d") if args.get("start") else None
+    end = datetime.strptime(args["end"], "%Y-%m-%d") + timedelta(days=1) if args.get("end") else None
+    return start, end
+
+
+@app.route('/admin/export/activity_logs', methods=['GET'])
+@require_admin
+def export_activity_logs():
+    """Export ActivityLog rows (without the PDF payloads).
+
+    Filters: start, end, resource_type, action, email; format=csv|xlsx.
+    """
+    try:
+        start, end = parse_date_range(request.args)
+    except ValueError:
+        return jsonify({"error": "Dates must be YYYY-MM-DD"}), 400
+
+    query = (
+        db.session.query(
+            ActivityLog.id, ActivityLog.date, User.email, ActivityLog.action,
+            ActivityLog.resource_type, ActivityLog.resource_name, ActivityLog.source,
+        )
+        .outerjoin(User, User.id == ActivityLog.user_id)
+        .order_by(ActivityLog.id)
+    )
+    if start:
+        query = query.filter(ActivityLog.date >= start)
+    if end:
+        query = query.filter(ActivityLog.date < end)
+    if request.args.get("resource_type"):
+        query = query.filter(ActivityLog.resource_type == request.args["resource_type"])
+    if request.args.get("action"):
+        query = query.filter(ActivityLog.action == request.args["action"])
+    if request.args.get("email"):
+        query = query.filter(User.email == request.args["email"])
+
+    header = ["id", "date", "email", "action", "resource_type", "resource_name", "source"]
+    rows = (list(row) for row in query.yield_per(1000))
+    return export_rows("activity_logs", header, rows, request.args.get("format", "csv"))
+
+
+@app.route('/admin/export/payments', methods=['GET'])
+@require_admin
+def export_payments():
+    """Export Payment rows. Filters: start, end, status, plan, email; format=csv|xlsx."""
+    try:
+        start, end = parse_date_range(request.args)
+    except ValueError:
+        return jsonify({"error": "Dates must be YYYY-MM-DD"}), 400
+
+    query = db.session.query(
+        Payment.id, Payment.created_at, Payment.txnid, Payment.email, Payment.name,
+        Payment.plan_name, Payment.amount, Payment.payment_status,
+    ).order_by(Payment.id)
+    if start:
+        query = query.filter(Payment.created_at >= start)
+    if end:
+        query = query.filter(Payment.created_at < end)
+    if request.args.get("status"):
+        query = query.filter(Payment.payment_status == request.args["status"])
+    if request.args.get("plan"):
+        query = query.filter(Payment.plan_name == request.args["plan"])
+    if request.args.get("email"):
+        query = query.filter(Payment.email == request.args["email"])
+
+    header = ["id", "created_at", "txnid", "email", "name", "plan", "amount", "status"]
+    rows = (list(row) for row in query.yield_per(1000))
+    return export_rows("payments", header, rows, request.args.get("format", "csv"))
+
+
+@app.route('/admin/export/users', methods=['GET'])
+@require_admin
+def export_users():
+    """Same as /admin/api/users/export; kept alongside the other exports."""
+    return admin_export_users()
+
+
+@app.cli.command("backfill-entitlements")
+def backfill_entitlements_command():
+    """Materialize Entitlement rows for users who paid before the table existed."""
+    paid_emails = (
+        db.session.query(Payment.email)
+        .filter(Payment.payment_status == "Success")
+        .filter(~db.session.query(Entitlement.id).filter(Entitlement.email == Payment.email).exists())
+        .distinct()
+    )
+    count = 0
+    for (email,) in paid_emails.all():
+        load_entitlement(email)
+        count += 1
+    print(f"✅ Backfilled {count} entitlements")
+
+
+@app.route("/admin/reconcile_payments", methods=["POST"])
+@require_admin
+def admin_reconcile_payments():
+    hours = (request.get_json(silent=True) or {}).get("expire_after_hours")
+    task_id = reconcile_payments.delay(int(hours) if hours else None)
+    return jsonify({"message": "Payment reconciliation started", "task_id": task_id}), 202
+
+
+# ✅ Task Status API
+@app.route('/tasks/<task_id>', methods=['GET'])
+def get_task_status(task_id):
+    """Status/result of a background task; visible to the user who queued it and to admins."""
+    task = tasks.broker.get(task_id)
+    if task is None:
+        return jsonify({"error": "Task not found"}), 404
+    if not session.get("is_admin") and (task["owner"] is None or task["owner"] != session.get("email")):
+        return jsonify({"error": "Task not found"}), 404
+    return jsonify(task_to_dict(task))
+
+
+@app.route('/admin/tasks', methods=['GET'])
+@require_admin
+def admin_list_tasks():
+    limit = min(max(request.args.get("limit", 100, type=int), 1), 500)
+    return jsonify({"tasks": [task_to_dict(task) for task in tasks.broker.list(request.args.get("status"), limit)]})
+
+
+@app.cli.command("run-tasks")
+@click.option("--workers", default=TASK_WORKERS or 4, show_default=True, help="Worker threads")
+def run_tasks_command(workers):
+    """Run task workers in the foreground (pair with TASK_WORKERS=0 on web processes)."""
+    tasks.start(workers)
+    print(f"✅ {workers} task workers polling the {tasks.broker}")
+    while True:
+        time.sleep(60)
+
+
+
+
+
+
+# ✅ AI Generation Gateway (server-side Gemini calls with a shared cache)
+GEMINI_API_URL = os.getenv(
+    "GEMINI_API_URL",
+    "https://generativelanguage.googleapis.com/v1/models/gemini-1.5-pro:streamGenerateContent",
+)
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GENERATION_TIMEOUT = 120  # Seconds to wait on the model (or on a coalesced leader)
+
+GENERATION_PROMPTS = {
+    "worksheet": (
+        'Generate a JSON object containing an array called "data" with {count} elements. '
+        "Each element should be a string-based question for a worksheet on the topic '{topic}' for "
+        "{age_group}-year-old children. Ensure the response is valid JSON with no extra text."
+    ),
+    "flashcard": (
+        'Generate a JSON object with an array called "flashcards". Each element should have '
+        "a \"question\" and an \"answer\" for flashcards on the topic '{topic}' for {age_group}-year-old children. "
+        "Ensure the response is valid JSON with no extra text."
+    ),
+}
+
+
+def parse_generated_json(text):
+    """Strip Markdown code fences from a model reply and parse the JSON."""
+    return json.loads(text.replace("```json", "").replace("```", "").strip())
+
+
+def normalize_generation_params(data):
+    """Canonical (type, topic, age_group, count) so equivalent requests share a cache entry."""
+    kind = (data.get("type") or "").strip().lower()
+    if kind not in GENERATION_PROMPTS:
+        raise ValueError("type must be 'worksheet' or 'flashcard'")
+
+    topic = " ".join(str(data.get("topic") or "").split())
+    age_group = " ".join(str(data.get("age_group") or "").split())
+    if not topic or not age_group:
+        raise ValueError("topic and age_group are required")
+    if len(topic) > 255 or len(age_group) > 50:
+        raise ValueError("topic or age_group is too long")
+
+    count = min(max(int(data.get("count") or 10), 1), 50) if kind == "worksheet" else None
+    return kind, topic, age_group, count
+
+
+class GenerationGateway:
+    """Serves model output from a cache and coalesces identical in-flight requests.
+
+    The first request for a key (the leader) calls the model and streams its
+    chunks; concurrent requests for the same key wait for the leader's result
+    instead of paying for a second model call.
+    """
+
+    def __init__(self, model_url, api_key, cache):
+        self.model_url = model_url
+        self.api_key = api_key
+        self.cache = cache
+        self.http = requests.Session()
+        self._async_http = None
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _stream_model(self, prompt):
+        response = self.http.post(
+            self.model_url,
+            params={"alt": "sse", "key": self.api_key},
+            json={"contents": [{"parts": [{"text": prompt}]}]},
+            stream=True,
+            timeout=GENERATION_TIMEOUT,
+        )
+        response.raise_for_status()
+
+        for line in response.iter_lines(decode_unicode=True):
+            yield from self._parse_sse_line(line)
+
+    @staticmethod
+    def _parse_sse_line(line):
+        if not line or not line.startswith("data:"):
+            return []
+        event = json.loads(line[len("data:"):])
+        return [
+            part["text"]
+            for candidate in event.get("candidates", [])[:1]
+            for part in candidate.get("content", {}).get("parts", [])
+            if part.get("text")
+        ]
+
+    async def _stream_model_async(self, prompt):
+        if self._async_http is None:  # Created lazily so it binds to the serving event loop
+            self._async_http = httpx.AsyncClient(timeout=GENERATION_TIMEOUT)
+
+        async with self._async_http.stream(
+            "POST",
+            self.model_url,
+            params={"alt": "sse", "key": self.api_key},
+            json={"contents": [{"parts": [{"text": prompt}]}]},
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                for text in self._parse_sse_line(line):
+                    yield text
+
+    def stream(self, key, prompt):
+        """Yield the generated text in chunks (a single chunk for cache hits and followers)."""
+        cached = self.cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+        with self._lock:
+            future = self._inflight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._inflight[key] = Future()
+
+        if not is_leader:
+            yield future.result(timeout=GENERATION_TIMEOUT)
+            return
+
+        parts = []
+        chunks = self._stream_model(prompt)
+        try:
+            for chunk in chunks:
+                parts.append(chunk)
+                yield chunk
+            future.set_result(self._finish(key, parts))
+        except GeneratorExit:
+            # The client disconnected mid-stream; finish the model call anyway so
+            # coalesced followers (and the cache) still get the reply
+            try:
+                parts.extend(chunks)
+                future.set_result(self._finish(key, parts))
+            except Exception as e:
+                future.set_exception(e)
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            if not future.done():  # Interrupted some other way; followers get an ordinary error
+                future.set_exception(RuntimeError("Generation was interrupted"))
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _finish(self, key, parts):
+        text = "".join(parts)
+        parse_generated_json(text)  # Never cache a reply the client can't use
+        self.cache.set(key, text)
+        return text
+
+    def generate(self, key, prompt):
+        return "".join(self.stream(key, prompt))
+
+    async def stream_async(self, key, prompt):
+        """stream() for the ASGI entrypoint: waits on the model without holding a thread.
+
+        Shares the cache and in-flight table with stream(), so sync and async
+        requests for the same key still make a single model call.
+        """
+        cached = self.cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+        if httpx is None:  # No async client installed; fall back to a worker thread
+            yield await asyncio.to_thread(self.generate, key, prompt)
+            return
+
+        with self._lock:
+            future = self._inflight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._inflight[key] = Future()
+
+        if not is_leader:
+            # shield(): a follower timing out or disconnecting must not cancel the shared future
+            yield await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), GENERATION_TIMEOUT)
+            return
+
+        try:
+            parts = []
+            async for chunk in self._stream_model_async(prompt):
+                parts.append(chunk)
+                yield chunk
+            future.set_result(self._finish(key, parts))
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            if not future.done():  # Cancelled or closed mid-stream; followers get an ordinary error
+                future.set_exception(RuntimeError("Generation was interrupted"))
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    async def generate_async(self, key, prompt):
+        return "".join([chunk async for chunk in self.stream_async(key, prompt)])
+
+
+generation_gateway = GenerationGateway(GEMINI_API_URL, GEMINI_API_KEY, make_cache("generation", ttl=24 * 3600, max_size=1000))
+
+
+def log_generation(user_id, kind, topic, age_group, count):
+    """Record the generation in ActivityLog (and the user's counters)."""
+    if kind == "worksheet":
+        action, resource_type = "Generated Worksheet", "Worksheet"
+        resource_name = f"{topic} ({age_group} Years, {count} Questions)"
+    else:
+        action, resource_type = "Generated Flashcard", "Flashcard"
+        resource_name = f"{topic} ({age_group} Years)"
+
+    db.session.add(ActivityLog(user_id=user_id, action=action, resource_type=resource_type, resource_name=resource_name))
+    bump_counters(user_id, activities=1)
+    db.session.commit()
+
+
+# ✅ Content Library (generated resources shared across users)
+TRENDING_LIMIT = 5
+TRENDING_WINDOW = timedelta(days=30)  # Only resources downloaded recently can trend
+LIBRARY_CONTAINER_PREFIX = "library"
+
+trending_cache = make_cache("trending", ttl=300, max_size=4)
+
+
+def resource_key(kind, topic, age_group, count):
+    """Normalized (kind, topic_key, age_key, item_count), matching ix_resource_key."""
+    return kind, topic.lower(), age_group.lower(), count or 0
+
+
+def find_resource(kind, topic, age_group, count):
+    kind, topic_key, age_key, item_count = resource_key(kind, topic, age_group, count)
+    return Resource.query.filter_by(kind=kind, topic_key=topic_key, age_key=age_key, item_count=item_count).first()
+
+
+def resource_to_dict(resource, include_content=True):
+    data = {
+        "id": resource.id,
+        "type": resource.kind,
+        "topic": resource.topic,
+        "age_group": resource.age_group,
+        "count": resource.item_count or None,
+        "blob_url": resource.blob_url,
+        "downloads": resource.download_count,
+    }
+    if include_content:
+        data["data"] = json.loads(resource.content)
+    return data
+
+
+def save_resource(user_id, kind, topic, age_group, count, result):
+    """Add a generated result to the library and return its row (or the one a concurrent request added)."""
+    kind, topic_key, age_key, item_count = resource_key(kind, topic, age_group, count)
+    resource = Resource(
+        kind=kind, topic_key=topic_key, age_key=age_key, item_count=item_count,
+        topic=topic, age_group=age_group, content=json.dumps(result), user_id=user_id,
+    )
+    db.session.add(resource)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        resource = find_resource(kind, topic, age_group, count)
+    return resource
+
+
+def load_trending_resources():
+    cutoff = datetime.utcnow() - TRENDING_WINDOW
+    rows = (
+        Resource.query
+        .filter(Resource.download_count > 0, Resource.last_downloaded_at >= cutoff)
+        .order_by(Resource.download_count.desc())
+        .limit(TRENDING_LIMIT)
+        .all()
+    )
+    return [resource_to_dict(resource, include_content=False) for resource in rows]
+
+
+def get_trending_resources():
+    """Most downloaded library resources, recomputed at most every few minutes."""
+    return trending_cache.get_or_set("trending", load_trending_resources)
+
+
+@app.route('/resources/lookup', methods=['GET'])
+def lookup_resource():
+    """Check the library before generating.
+
+    Query params: type, topic, age_group and count (worksheets). Returns the
+    resource with its generated data, or 404 if nobody has generated it yet.
+    """
+    try:
+        kind, topic, age_group, count = normalize_generation_params(request.args)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    resource = find_resource(kind, topic, age_group, count)
+    if resource is None:
+        return jsonify({'error': 'Not found'}), 404
+    return json_response(resource_to_dict(resource), max_age=60, private=False)
+
+
+@app.route('/resources/trending', methods=['GET'])
+def trending_resources():
+    return json_response({"resources": get_trending_resources()}, max_age=60, private=False)
+
+
+def count_resource_download(user_id, resource_id):
+    """Count a user's first download of a resource; returns False if there's no such resource.
+
+    Repeat downloads and the creator's own copies don't count, so nobody can
+    push a resource into Trending on their own. The increment is a single
+    UPDATE so concurrent downloads don't lose counts.
+    """
+    resource = db.session.query(Resource.id, Resource.user_id).filter(Resource.id == resource_id).first()
+    if resource is None:
+        return False
+    if user_id is None or resource.user_id == user_id:
+        return True
+
+    try:
+        with db.session.begin_nested():
+            db.session.add(ResourceDownload(resource_id=resource_id, user_id=user_id))
+            db.session.flush()
+            db.session.query(Resource).filter(Resource.id == resource_id).update(
+                {"download_count": Resource.download_count + 1, "last_downloaded_at": datetime.utcnow()},
+                synchronize_session=False,
+            )
+    except IntegrityError:
+        pass  # Already counted for this user
+    db.session.commit()
+    return True
+
+
+@app.route('/resources/<int:resource_id>/download', methods=['POST'])
+@rate_limit("resource_download")
+def record_resource_download(resource_id):
+    """Count a download made outside /upload_blob (at most once per user and resource)."""
+    user_id = current_user_id()
+    if user_id is None:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    if not count_resource_download(user_id, resource_id):
+        return jsonify({'error': 'Resource not found'}), 404
+    return jsonify({'message': 'Download recorded'})
+
+
+def attach_resource_artifact(resource_id, data):
+    """Store the first rendered PDF of a library resource under a shared blob name."""
+    resource = Resource.query.get(resource_id)
+    if resource is None or resource.blob_url:
+        return
+
+    blob_name = f"{LIBRARY_CONTAINER_PREFIX}/{resource.kind}-{resource.id}.pdf"
+    blob_client = BLOB_SERVICE_CLIENT.get_blob_client(container=CONTAINER_MAPPING[resource.kind], blob=blob_name)
+    blob_client.upload_blob(data, overwrite=True)
+
+    db.session.query(Resource).filter(Resource.id == resource.id, Resource.blob_url.is_(None)).update(
+        {"blob_url": blob_client.url}, synchronize_session=False
+    )
+    db.session.commit()
+
+
+def prepare_generation():
+    """Validate the current /generate request and check the library.
+
+    Returns (response, None) when the request can be answered right away
+    (errors and library hits), otherwise (None, job) describing the model call.
+    Shared by the Flask view and the native async view in asgi.py.
+    """
+    if 'email' not in session:
+        return (jsonify({'error': 'Unauthorized'}), 401), None
+
+    user_id = db.session.query(User.id).filter(User.email == session['email']).scalar()
+    if user_id is None:
+        return (jsonify({'error': 'User not found'}), 404), None
+
+    data = request.get_json(silent=True) or {}
+    try:
+        kind, topic, age_group, count = normalize_generation_params(data)
+    except (TypeError, ValueError) as e:
+        return (jsonify({'error': str(e)}), 400), None
+
+    resource = find_resource(kind, topic, age_group, count)
+    if resource is not None:
+        log_generation(user_id, kind, topic, age_group, count)
+        result = resource_to_dict(resource)
+        if data.get("stream"):
+            event = {"done": True, "data": result["data"], "resource_id": resource.id}
+            return Response(f"data: {json.dumps(event)}\n\n", mimetype="text/event-stream"), None
+        return jsonify({'data': result["data"], 'resource_id': resource.id}), None
+
+    prompt = GENERATION_PROMPTS[kind].format(topic=topic, age_group=age_group, count=count)
+    job = {
+        "user_id": user_id,
+        "kind": kind,
+        "topic": topic,
+        "age_group": age_group,
+        "count": count,
+        "stream": bool(data.get("stream")),
+        "prompt": prompt,
+        "key": (kind, topic.lower(), age_group.lower(), hashlib.sha256(prompt.lower().encode("utf-8")).hexdigest()),
+    }
+    return None, job
+
+
+def record_generation(job, result):
+    """Log a finished generation and add it to the library; returns the response payload."""
+    log_generation(job["user_id"], job["kind"], job["topic"], job["age_group"], job["count"])
+    resource = save_resource(job["user_id"], job["kind"], job["topic"], job["age_group"], job["count"], result)
+    return {'data': result, 'resource_id': resource.id}
+
+
+@app.route('/generate', methods=['POST'])
+@rate_limit("generate")
+@requires_entitlement(api=True)  # Model calls are the paid feature; library hits via /resources/lookup stay free
+def generate():
+    """Generate a worksheet or flashcard deck through the shared cache.
+
+    Body: {"type": "worksheet"|"flashcard", "topic", "age_group", "count", "stream"}.
+    Returns {"data": ..., "resource_id": ...}; with "stream": true the reply is
+    text/event-stream with {"text"} chunks followed by a final {"done": true, ...}
+    event. Results already in the content library are returned without a model call.
+    """
+    response, job = prepare_generation()
+    if response is not None:
+        return response
+
+    if job["stream"]:
+        def events():
+            parts = []
+            try:
+                for chunk in generation_gateway.stream(job["key"], job["prompt"]):
+                    parts.append(chunk)
+                    yield f"data: {json.dumps({'text': chunk})}\n\n"
+                result = parse_generated_json("".join(parts))
+            except Exception as e:
+                logging.error(f"❌ Generation failed: {str(e)}")
+                yield f"data: {json.dumps({'error': 'Generation failed'})}\n\n"
+                return
+            yield f"data: {json.dumps({'done': True, **record_generation(job, result)})}\n\n"
+
+        return Response(stream_with_context(events()), mimetype="text/event-stream")
+
+    try:
+        result = parse_generated_json(generation_gateway.generate(job["key"], job["prompt"]))
+    except Exception as e:
+        logging.error(f"❌ Generation failed: {str(e)}")
+        return jsonify({'error': 'Generation failed'}), 502
+
+    return jsonify(record_generation(job, result))
 
 
 from flask import Flask, request, jsonify, url_for
@@ -1135,13 +4041,12 @@ from reportlab.lib import colors
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle
 import os
 
-# Ensure PDF directory exists
-PDF_DIR = "static/pdfs"
-if not os.path.exists(PDF_DIR):
-    os.makedirs(PDF_DIR)
+PDF_PREFIX = "pdfs"  # Flashcard PDFs in file_store, served by /files/pdfs/<filename>
 
 @app.route('/generate_flashcard_pdf', methods=['POST'])
+@rate_limit("generate_flashcard_pdf")
 def generate_flashcard_pdf():
+    """Queue the PDF render; pdf_url is valid once /tasks/<task_id> reports success."""
     try:
         data = request.json  
         topic = data.get('topic', 'Unknown_Topic').replace(" ", "_")
@@ -1152,54 +4057,69 @@ def generate_flashcard_pdf():
             return jsonify({'error': 'No flashcards provided'}), 400
 
         # Generate filename
-        pdf_filename = f"{topic}_{age_group}.pdf"
-        pdf_path = os.path.join(PDF_DIR, pdf_filename)
+        pdf_filename = secure_filename(f"{topic}_{age_group}.pdf")
+        pdf_path = f"{PDF_PREFIX}/{pdf_filename}"
 
-        # Create PDF
-        doc = canvas.Canvas(pdf_path, pagesize=letter)
-        doc.setFont("Helvetica-Bold", 14)
+        task_id = render_flashcard_pdf.delay(topic, age_group, flashcards, pdf_path)
+        return jsonify({'pdf_url': url_for('serve_flashcard_pdf', filename=pdf_filename), 'task_id': task_id}), 202
 
-        y_position = 750  # Start position
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        # Add Topic and Age Group at the top
-        doc.drawString(50, y_position, f"Flashcards for Topic: {topic.replace('_', ' ')}")
-        y_position -= 20
-        doc.drawString(50, y_position, f"Age Group: {age_group.replace('_', ' ')}")
-        y_position -= 40  # Extra spacing
 
-        doc.setFont("Helvetica", 12)  # Reset font
+@tasks.task(max_attempts=3)
+def render_flashcard_pdf(topic, age_group, flashcards, pdf_path):
+    # Create PDF
+    buffer = BytesIO()
+    doc = canvas.Canvas(buffer, pagesize=letter)
+    doc.setFont("Helvetica-Bold", 14)
 
-        for index, flashcard in enumerate(flashcards):
-            question = flashcard.get('question', 'Question')
-            answer = flashcard.get('answer', 'Answer')
+    y_position = 750  # Start position
 
-            # Add Question
-            doc.drawString(50, y_position, f"Q{index+1}: {question}")
-            y_position -= 40  # Larger space between question and answer
+    # Add Topic and Age Group at the top
+    doc.drawString(50, y_position, f"Flashcards for Topic: {topic.replace('_', ' ')}")
+    y_position -= 20
+    doc.drawString(50, y_position, f"Age Group: {age_group.replace('_', ' ')}")
+    y_position -= 40  # Extra spacing
 
-            # Add Placeholder for fold
-            doc.drawString(50, y_position, "___________________________")
-            y_position -= 40  
+    doc.setFont("Helvetica", 12)  # Reset font
 
-            # Add Answer
-            doc.drawString(50, y_position, f"A: {answer}")
-            y_position -= 60  # Extra space before next question
+    for index, flashcard in enumerate(flashcards):
+        question = flashcard.get('question', 'Question')
+        answer = flashcard.get('answer', 'Answer')
 
-            # Start a new page if needed
-            if y_position < 100:
-                doc.showPage()
-                doc.setFont("Helvetica", 12)
-                y_position = 750  
+        # Add Question
+        doc.drawString(50, y_position, f"Q{index+1}: {question}")
+        y_position -= 40  # Larger space between question and answer
 
-        doc.save()
+        # Add Placeholder for fold
+        doc.drawString(50, y_position, "___________________________")
+        y_position -= 40  
 
-        return jsonify({'pdf_url': f"/static/pdfs/{pdf_filename}"})
+        # Add Answer
+        doc.drawString(50, y_position, f"A: {answer}")
+        y_position -= 60  # Extra space before next question
 
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        # Start a new page if needed
+        if y_position < 100:
+            doc.showPage()
+            doc.setFont("Helvetica", 12)
+            y_position = 750  
+
+    doc.save()
+    file_store.put(pdf_path, buffer.getvalue())
+    return {"pdf_path": pdf_path}
+
+
+@app.route('/files/pdfs/<filename>')
+def serve_flashcard_pdf(filename):
+    try:
+        data = file_store.get(f"{PDF_PREFIX}/{secure_filename(filename)}")
+    except FileNotFoundError:
+        return jsonify({'error': 'PDF not found'}), 404
+    return send_file(BytesIO(data), mimetype="application/pdf", download_name=filename)
 
 
-from collections import defaultdict
 from flask import jsonify, session
 from datetime import datetime, timedelta
 
@@ -1273,6 +4193,10 @@ def get_user_activity(email):
         return jsonify({"status": "error", "message": "User not found"}), 404
 
     logs = ActivityLog.query.filter_by(user_id=user.id).order_by(ActivityLog.date.desc()).all()
+
+    # ✅ Older history lives in the archive table; only read it when asked for
+    if request.args.get("include_archived") == "1":
+        logs += ActivityLogArchive.query.filter_by(user_id=user.id).order_by(ActivityLogArchive.date.desc()).all()
     
     log_data = [
         {
@@ -1286,7 +4210,7 @@ def get_user_activity(email):
         for log in logs
     ]
 
-    return jsonify({"status": "success", "logs": log_data})
+    return json_response({"status": "success", "logs": log_data})
 
 
 @app.route("/get_filtered_activity_logs")
@@ -1324,7 +4248,7 @@ def get_filtered_activity_logs():
 
 
 
-FOUNDER_EMAIL = "snehafrankocean@gmail.com"  # Set the founder's email
+FOUNDER_EMAIL = os.getenv("FOUNDER_EMAIL", "snehafrankocean@gmail.com")  # Set the founder's email
 
 @app.route("/post_founder_message", methods=["POST"])
 def post_founder_message():
@@ -1341,6 +4265,7 @@ def post_founder_message():
     db.session.add(new_message)
     db.session.commit()
 
+    fan_out_notification.delay("founder", f"Founder Message: {message_content}")
     return jsonify({"message": "Message posted successfully!"})
 
 
@@ -1353,6 +4278,7 @@ def get_founder_messages():
     ])
 
 @app.route('/send_message', methods=['POST'])
+@rate_limit("send_message")
 def send_message():
     if 'email' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
@@ -1371,6 +4297,7 @@ def send_message():
         message=data['message']
     )
     db.session.add(new_message)
+    bump_counters(user.id, chat_messages=1)
     db.session.commit()
 
     return jsonify({'message': 'Message sent successfully'})
@@ -1379,8 +4306,7 @@ def send_message():
 @app.route('/get_messages/<room>', methods=['GET'])
 def get_messages(room):
     messages = Message.query.filter_by(room=room).order_by(Message.timestamp).all()
-    
-    return jsonify([
+    data = [
         {
             'username': m.username,
             'message': m.message,
@@ -1388,7 +4314,28 @@ def get_messages(room):
             'profile_picture': m.user.picture if m.user.picture else "/static/images/default-user.png"
         }
         for m in messages
-    ])
+    ]
+
+    # ✅ Archived history comes first (it is older than anything still live)
+    if request.args.get('include_archived') == '1':
+        archived = (
+            db.session.query(MessageArchive, User.picture)
+            .outerjoin(User, User.id == MessageArchive.user_id)
+            .filter(MessageArchive.room == room)
+            .order_by(MessageArchive.timestamp)
+            .all()
+        )
+        data = [
+            {
+                'username': m.username,
+                'message': m.message,
+                'timestamp': m.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                'profile_picture': picture or "/static/images/default-user.png"
+            }
+            for m, picture in archived
+        ] + data
+
+    return json_response(data)
 
 
 
@@ -1402,59 +4349,141 @@ def get_user_contributions():
     if not user:
         return jsonify({"error": "User not found"}), 404
 
-    # Count user contributions
-    chat_messages = Message.query.filter_by(user_id=user.id).count()
-    forum_posts = Question.query.filter_by(user_id=user.id).count()
-    qa_answers = Answer.query.filter_by(user_id=user.id).count()
+    # ✅ Single-row lookup in user_counters
+    counters = counters_to_dict(UserCounter.query.get(user.id))
 
     return jsonify({
-        "chat_messages": chat_messages,
-        "forum_posts": forum_posts,
-        "qa_answers": qa_answers
+        "chat_messages": counters["chat_messages"],
+        "forum_posts": counters["forum_posts"],
+        "qa_answers": counters["qa_answers"]
     })
 
 
+# ✅ Notification Inbox (persisted per user, with read state)
+NOTIFICATION_PAGE_SIZE = 20
+NOTIFICATION_FANOUT_CHUNK = 1000  # Users per INSERT ... SELECT when broadcasting
+
+
+def notify(user_id, kind, message):
+    """Queue a notification inside the caller's transaction."""
+    db.session.add(Notification(user_id=user_id, kind=kind, message=message))
+
+
+@tasks.task(max_attempts=1)  # A retry would deliver the finished chunks twice
+def fan_out_notification(kind, message):
+    """Deliver one notification to every active user, a range of user ids per statement.
+
+    Each chunk is a single INSERT ... SELECT, so the rows never pass through
+    Python and no transaction covers the whole user table.
+    """
+    last_id, delivered = 0, 0
+    while True:
+        chunk = db.session.query(User.id).filter(User.id > last_id).order_by(User.id).limit(NOTIFICATION_FANOUT_CHUNK).subquery()
+        chunk_end = db.session.query(func.max(chunk.c.id)).scalar()
+        if chunk_end is None:
+            break
+
+        recipients = db.session.query(
+            User.id, literal(kind), literal(message), literal(False), literal(datetime.utcnow())
+        ).filter(User.id > last_id, User.id <= chunk_end, User.is_active == True)  # noqa: E712
+        result = db.session.execute(
+            insert(Notification).from_select(["user_id", "kind", "message", "is_read", "created_at"], recipients)
+        )
+        db.session.commit()
+        delivered += result.rowcount
+        last_id = chunk_end
+
+    logging.info(f"📣 Delivered {kind} notification to {delivered} users")
+    return delivered
+
+
+def unread_notification_count(user_id):
+    """Served entirely from ix_notification_unread."""
+    return (
+        db.session.query(func.count(Notification.id))
+        .filter(Notification.user_id == user_id, Notification.is_read == False)  # noqa: E712
+        .scalar()
+    )
+
+
 @app.route('/get_notifications', methods=['GET'])
 def get_notifications():
     if 'email' not in session:
         return jsonify({"notifications": [], "unread_count": 0})
 
-    user = User.query.filter_by(email=session['email']).first()
-    if not user:
+    user_id = db.session.query(User.id).filter(User.email == session['email']).scalar()
+    if user_id is None:
         return jsonify({"notifications": [], "unread_count": 0})
 
-    # Fetch latest notifications (founder messages, replies, top downloads)
-    founder_messages = FounderMessage.query.order_by(FounderMessage.timestamp.desc()).limit(5).all()
-    
-    # Fetch replies to questions asked by the logged-in user
-    user_questions = Question.query.filter_by(user_id=user.id).all()
-    question_ids = [q.id for q in user_questions]
+    inbox = (
+        Notification.query
+        .filter_by(user_id=user_id)
+        .order_by(Notification.id.desc())
+        .limit(NOTIFICATION_PAGE_SIZE)
+        .all()
+    )
+    notifications = [
+        {
+            "id": n.id,
+            "kind": n.kind,
+            "message": n.message,
+            "read": n.is_read,
+            "timestamp": n.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        for n in inbox
+    ]
+
+    # Alerts on Most Downloaded Topics (shared, so they carry no read state)
+    for resource in get_trending_resources():
+        label = "Worksheet" if resource["type"] == "worksheet" else "Flashcards"
+        notifications.append({
+            "id": None,
+            "kind": "trending",
+            "message": f"Trending: {resource['topic']} ({resource['age_group']} Years) {label} has been downloaded {resource['downloads']} times!",
+            "read": True,
+            "timestamp": None,
+        })
 
-    replies = Answer.query.filter(Answer.question_id.in_(question_ids)).order_by(Answer.created_at.desc()).limit(5).all()
+    return jsonify({"notifications": notifications, "unread_count": unread_notification_count(user_id)})
 
-    top_downloads = ActivityLog.query.filter(ActivityLog.resource_type == "Worksheet").order_by(ActivityLog.date.desc()).limit(5).all()
 
-    notifications = []
-    unread_count = 0  # Initialize unread count
+@app.route('/mark_notifications_read', methods=['POST'])
+def mark_notifications_read():
+    """Mark the user's notifications read.
 
-    # Messages from Founder
-    for msg in founder_messages:
-        notifications.append({"message": f"Founder Message: {msg.message}"})
-        unread_count += 1
+    Body (optional): {"ids": [...]} for specific notifications, or
+    {"up_to": id} to leave anything that arrived after the client's last
+    fetch unread. With neither, everything is marked read.
+    """
+    if 'email' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
 
-    # Replies to User Questions (Include Responder's Email)
-    for reply in replies:
-        responder = User.query.get(reply.user_id)  # Get the responder's details
-        if responder:
-            notifications.append({"message": f"Reply from {responder.email}: {reply.answer_text}"})
-            unread_count += 1
+    user_id = db.session.query(User.id).filter(User.email == session['email']).scalar()
+    if user_id is None:
+        return jsonify({"error": "User not found"}), 404
 
-    # Alerts on Most Downloaded Topics
-    for log in top_downloads:
-        notifications.append({"message": f"Trending: {log.resource_name} has been downloaded frequently!"})
-        unread_count += 1
+    data = request.get_json(silent=True) or {}
+    query = Notification.query.filter_by(user_id=user_id, is_read=False)
+    try:
+        if data.get("ids"):
+            query = query.filter(Notification.id.in_([int(i) for i in data["ids"]][:NOTIFICATION_PAGE_SIZE * 5]))
+        elif data.get("up_to") is not None:
+            query = query.filter(Notification.id <= int(data["up_to"]))
+    except (TypeError, ValueError):
+        return jsonify({"error": "ids and up_to must be integers"}), 400
+
+    marked = query.update({"is_read": True}, synchronize_session=False)
+    db.session.commit()
+    return jsonify({"marked": marked, "unread_count": unread_notification_count(user_id)})
 
-    return jsonify({"notifications": notifications, "unread_count": unread_count})
+
+@app.cli.command("backfill-notifications")
+def backfill_notifications_command():
+    """Deliver the latest founder messages to every inbox (run once after deploying the inbox)."""
+    messages = FounderMessage.query.order_by(FounderMessage.timestamp.desc()).limit(5).all()
+    for msg in reversed(messages):
+        fan_out_notification("founder", f"Founder Message: {msg.message}")
+    print(f"✅ Backfilled {len(messages)} founder messages")
 
 
 
@@ -1466,6 +4495,7 @@ def get_notifications():
 
 
 @app.route('/upload_blob', methods=['POST'])
+@rate_limit("upload_blob")
 def upload_blob():
     """Upload worksheets or flashcards to Azure Blob Storage."""
     if 'file' not in request.files or 'type' not in request.form:
@@ -1479,16 +4509,41 @@ def upload_blob():
 
     container_name = CONTAINER_MAPPING[file_type]
     filename = secure_filename(file.filename)
+    resource_id = int(request.form["resource_id"]) if request.form.get("resource_id", "").isdigit() else None
 
     try:
-        blob_client = BLOB_SERVICE_CLIENT.get_blob_client(container=container_name, blob=filename)
-        blob_client.upload_blob(file, overwrite=True)  # 🔥 Upload to Azure
-
-        return jsonify({"success": True, "url": blob_client.url})
+        # ✅ Spool to the file store and let a task (on any node) do the Azure round trip; the blob URL is known up front
+        spool_name = f"spool/{secrets.token_hex(8)}-{filename}"
+        file_store.put(spool_name, file.read())
+
+        task_id = upload_blob_file.delay(container_name, filename, spool_name, resource_id)
+        if resource_id is not None:  # The PDF reaching us is the download; count it here rather than trust a separate call
+            count_resource_download(current_user_id(), resource_id)
+        blob_url = BLOB_SERVICE_CLIENT.get_blob_client(container=container_name, blob=filename).url
+        return jsonify({"success": True, "url": blob_url, "task_id": task_id}), 202
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+@tasks.task(max_attempts=5)
+def upload_blob_file(container_name, blob_name, spool_name, resource_id=None):
+    """Upload a spooled file to Azure Blob Storage, then remove the spool copy."""
+    data = file_store.get(spool_name)
+    blob_client = BLOB_SERVICE_CLIENT.get_blob_client(container=container_name, blob=blob_name)
+    blob_client.upload_blob(data, overwrite=True)  # 🔥 Upload to Azure
+
+    # ✅ The first PDF rendered for a library resource becomes its shared artifact
+    if resource_id is not None:
+        try:
+            attach_resource_artifact(resource_id, data)
+        except Exception as e:
+            db.session.rollback()
+            logging.warning(f"⚠️ Could not store library artifact: {str(e)}")
+
+    file_store.delete(spool_name)
+    return {"url": blob_client.url}
+
+
 @app.route("/get_user_id", methods=["GET"])
 def get_user_id():
     """Fetch the user ID from the database."""
@@ -1503,6 +4558,36 @@ def get_user_id():
 
 
 
+# ✅ Batch Scheduling (interval queries + cached reads)
+BATCH_CALENDAR_PER_PAGE = 50
+
+batch_cache = make_cache("batch", ttl=600, max_size=512)
+
+
+def invalidate_batches():
+    batch_cache.clear()
+
+
+def batch_to_dict(batch):
+    return {
+        "id": batch.id,
+        "month": batch.month,
+        "week": batch.week,
+        "name": batch.name,
+        "start_date": batch.start_date.strftime('%Y-%m-%d'),
+        "end_date": batch.end_date.strftime('%Y-%m-%d')
+    }
+
+
+def parse_day(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def overlapping_batches_query(start, end):
+    """Batches whose [start_date, end_date] interval intersects [start, end]."""
+    return Batch.query.filter(Batch.start_date <= end, Batch.end_date >= start)
+
+
 @app.route('/add_batch', methods=['POST'])
 def add_batch():
     if not session.get("is_admin"):
@@ -1518,34 +4603,95 @@ def add_batch():
     if not all([month, week, name, start_date, end_date]):
         return jsonify({"error": "All batch details are required"}), 400
 
+    try:
+        start_date, end_date = parse_day(start_date), parse_day(end_date)
+    except ValueError:
+        return jsonify({"error": "Dates must be YYYY-MM-DD"}), 400
+    if end_date < start_date:
+        return jsonify({"error": "End date must be on or after start date"}), 400
+
+    overlaps = [batch.id for batch in overlapping_batches_query(start_date, end_date).with_entities(Batch.id)]
+
     new_batch = Batch(
         month=month,
         week=week,
         name=name,
-        start_date=datetime.strptime(start_date, "%Y-%m-%d"),
-        end_date=datetime.strptime(end_date, "%Y-%m-%d")
+        start_date=start_date,
+        end_date=end_date
     )
     db.session.add(new_batch)
     db.session.commit()
+    invalidate_batches()
 
-    return jsonify({"message": "Batch added successfully"})
+    return jsonify({"message": "Batch added successfully", "id": new_batch.id, "overlaps": overlaps})
 
 
 
 @app.route('/get_batches', methods=['GET'])
 def get_batches():
-    batches = Batch.query.order_by(Batch.created_at.desc()).all()
-    return jsonify([
-        {
-            "id": batch.id,
-            "month": batch.month,
-            "week": batch.week,
-            "name": batch.name,
-            "start_date": batch.start_date.strftime('%Y-%m-%d'),
-            "end_date": batch.end_date.strftime('%Y-%m-%d')
+    batches = batch_cache.get_or_set(
+        "all",
+        lambda: [batch_to_dict(batch) for batch in Batch.query.order_by(Batch.start_date.desc(), Batch.id.desc()).all()],
+    )
+    return jsonify(batches)
+
+
+@app.route('/batches/active', methods=['GET'])
+def get_active_batches():
+    """Batches running on ?date=YYYY-MM-DD (defaults to today)."""
+    try:
+        day = parse_day(request.args["date"]) if request.args.get("date") else datetime.utcnow().date()
+    except ValueError:
+        return jsonify({"error": "Date must be YYYY-MM-DD"}), 400
+
+    batches = batch_cache.get_or_set(
+        ("active", day),
+        lambda: [batch_to_dict(batch) for batch in overlapping_batches_query(day, day).order_by(Batch.start_date).all()],
+    )
+    return jsonify(batches)
+
+
+@app.route('/batches/overlapping', methods=['GET'])
+def get_overlapping_batches():
+    """Batches intersecting ?start=&end= (optionally ignoring ?exclude_id=)."""
+    try:
+        start, end = parse_day(request.args["start"]), parse_day(request.args["end"])
+    except (KeyError, ValueError):
+        return jsonify({"error": "start and end must be YYYY-MM-DD"}), 400
+
+    exclude_id = request.args.get("exclude_id", type=int)
+
+    def load():
+        query = overlapping_batches_query(start, end)
+        if exclude_id:
+            query = query.filter(Batch.id != exclude_id)
+        return [batch_to_dict(batch) for batch in query.order_by(Batch.start_date).all()]
+
+    return jsonify(batch_cache.get_or_set(("overlap", start, end, exclude_id), load))
+
+
+@app.route('/batches/calendar', methods=['GET'])
+def get_batch_calendar():
+    """Paginated calendar feed of batches within ?from=&to=, oldest first."""
+    try:
+        start = parse_day(request.args["from"]) if request.args.get("from") else datetime.utcnow().date()
+        end = parse_day(request.args["to"]) if request.args.get("to") else start + timedelta(days=90)
+    except ValueError:
+        return jsonify({"error": "Dates must be YYYY-MM-DD"}), 400
+
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = min(max(request.args.get("per_page", BATCH_CALENDAR_PER_PAGE, type=int), 1), 200)
+
+    def load():
+        query = overlapping_batches_query(start, end).order_by(Batch.start_date, Batch.id)
+        rows = query.offset((page - 1) * per_page).limit(per_page + 1).all()
+        return {
+            "batches": [batch_to_dict(batch) for batch in rows[:per_page]],
+            "page": page,
+            "has_more": len(rows) > per_page,
         }
-        for batch in batches
-    ])
+
+    return jsonify(batch_cache.get_or_set(("calendar", start, end, page, per_page), load))
 
 
 @app.route('/edit_batch/<int:batch_id>', methods=['PUT'])
@@ -1561,10 +4707,21 @@ def edit_batch(batch_id):
     batch.month = data.get("month", batch.month)
     batch.week = data.get("week", batch.week)
     batch.name = data.get("name", batch.name)
-    batch.start_date = datetime.strptime(data.get("start_date"), "%Y-%m-%d")
-    batch.end_date = datetime.strptime(data.get("end_date"), "%Y-%m-%d")
+    try:
+        if data.get("start_date"):
+            batch.start_date = parse_day(data["start_date"])
+        if data.get("end_date"):
+            batch.end_date = parse_day(data["end_date"])
+    except ValueError:
+        db.session.rollback()
+        return jsonify({"error": "Dates must be YYYY-MM-DD"}), 400
+
+    if batch.end_date < batch.start_date:
+        db.session.rollback()
+        return jsonify({"error": "End date must be on or after start date"}), 400
 
     db.session.commit()
+    invalidate_batches()
     return jsonify({"message": "Batch updated successfully"})
 
 
@@ -1579,52 +4736,478 @@ def delete_batch(batch_id):
 
     db.session.delete(batch)
     db.session.commit()
+    invalidate_batches()
     return jsonify({"message": "Batch deleted successfully"})
 
 
 
+# ✅ Historical Data Archiver
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_CHUNK = 1000  # Rows moved per transaction
 
-@app.route('/get_top_contributors', methods=['GET'])
-def get_top_contributors():
+
+def archive_rows(model, archive_model, date_column, cutoff):
+    """Move rows older than cutoff from model into archive_model in chunks."""
+    columns = [column.name for column in model.__table__.columns]
+    moved = 0
+
+    while True:
+        rows = model.query.filter(date_column < cutoff).order_by(model.id).limit(ARCHIVE_CHUNK).all()
+        if not rows:
+            break
+
+        db.session.bulk_insert_mappings(archive_model, [{name: getattr(row, name) for name in columns} for row in rows])
+        model.query.filter(model.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+        db.session.commit()
+        moved += len(rows)
+
+    return moved
+
+
+def prune_read_notifications(cutoff):
+    """Read notifications have no history value; delete them in chunks instead of archiving."""
+    pruned = 0
+    while True:
+        ids = [
+            row.id for row in
+            db.session.query(Notification.id)
+            .filter(Notification.is_read == True, Notification.created_at < cutoff)  # noqa: E712
+            .limit(ARCHIVE_CHUNK)
+        ]
+        if not ids:
+            return pruned
+        Notification.query.filter(Notification.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        pruned += len(ids)
+
+
+@tasks.task(max_attempts=3)
+def archive_history(days=None):
+    cutoff = datetime.utcnow() - timedelta(days=days or ARCHIVE_AFTER_DAYS)
+    logging.info(f"📦 Archiving ActivityLog and Message rows older than {cutoff}")
+
+    result = {
+        "activity_logs": archive_rows(ActivityLog, ActivityLogArchive, ActivityLog.date, cutoff),
+        "messages": archive_rows(Message, MessageArchive, Message.timestamp, cutoff),
+        "notifications_pruned": prune_read_notifications(cutoff),
+        "tasks_pruned": tasks.broker.prune(TASK_RESULT_TTL_DAYS),
+    }
+    logging.info(f"✅ Archive run finished: {result}")
+    return result
+
+
+@app.cli.command("archive-history")
+def archive_history_command():
+    """Move old ActivityLog/Message rows to the archive tables."""
+    print(archive_history())
+
+
+@app.route("/admin/archive_history", methods=["POST"])
+@require_admin
+def admin_archive_history():
+    days = (request.get_json(silent=True) or {}).get("days")
+    task_id = archive_history.delay(int(days) if days else None)
+    return jsonify({"message": "Archive run started", "task_id": task_id}), 202
+
+
+
+
+# ✅ Events & Enrollment
+MAX_EVENTS_PER_REQUEST = 100
+
+enrollment_cache = make_cache("enrollment", ttl=300, max_size=10000)
+
+
+def event_to_dict(event, enrolled_ids=frozenset()):
+    return {
+        "id": event.id,
+        "batch_id": event.batch_id,
+        "title": event.title,
+        "starts_at": event.starts_at.strftime("%Y-%m-%d %H:%M"),
+        "ends_at": event.ends_at.strftime("%Y-%m-%d %H:%M") if event.ends_at else None,
+        "link": event.link,
+        "price": event.price,
+        "capacity": event.capacity,
+        "seats_left": None if event.capacity is None else max(event.capacity - event.enrolled_count, 0),
+        "enrolled": event.id in enrolled_ids,
+    }
+
+
+def get_enrolled_event_ids(user_id):
+    """All of a user's enrolled event ids as one cached set (one query per cache miss)."""
+    return enrollment_cache.get_or_set(
+        user_id,
+        lambda: frozenset(event_id for (event_id,) in db.session.query(Enrollment.event_id).filter(Enrollment.user_id == user_id)),
+    )
+
+
+def parse_event_ids(data):
+    """Event ids from a JSON list or a comma-separated string, capped per request."""
+    raw = data.get("event_ids")
+    if raw is None and data.get("event_id") is not None:
+        raw = [data.get("event_id")]
+    if isinstance(raw, str):
+        raw = raw.split(",")
+    ids = list(dict.fromkeys(int(value) for value in raw or []))
+    if not ids or len(ids) > MAX_EVENTS_PER_REQUEST:
+        raise ValueError(f"Provide between 1 and {MAX_EVENTS_PER_REQUEST} event ids")
+    return ids
+
+
+def current_user_id():
+    if "email" not in session:
+        return None
+    return db.session.query(User.id).filter(User.email == session["email"]).scalar()
+
+
+def enroll_user(user_id, event):
+    """Take a seat with a conditional UPDATE so concurrent enrollments can't overfill an event."""
     try:
-        top_users = (
-            db.session.query(
-                User.id,
-                User.name,
-                User.picture,
-                db.func.count(Question.id).label("question_count"),
-                db.func.count(Answer.id).label("answer_count"),
-                (db.func.count(Question.id) + db.func.count(Answer.id)).label("total_contributions")
+        with db.session.begin_nested():
+            db.session.add(Enrollment(user_id=user_id, event_id=event.id))
+            db.session.flush()
+            seat_taken = (
+                db.session.query(Event)
+                .filter(Event.id == event.id)
+                .filter(or_(Event.capacity.is_(None), Event.enrolled_count < Event.capacity))
+                .update({"enrolled_count": Event.enrolled_count + 1}, synchronize_session=False)
             )
-            .outerjoin(Question, User.id == Question.user_id)
-            .outerjoin(Answer, User.id == Answer.user_id)
-            .group_by(User.id, User.name, User.picture)
-            .order_by(db.desc("total_contributions"))
-            .limit(5)  # Show top 5 contributors
-            .all()
+            if not seat_taken:
+                raise OverflowError
+    except IntegrityError:
+        return "already_enrolled"
+    except OverflowError:
+        return "full"
+    return "enrolled"
+
+
+def settle_event_payment(event_payment):
+    """Enroll the buyer once their event payment succeeds."""
+    event = Event.query.get(event_payment.event_id)
+    outcome = enroll_user(event_payment.user_id, event) if event else "not_found"
+    db.session.commit()
+    enrollment_cache.delete(event_payment.user_id)
+    if outcome in ("full", "not_found"):  # Paid but no seat: needs a refund
+        logging.warning(f"🚨 Paid for event {event_payment.event_id} but could not enroll ({outcome}) - TXN: {event_payment.txnid}")
+    return outcome
+
+
+def paid_event_ids(user_id, event_ids):
+    """The events among event_ids this user has a successful payment for."""
+    if not event_ids:
+        return set()
+    return {
+        event_id for (event_id,) in
+        db.session.query(EventPayment.event_id)
+        .join(Payment, Payment.txnid == EventPayment.txnid)
+        .filter(EventPayment.user_id == user_id, EventPayment.event_id.in_(event_ids))
+        .filter(Payment.payment_status == "Success")
+    }
+
+
+def release_enrollments(user_id, event_ids=None):
+    """Remove enrollments and give their seats back; returns the event ids released."""
+    query = db.session.query(Enrollment.event_id).filter(Enrollment.user_id == user_id)
+    if event_ids is not None:
+        query = query.filter(Enrollment.event_id.in_(event_ids))
+    released = [event_id for (event_id,) in query]
+    if not released:
+        return []
+
+    Enrollment.query.filter(Enrollment.user_id == user_id, Enrollment.event_id.in_(released)).delete(synchronize_session=False)
+    db.session.query(Event).filter(Event.id.in_(released)).update(
+        {"enrolled_count": Event.enrolled_count - 1}, synchronize_session=False
+    )
+    enrollment_cache.delete(user_id)
+    return released
+
+
+@app.route('/events', methods=['GET'])
+def list_events():
+    """Events starting within ?from=&to= (default: the next 90 days), with the caller's enrollment flags."""
+    try:
+        start = parse_day(request.args["from"]) if request.args.get("from") else datetime.utcnow().date()
+        end = parse_day(request.args["to"]) if request.args.get("to") else start + timedelta(days=90)
+    except ValueError:
+        return jsonify({"error": "Dates must be YYYY-MM-DD"}), 400
+
+    events = (
+        Event.query
+        .filter(Event.starts_at >= datetime.combine(start, datetime.min.time()))
+        .filter(Event.starts_at < datetime.combine(end + timedelta(days=1), datetime.min.time()))
+        .order_by(Event.starts_at)
+        .limit(500)
+        .all()
+    )
+    user_id = current_user_id()
+    enrolled_ids = get_enrolled_event_ids(user_id) if user_id else frozenset()
+    return jsonify({"events": [event_to_dict(event, enrolled_ids) for event in events]})
+
+
+@app.route('/events', methods=['POST'])
+@require_admin
+def create_event():
+    data = request.get_json(silent=True) or {}
+    if not data.get("title") or not data.get("starts_at"):
+        return jsonify({"error": "title and starts_at are required"}), 400
+
+    try:
+        event = Event(
+            batch_id=int(data["batch_id"]) if data.get("batch_id") else None,
+            title=data["title"].strip(),
+            starts_at=datetime.strptime(data["starts_at"], "%Y-%m-%d %H:%M"),
+            ends_at=datetime.strptime(data["ends_at"], "%Y-%m-%d %H:%M") if data.get("ends_at") else None,
+            link=data.get("link"),
+            price=float(data.get("price") or 0),
+            capacity=int(data["capacity"]) if data.get("capacity") else None,
         )
+    except (TypeError, ValueError):
+        return jsonify({"error": "Dates must be YYYY-MM-DD HH:MM; price/capacity must be numbers"}), 400
 
-        # Convert data to JSON format
-        return jsonify([
-            {
-                "name": user.name,
-                "picture": user.picture if user.picture else "/static/images/default-user.png",
-                "questions": user.question_count,
-                "answers": user.answer_count,
-                "points": user.total_contributions * 10  # Assign 10 points per contribution
-            }
-            for user in top_users
-        ])
+    if event.batch_id and not db.session.query(Batch.id).filter(Batch.id == event.batch_id).scalar():
+        return jsonify({"error": "Batch not found"}), 404
+
+    db.session.add(event)
+    db.session.commit()
+    return jsonify({"message": "Event created", "event": event_to_dict(event)}), 201
+
+
+@app.route('/check_enrollment', methods=['GET'])
+def check_enrollment():
+    """Enrollment status for ?event_id= or many ?event_ids=1,2,3, from the cached per-user set."""
+    user_id = current_user_id()
+    try:
+        event_ids = parse_event_ids(request.args)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    enrolled_ids = get_enrolled_event_ids(user_id) if user_id else frozenset()
+    if "event_ids" not in request.args:
+        return jsonify({"enrolled": event_ids[0] in enrolled_ids})
+    return jsonify({"enrolled": {str(event_id): event_id in enrolled_ids for event_id in event_ids}})
+
+
+@app.route('/enroll', methods=['POST'])
+@rate_limit("enroll")
+def enroll():
+    """Enroll in one or more events: {"event_ids": [...]}.
+
+    Paid events need a successful payment for that event; unpaid ones
+    come back under "requires_payment" so the client can send the user to
+    /pay?event_id=, whose callback enrolls them.
+    """
+    user_id = current_user_id()
+    if user_id is None:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        event_ids = parse_event_ids(request.get_json(silent=True) or {})
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    events = {event.id: event for event in Event.query.filter(Event.id.in_(event_ids))}
+    paid_ids = paid_event_ids(user_id, [event.id for event in events.values() if event.price])
+
+    results = defaultdict(list)
+    for event_id in event_ids:
+        event = events.get(event_id)
+        if event is None:
+            results["not_found"].append(event_id)
+        elif event.price and event_id not in paid_ids:
+            results["requires_payment"].append(event_id)
+        else:
+            results[enroll_user(user_id, event)].append(event_id)
+
+    db.session.commit()
+    enrollment_cache.delete(user_id)
+    return jsonify(results)
+
+
+@app.route('/unenroll', methods=['POST'])
+@rate_limit("enroll")
+def unenroll():
+    user_id = current_user_id()
+    if user_id is None:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        event_ids = parse_event_ids(request.get_json(silent=True) or {})
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    released = release_enrollments(user_id, event_ids)
+    db.session.commit()
+    return jsonify({"unenrolled": released})
+
+
+def load_top_contributors():
+    top_users = (
+        db.session.query(
+            User.id,
+            User.name,
+            User.picture,
+            UserCounter.forum_posts.label("question_count"),
+            UserCounter.qa_answers.label("answer_count"),
+            UserCounter.contributions.label("total_contributions")
+        )
+        .join(UserCounter, User.id == UserCounter.user_id)
+        .order_by(UserCounter.contributions.desc())
+        .limit(5)  # Show top 5 contributors
+        .all()
+    )
+    return [
+        {
+            "name": user.name,
+            "picture": user.picture if user.picture else "/static/images/default-user.png",
+            "questions": user.question_count,
+            "answers": user.answer_count,
+            "points": user.total_contributions * 10  # Assign 10 points per contribution
+        }
+        for user in top_users
+    ]
+
+
+# ✅ Leaderboard Snapshots (recomputed in the background, served from memory)
+LEADERBOARD_REFRESH_INTERVAL = 30  # Seconds between scheduled refreshes
+LEADERBOARD_DEBOUNCE = 1  # Seconds to wait after a write so its commit lands first
+
+
+class LeaderboardMaterializer:
+    """Keeps serialized leaderboards in memory and refreshes them off the request path.
 
+    A daemon thread recomputes every board on a fixed schedule, and shortly
+    after mark_dirty() when a counter changes. Requests only read the last
+    snapshot, whose content hash doubles as its version/ETag.
+    """
+
+    def __init__(self, boards, interval, debounce):
+        self.boards = boards  # name -> loader returning JSON-serializable data
+        self.interval = interval
+        self.debounce = debounce
+        self._snapshots = {}  # name -> (body, etag)
+        self._dirty = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def mark_dirty(self):
+        self._dirty.set()
+
+    def refresh(self):
+        snapshots = {}
+        for name, loader in self.boards.items():
+            body = dumps_json(loader())
+            snapshots[name] = (body, hashlib.sha1(body).hexdigest())
+        self._snapshots = snapshots  # Swap in one assignment; readers never see a partial set
+
+    def _run(self):
+        while True:
+            if self._dirty.wait(self.interval):
+                time.sleep(self.debounce)
+                self._dirty.clear()
+            with app.app_context():
+                try:
+                    self.refresh()
+                except Exception:
+                    logging.exception("❌ Leaderboard refresh failed")
+                finally:
+                    db.session.remove()
+
+    def snapshot(self, name):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self.refresh()  # First request in this process builds the initial snapshot
+                    self._thread = threading.Thread(target=self._run, name="leaderboards", daemon=True)
+                    self._thread.start()
+        return self._snapshots[name]
+
+    def response(self, name):
+        body, etag = self.snapshot(name)
+        response = app.response_class(body, mimetype="application/json")
+        response.set_etag(etag, weak=True)
+        response.headers["X-Leaderboard-Version"] = etag
+        response.cache_control.no_cache = True
+        response.make_conditional(request)
+        return compress_response(response)
+
+
+leaderboards = LeaderboardMaterializer(
+    {"top_contributors": load_top_contributors, "top_users": load_top_users},
+    interval=LEADERBOARD_REFRESH_INTERVAL,
+    debounce=LEADERBOARD_DEBOUNCE,
+)
+
+
+@app.route('/get_top_contributors', methods=['GET'])
+def get_top_contributors():
+    try:
+        return leaderboards.response("top_contributors")
     except Exception as e:
         app.logger.error(f"Error fetching top contributors: {str(e)}")
         return jsonify({"error": "Internal Server Error", "details": str(e)}), 500
 
+# ✅ User Directory (projection-only, paginated, cached)
+DIRECTORY_DEFAULT_LIMIT = 50
+DIRECTORY_MAX_LIMIT = 200
+DIRECTORY_SAMPLE_POOL = 500  # Pictures kept around for the random avatar wall
+
+user_directory_cache = make_cache("user_directory", ttl=300, max_size=256)
+
+
+def invalidate_user_directory():
+    """Drop cached directory pages; call whenever users are added/changed."""
+    user_directory_cache.clear()
+
+
+def _directory_query():
+    return (
+        db.session.query(User.id, User.picture)
+        .filter(User.is_active == True, User.picture.isnot(None))  # noqa: E712
+        .order_by(User.id)
+    )
+
+
+def load_directory_page(after_id, limit):
+    rows = _directory_query().filter(User.id > after_id).limit(limit).all()
+    return {
+        "pictures": [row.picture for row in rows],
+        "next_cursor": rows[-1].id if len(rows) == limit else None,
+    }
+
+
+def load_directory_sample_pool():
+    """Grab a contiguous run of users starting at a random id.
+
+    Seeking on the primary key keeps this a single index range scan no
+    matter how many users exist, unlike ORDER BY NEWID().
+    """
+    min_id, max_id = db.session.query(func.min(User.id), func.max(User.id)).one()
+    if min_id is None:
+        return []
+
+    start_id = random.randint(min_id, max_id)
+    rows = _directory_query().filter(User.id >= start_id).limit(DIRECTORY_SAMPLE_POOL).all()
+    if len(rows) < DIRECTORY_SAMPLE_POOL:  # Wrap around to the beginning
+        rows += _directory_query().filter(User.id < start_id).limit(DIRECTORY_SAMPLE_POOL - len(rows)).all()
+    return [row.picture for row in rows]
+
+
 @app.route('/get_all_users', methods=['GET'])
 def get_all_users():
-    users = User.query.filter_by(is_active=True).all()
-    profile_pictures = [user.picture for user in users if user.picture]
-    return jsonify({'pictures': profile_pictures})
+    """Return active users' profile pictures.
+
+    Query params: `limit` (max 200), `after` (cursor from `next_cursor`) and
+    `mode=sample` for a random selection used by the avatar wall.
+    """
+    limit = min(max(request.args.get('limit', DIRECTORY_DEFAULT_LIMIT, type=int), 1), DIRECTORY_MAX_LIMIT)
+
+    if request.args.get('mode') == 'sample':
+        pool = user_directory_cache.get_or_set("sample_pool", load_directory_sample_pool)
+        return jsonify({'pictures': random.sample(pool, min(limit, len(pool))), 'next_cursor': None})
+
+    after_id = request.args.get('after', 0, type=int)
+    page = user_directory_cache.get_or_set(("page", after_id, limit), lambda: load_directory_page(after_id, limit))
+    return jsonify(page)
 
 
 
@@ -1638,6 +5221,13 @@ def logout():
 
 
 
+# ✅ Start the task workers with the app, so queued, retried and left-over
+# tasks run without waiting for this process to enqueue something. Under the
+# `flask` CLI they still start on first enqueue; `flask run-tasks` starts its own.
+if not os.environ.get("FLASK_RUN_FROM_CLI"):
+    tasks.start()
+
+
 # Run the Flask app
 if __name__ == '__main__':
     logging.info("🚀 Starting Flask app...")
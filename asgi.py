@@ -0,0 +1,169 @@
+"""ASGI entrypoint.
+
+Usage: ASGI_THREADS=32 uvicorn asgi:application --workers 4
+
+Every Flask route keeps working unchanged through WsgiToAsgi, which runs it
+on asgiref's thread pool (sized by ASGI_THREADS). Routes listed in
+ASYNC_ROUTES are served natively on the event loop instead: their short
+session/DB steps run via sync_to_async inside a Flask request context, and
+the slow upstream call is awaited, so a request waiting on the model holds
+no thread. The WSGI deployment (`gunicorn app:app`) is unaffected.
+"""
+import json
+import logging
+import sys
+from io import BytesIO
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi
+
+from app import (
+    app, check_entitlement, check_rate_limit, dumps_json, generation_gateway, parse_generated_json, prepare_generation,
+    record_generation,
+)
+
+
+wsgi_application = WsgiToAsgi(app)
+
+
+def build_environ(scope, body):
+    """Minimal WSGI environ for pushing a Flask request context from an ASGI scope."""
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("ascii"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            environ[name] = value
+        else:
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return bytes(body)
+
+
+async def send_response(send, status, headers, body):
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_flask_response(send, response):
+    headers = [(name.encode("latin1"), value.encode("latin1")) for name, value in response.headers.items()]
+    await send_response(send, response.status_code, headers, response.get_data())
+
+
+async def send_json(send, status, data):
+    await send_response(send, status, [(b"content-type", b"application/json")], dumps_json(data))
+
+
+def prepare_generate_request(environ):
+    with app.request_context(environ):
+        response = check_rate_limit("generate") or check_entitlement(api=True)
+        if response is None:
+            response, job = prepare_generation()
+            if response is None:
+                return None, job
+        return app.make_response(response), None
+
+
+def record_generate_result(job, result):
+    with app.app_context():
+        return record_generation(job, result)
+
+
+async def generate_view(scope, receive, send):
+    """Async twin of app.generate (same body, responses and library/cache behaviour)."""
+    environ = build_environ(scope, await read_body(receive))
+    response, job = await sync_to_async(prepare_generate_request, thread_sensitive=False)(environ)
+    if response is not None:
+        await send_flask_response(send, response)
+        return
+
+    if not job["stream"]:
+        try:
+            result = parse_generated_json(await generation_gateway.generate_async(job["key"], job["prompt"]))
+        except Exception as e:
+            logging.error(f"❌ Generation failed: {str(e)}")
+            await send_json(send, 502, {"error": "Generation failed"})
+            return
+
+        payload = await sync_to_async(record_generate_result, thread_sensitive=False)(job, result)
+        await send_json(send, 200, payload)
+        return
+
+    async def event(data, more_body=True):
+        body = f"data: {json.dumps(data)}\n\n".encode("utf-8")
+        await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/event-stream; charset=utf-8"), (b"cache-control", b"no-cache")],
+    })
+    parts = []
+    try:
+        async for chunk in generation_gateway.stream_async(job["key"], job["prompt"]):
+            parts.append(chunk)
+            await event({"text": chunk})
+        result = parse_generated_json("".join(parts))
+    except Exception as e:
+        logging.error(f"❌ Generation failed: {str(e)}")
+        await event({"error": "Generation failed"}, more_body=False)
+        return
+
+    payload = await sync_to_async(record_generate_result, thread_sensitive=False)(job, result)
+    await event({"done": True, **payload}, more_body=False)
+
+
+# ✅ (method, path) -> native async view; everything else goes to Flask
+ASYNC_ROUTES = {
+    ("POST", "/generate"): generate_view,
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+
+    if scope["type"] == "http":
+        view = ASYNC_ROUTES.get((scope["method"], scope["path"]))
+        if view is not None:
+            await view(scope, receive, send)
+            return
+
+    await wsgi_application(scope, receive, send)
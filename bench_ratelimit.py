@@ -0,0 +1,110 @@
+"""Micro-benchmark for the rate limiter's per-request overhead.
+
+Runs in-process against app.py, so it needs the app's environment; point it
+at a throwaway database rather than the real one:
+       DATABASE_URL=sqlite:///bench.db python bench_ratelimit.py
+       DATABASE_URL=sqlite:///bench.db python bench_ratelimit.py --redis redis://127.0.0.1:6379/15
+
+Reports three numbers per store:
+  take        one token-bucket update (MemoryRateLimitStore / RedisRateLimitStore)
+  check       check_rate_limit() as a route sees it: IP and user bucket
+  request     a full test-client GET of a trivial route, with and without
+              @rate_limit, so the overhead can be read against a whole request
+Limits are set high enough that nothing is ever rejected.
+"""
+import argparse
+import contextvars
+import os
+import statistics
+import threading
+import time
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("TASK_WORKERS", "0")
+
+import app as levelup  # noqa: E402  (reads the environment above)
+
+BENCH_LIMIT = (1e9, 10 ** 9)  # Never runs out during a run
+
+
+def timed(func, iterations, threads=1):
+    """Mean microseconds per call of func(i), over `threads` concurrent callers."""
+    def worker(offset, out):
+        start = time.perf_counter()
+        for i in range(iterations):
+            func(offset + i)
+        out.append(time.perf_counter() - start)
+
+    elapsed = []
+    runners = [  # Each caller runs in a copy of this context, so a surrounding request context carries over
+        threading.Thread(target=contextvars.copy_context().run, args=(worker, n * iterations, elapsed))
+        for n in range(threads)
+    ]
+    for runner in runners:
+        runner.start()
+    for runner in runners:
+        runner.join()
+    return statistics.mean(elapsed) / iterations * 1e6
+
+
+def bench_store(store, args):
+    rate, burst = BENCH_LIMIT
+    return timed(lambda i: store.take(f"bench:user:{i % args.keys}", rate, burst), args.iterations, args.threads)
+
+
+def bench_check(args):
+    levelup.RATE_LIMITS["bench"] = BENCH_LIMIT
+    with levelup.app.test_request_context("/bench", environ_base={"REMOTE_ADDR": "10.0.0.1"}):
+        levelup.session["email"] = "bench@example.com"
+        return timed(lambda i: levelup.check_rate_limit("bench"), args.iterations)
+
+
+def bench_request(args):
+    levelup.RATE_LIMITS["bench"] = BENCH_LIMIT
+
+    @levelup.app.route("/_bench/plain")
+    def bench_plain():
+        return "ok"
+
+    @levelup.app.route("/_bench/limited")
+    @levelup.rate_limit("bench")
+    def bench_limited():
+        return "ok"
+
+    client = levelup.app.test_client()
+    with client.session_transaction() as sess:
+        sess["email"] = "bench@example.com"
+
+    results = {}
+    for path in ("/_bench/plain", "/_bench/limited", "/_bench/plain", "/_bench/limited"):  # Second pass is measured
+        results[path] = timed(lambda i: client.get(path), args.requests)
+    return results["/_bench/plain"], results["/_bench/limited"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=100000, help="Calls per take/check measurement")
+    parser.add_argument("--requests", type=int, default=5000, help="Test-client requests per route")
+    parser.add_argument("--keys", type=int, default=1000, help="Distinct bucket keys to cycle through")
+    parser.add_argument("--threads", type=int, default=1, help="Concurrent callers for the take measurement")
+    parser.add_argument("--redis", help="Also measure RedisRateLimitStore at this URL")
+    args = parser.parse_args()
+
+    stores = [("memory", levelup.MemoryRateLimitStore())]
+    if args.redis:
+        stores.append(("redis", levelup.RedisRateLimitStore(args.redis)))
+        args.iterations = min(args.iterations, 10000)  # One round trip per call
+
+    for name, store in stores:
+        levelup.rate_limit_store = store
+        print(f"▶ {name} store")
+        print(f"  take:     {bench_store(store, args):8.2f} µs/call ({args.threads} thread(s), {args.keys} keys)")
+        print(f"  check:    {bench_check(args):8.2f} µs/request")
+        if name == "memory":  # Routes can only be registered once per process
+            plain, limited = bench_request(args)
+            print(f"  request:  {plain:8.2f} µs plain, {limited:8.2f} µs with @rate_limit "
+                  f"(+{limited - plain:.2f} µs, {(limited - plain) / plain:+.1%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Build the fingerprinted static asset bundles.
+
+Compiles scss/style.scss, concatenates and minifies the CSS/JS bundles
+listed in BUNDLES, names each output after its content hash and writes
+precompressed .gz/.br copies next to it. app.py reads the resulting
+manifest through the asset_tags() template helper.
+
+Usage: python build_assets.py
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+try:
+    import sass  # libsass
+except ImportError:
+    sass = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Source files are looked up under static/ first (deployed layout), then
+# the repository root (css/, js/, scss/ as checked in).
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))  # Same tree app.root_path points at, whatever the cwd
+SOURCE_DIRS = [os.path.join(BASE_DIR, "static"), BASE_DIR]
+OUTPUT_DIR = os.path.join(BASE_DIR, "static", "dist")
+MANIFEST_PATH = os.path.join(OUTPUT_DIR, "manifest.json")
+
+# ✅ Bundle name -> source files, in load order (paths relative to /static)
+BUNDLES = {
+    "index.css": [
+        "css/bootstrap.min.css",
+        "css/jquery-ui.css",
+        "css/owl.carousel.min.css",
+        "css/owl.theme.default.min.css",
+        "css/jquery.fancybox.min.css",
+        "css/bootstrap-datepicker.css",
+        "css/aos.css",
+        "css/style.css",
+    ],
+    "index.js": [
+        "js/jquery-3.3.1.min.js",
+        "js/jquery-migrate-3.0.1.min.js",
+        "js/jquery-ui.js",
+        "js/popper.min.js",
+        "js/bootstrap.min.js",
+        "js/owl.carousel.min.js",
+        "js/jquery.stellar.min.js",
+        "js/jquery.countdown.min.js",
+        "js/bootstrap-datepicker.min.js",
+        "js/jquery.easing.1.3.js",
+        "js/aos.js",
+        "js/jquery.fancybox.min.js",
+        "js/jquery.sticky.js",
+        "js/main.js",
+    ],
+    "chatbot.css": [
+        "css/chatbot.css",
+    ],
+}
+
+CSS_URL_RE = re.compile(r"url\(\s*(['\"]?)([^'\")]+)\1\s*\)")
+
+
+def find_source(relative_path):
+    for base in SOURCE_DIRS:
+        path = os.path.join(base, relative_path)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"Asset not found in {SOURCE_DIRS}: {relative_path}")
+
+
+def compile_scss():
+    """Compile scss/style.scss into css/style.css (skipped without libsass)."""
+    if sass is None:
+        print("⚠️ libsass not installed, using the checked-in css/style.css")
+        return
+
+    source = find_source("scss/style.scss")
+    css = sass.compile(filename=source, output_style="expanded")
+    target = os.path.join(os.path.dirname(os.path.dirname(source)), "css", "style.css")
+    with open(target, "w", encoding="utf-8") as f:
+        f.write(css)
+    print(f"✅ Compiled {source} -> {target}")
+
+
+def rewrite_css_urls(css, relative_path):
+    """Make relative url() references absolute so they survive bundling."""
+    base = "/static/" + os.path.dirname(relative_path)
+
+    def replace(match):
+        quote, url = match.groups()
+        if url.startswith(("/", "data:", "http:", "https:", "#")):
+            return match.group(0)
+        return f"url({quote}{os.path.normpath(os.path.join(base, url))}{quote})"
+
+    return CSS_URL_RE.sub(replace, css)
+
+
+def minify_css(css):
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    return css.replace(";}", "}").strip()
+
+
+def minify_js(js):
+    if rjsmin is not None:
+        return rjsmin.jsmin(js)
+    return js  # Most bundled libraries already ship minified
+
+
+def build_bundle(name, sources):
+    parts = []
+    for relative_path in sources:
+        with open(find_source(relative_path), encoding="utf-8") as f:
+            content = f.read()
+        if name.endswith(".css"):
+            parts.append(minify_css(rewrite_css_urls(content, relative_path)))
+        else:
+            parts.append(minify_js(content))
+
+    # Guard against files that don't end with a semicolon / newline
+    data = ("\n" if name.endswith(".css") else ";\n").join(parts).encode("utf-8")
+
+    stem, ext = os.path.splitext(name)
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    filename = f"{stem}.{digest}{ext}"
+    path = os.path.join(OUTPUT_DIR, filename)
+
+    with open(path, "wb") as f:
+        f.write(data)
+    with open(path + ".gz", "wb") as f:
+        f.write(gzip.compress(data, compresslevel=9))
+    if brotli is not None:
+        with open(path + ".br", "wb") as f:
+            f.write(brotli.compress(data, quality=11))
+
+    print(f"✅ {name} -> {filename} ({len(data)} bytes from {len(sources)} files)")
+    return filename
+
+
+def main():
+    compile_scss()
+
+    shutil.rmtree(OUTPUT_DIR, ignore_errors=True)
+    os.makedirs(OUTPUT_DIR)
+
+    manifest = {name: build_bundle(name, sources) for name, sources in BUNDLES.items()}
+    with open(MANIFEST_PATH, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"✅ Manifest written to {MANIFEST_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""Concurrent-connection load test for comparing the WSGI and ASGI deployments.
+
+1. Start a stand-in model that answers slowly, like Gemini does:
+       python loadtest.py stub-model --port 9100 --delay 5
+2. Start the app against it, once per deployment:
+       GEMINI_API_URL=http://127.0.0.1:9100/ gunicorn -w 2 --threads 16 -b :8000 app:app
+       GEMINI_API_URL=http://127.0.0.1:9100/ uvicorn asgi:application --workers 2 --port 8000
+3. Fire requests (copy the session cookie from a logged-in browser):
+       python loadtest.py run http://127.0.0.1:8000/generate --cookie "session=..." \\
+           --concurrency 200 --requests 1000 \\
+           --body '{"type": "worksheet", "topic": "Load test {n}", "age_group": "8", "count": 5}'
+
+"{n}" in --body is replaced with the request number so every request misses
+the cache. Raise RATE_LIMIT_GENERATE for the run, or the limiter answers 429.
+
+Scale-out check: `scale` starts the server once per worker count, runs the
+same load against each and reports throughput relative to one worker.
+Point every worker at shared state (REDIS_URL, FILE_STORE_CONTAINER) so the
+run exercises the multi-node setup rather than per-process state:
+       REDIS_URL=redis://127.0.0.1:6379/0 python loadtest.py scale \
+           http://127.0.0.1:8000/get_top_users --method GET --cookie "session=..." \
+           --server "gunicorn -w {workers} -b 127.0.0.1:{port} app:app" --workers 1 2 4 8
+"""
+import argparse
+import asyncio
+import json
+import shlex
+import statistics
+import subprocess
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+
+async def load(args):
+    latencies, statuses, in_flight, peak = [], {}, 0, 0
+    counter = iter(range(args.requests))
+    headers = {"Content-Type": "application/json"}
+    if args.cookie:
+        headers["Cookie"] = args.cookie
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(headers=headers, limits=limits, timeout=args.timeout) as client:
+
+        async def worker():
+            nonlocal in_flight, peak
+            for n in counter:
+                body = args.body.replace("{n}", str(n)) if args.body else None
+                start = time.perf_counter()
+                in_flight += 1
+                peak = max(peak, in_flight)
+                try:
+                    response = await client.request(args.method, args.url, content=body)
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                finally:
+                    in_flight -= 1
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {"latencies": latencies, "statuses": statuses, "elapsed": elapsed, "peak": peak, "throughput": len(latencies) / elapsed}
+
+
+def report(args, stats):
+    latencies = stats["latencies"]
+
+    def percentile(p):
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+
+    print(f"Requests:     {len(latencies)} in {stats['elapsed']:.1f}s ({stats['throughput']:.1f} req/s)")
+    print(f"Concurrency:  {args.concurrency} clients, {stats['peak']} in flight at peak")
+    print(f"Statuses:     {stats['statuses']}")
+    print(
+        f"Latency (s):  mean {statistics.mean(latencies):.2f}  p50 {percentile(0.5):.2f}  "
+        f"p95 {percentile(0.95):.2f}  p99 {percentile(0.99):.2f}  max {latencies[-1]:.2f}"
+    )
+
+
+async def run(args):
+    report(args, await load(args))
+
+
+async def wait_for_port(host, port, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Server did not start listening on {host}:{port} within {timeout}s")
+            await asyncio.sleep(0.2)
+
+
+async def scale(args):
+    """Run the same load against 1..N server workers and compare throughput."""
+    target = urlsplit(args.url)
+    host, port = target.hostname, target.port or 80
+    results = []
+
+    for workers in args.workers:
+        command = shlex.split(args.server.format(workers=workers, port=port))
+        print(f"▶ {workers} worker(s): {' '.join(command)}")
+        server = subprocess.Popen(command)
+        try:
+            await wait_for_port(host, port, args.startup_timeout)
+            if args.warmup:
+                await load(argparse.Namespace(**{**vars(args), "requests": args.warmup}))
+            stats = await load(args)
+        finally:
+            server.terminate()
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+        report(args, stats)
+        results.append((workers, stats))
+
+    base_workers, base = results[0]
+    print(f"\n{'workers':>8} {'req/s':>10} {'speedup':>8} {'efficiency':>11} {'p95 (s)':>8}")
+    for workers, stats in results:
+        speedup = stats["throughput"] / base["throughput"]
+        latencies = stats["latencies"]
+        p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+        efficiency = speedup / (workers / base_workers)
+        print(f"{workers:>8} {stats['throughput']:>10.1f} {speedup:>7.2f}x {efficiency:>10.0%} {p95:>8.2f}")
+
+
+async def stub_model(args):
+    """Answer every POST like Gemini's streamGenerateContent?alt=sse, after a delay."""
+    reply = json.dumps({"data": ["What is 2 + 2?", "Name a prime number.", "What is half of 10?"]})
+
+    async def handle(reader, writer):
+        try:
+            request_head = await reader.readuntil(b"\r\n\r\n")
+            length = next(
+                (int(line.split(b":", 1)[1]) for line in request_head.split(b"\r\n") if line.lower().startswith(b"content-length:")),
+                0,
+            )
+            await reader.readexactly(length)
+            await asyncio.sleep(args.delay)
+
+            event = {"candidates": [{"content": {"parts": [{"text": reply}]}}]}
+            body = f"data: {json.dumps(event)}\r\n\r\n".encode("utf-8")
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii")
+                + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", args.port, backlog=4096)
+    print(f"Stub model listening on http://127.0.0.1:{args.port}/ ({args.delay}s per reply)")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Send concurrent requests and report throughput/latency")
+    scale_parser = commands.add_parser("scale", help="Repeat the run against 1..N server workers and compare")
+    for load_parser in (run_parser, scale_parser):
+        load_parser.add_argument("url")
+        load_parser.add_argument("--method", default="POST")
+        load_parser.add_argument("--body", help='Request body; "{n}" becomes the request number')
+        load_parser.add_argument("--cookie", help="Cookie header for an authenticated session")
+        load_parser.add_argument("--concurrency", type=int, default=100)
+        load_parser.add_argument("--requests", type=int, default=500)
+        load_parser.add_argument("--timeout", type=float, default=180)
+
+    scale_parser.add_argument("--server", required=True, help='Server command; "{workers}" and "{port}" are filled in')
+    scale_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    scale_parser.add_argument("--warmup", type=int, default=50, help="Requests sent before measuring")
+    scale_parser.add_argument("--startup-timeout", type=float, default=60)
+
+    stub_parser = commands.add_parser("stub-model", help="Run a slow stand-in for the Gemini endpoint")
+    stub_parser.add_argument("--port", type=int, default=9100)
+    stub_parser.add_argument("--delay", type=float, default=5)
+
+    args = parser.parse_args()
+    asyncio.run({"run": run, "scale": scale, "stub-model": stub_model}[args.command](args))
+
+
+if __name__ == "__main__":
+    main()
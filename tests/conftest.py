@@ -0,0 +1,63 @@
+"""Shared fixtures: import app.py against a throwaway SQLite database.
+
+Run with `python -m pytest` from the repository root. The environment is
+set up before app.py is imported, so no MSSQL, Azure or PayU account is
+needed; task workers are disabled and queued tasks just sit in SQLite.
+"""
+import os
+import tempfile
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+TEST_DIR = tempfile.mkdtemp(prefix="levelup-tests-")
+
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{os.path.join(TEST_DIR, 'app.db')}",
+    "PAYU_MERCHANT_KEY": "test-key",
+    "PAYU_MERCHANT_SALT": "test-salt",
+    "PAYU_VERIFY_URL": "local",
+    "AZURE_STORAGE_CONNECTION_STRING": (
+        "DefaultEndpointsProtocol=https;AccountName=test;AccountKey=dGVzdA==;EndpointSuffix=core.windows.net"
+    ),
+    "FLASK_SECRET_KEY": "test-secret",
+    "GOOGLE_CLIENT_ID": "test-client-id",
+    "TASK_WORKERS": "0",
+    "TASK_DB_PATH": os.path.join(TEST_DIR, "tasks.sqlite3"),
+    "FILE_STORE_DIR": os.path.join(TEST_DIR, "files"),
+    "LOG_FILE": "-",
+    "LOG_LEVEL": "WARNING",
+})
+for name in ("REDIS_URL", "SESSION_REDIS_URL", "CACHE_REDIS_URL", "TASK_REDIS_URL", "RATE_LIMIT_REDIS_URL", "FILE_STORE_CONTAINER"):
+    os.environ.pop(name, None)
+
+
+@event.listens_for(Engine, "connect")
+def enforce_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite ignores FOREIGN KEY constraints unless asked; MSSQL always enforces them."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+import app as app_module  # noqa: E402  (needs the environment above)
+
+
+@pytest.fixture
+def levelup():
+    """The app module with empty tables and caches."""
+    with app_module.app.app_context():
+        app_module.db.drop_all()
+        app_module.db.create_all()
+        app_module.entitlement_cache.clear()
+        app_module.enrollment_cache.clear()
+        app_module._deleted_user_id = None  # Its row went with drop_all
+        yield app_module
+        app_module.db.session.remove()
+
+
+@pytest.fixture
+def client(levelup):
+    levelup.app.config["TESTING"] = True
+    return levelup.app.test_client()
@@ -0,0 +1,95 @@
+import pytest
+
+
+@pytest.fixture
+def users(levelup):
+    """The user being deleted and another user; returns (leaving_id, staying_id)."""
+    leaving = levelup.User(google_id="g-1", email="leaving@example.com", name="Leaving")
+    staying = levelup.User(google_id="g-2", email="staying@example.com", name="Staying")
+    levelup.db.session.add_all([leaving, staying])
+    levelup.db.session.commit()
+    return leaving.id, staying.id
+
+
+def delete_user(levelup, user_id):
+    job = levelup.AccountDeletionJob(user_id=user_id)
+    levelup.db.session.add(job)
+    levelup.db.session.commit()
+    levelup.run_account_deletion(job.id)
+
+    levelup.db.session.expire_all()
+    job = levelup.db.session.get(levelup.AccountDeletionJob, job.id)
+    assert (job.status, job.error) == ("Completed", None)
+    assert levelup.db.session.get(levelup.User, user_id) is None
+
+
+def test_deletes_a_user_with_posts(levelup, users):
+    leaving_id, _ = users
+    levelup.db.session.add(levelup.Question(user_id=leaving_id, question_text="Why?"))
+    levelup.bump_counters(leaving_id, forum_posts=1)
+    levelup.db.session.commit()
+
+    delete_user(levelup, leaving_id)
+
+    question = levelup.Question.query.one()
+    assert question.user_id == levelup.get_deleted_user_id()
+
+
+def test_deletes_a_user_with_library_downloads(levelup, users):
+    leaving_id, staying_id = users
+    resource = levelup.save_resource(staying_id, "worksheet", "Fractions", "8", 5, {"data": ["1/2 + 1/4?"]})
+    levelup.count_resource_download(leaving_id, resource.id)
+
+    delete_user(levelup, leaving_id)
+
+    assert levelup.ResourceDownload.query.count() == 0
+    assert levelup.db.session.get(levelup.Resource, resource.id).download_count == 1  # Popularity is kept
+
+
+def test_deletes_a_user_with_event_payments(levelup, users):
+    leaving_id, _ = users
+    event = levelup.Event(title="Robotics Workshop", starts_at=levelup.datetime.utcnow(), price=250)
+    levelup.db.session.add(event)
+    levelup.db.session.commit()
+    levelup.db.session.add_all([
+        levelup.Payment(email="leaving@example.com", name="Leaving", plan_name="Event: Robotics Workshop", amount=250, txnid="TXN-EV"),
+        levelup.EventPayment(txnid="TXN-EV", user_id=leaving_id, event_id=event.id),
+    ])
+    levelup.db.session.commit()
+    levelup.transition_payment("TXN-EV", "Success")
+
+    delete_user(levelup, leaving_id)
+
+    payment = levelup.EventPayment.query.one()  # The payment record is kept, not deleted
+    assert (payment.txnid, payment.user_id) == ("TXN-EV", levelup.get_deleted_user_id())
+    assert levelup.db.session.get(levelup.Event, event.id).enrolled_count == 0
+
+
+def request_deletion(client, email):
+    with client.session_transaction() as sess:
+        sess["email"] = email
+    response = client.post("/delete_account")
+    assert response.status_code == 202
+    return response.get_json()
+
+
+def test_deletion_status_needs_the_signed_token(levelup, client, users):
+    started = request_deletion(client, "leaving@example.com")
+
+    response = client.get(started["status_url"])
+    assert response.status_code == 200
+    assert response.get_json()["status"] == "Pending"
+
+    # Sequential ids and forged tokens don't reveal anyone's job
+    assert client.get(f"/account_deletion_status/{started['job_id']}").status_code == 404
+    assert client.get(f"/account_deletion_status/{started['status_token']}x").status_code == 404
+    forged = levelup.URLSafeSerializer("not-the-app-key", salt="account-deletion-status").dumps(started["job_id"])
+    assert client.get(f"/account_deletion_status/{forged}").status_code == 404
+
+
+def test_admins_can_check_deletion_status_by_id(levelup, client, users):
+    started = request_deletion(client, "leaving@example.com")
+    with client.session_transaction() as sess:
+        sess["is_admin"] = True
+
+    assert client.get(f"/account_deletion_status/{started['job_id']}").get_json()["job_id"] == started["job_id"]
@@ -0,0 +1,33 @@
+import pytest
+
+
+@pytest.fixture
+def admin(levelup, client):
+    for n in (1, 2):
+        levelup.db.session.add(levelup.User(google_id=f"g-{n}", email=f"user{n}@example.com", name=f"User {n}"))
+    levelup.db.session.commit()
+    with client.session_transaction() as sess:
+        sess["is_admin"] = True
+
+
+@pytest.mark.parametrize("user_ids", [["abc"], [None], [[1]], "12"])
+def test_bulk_update_rejects_junk_ids(client, admin, user_ids):
+    response = client.post("/admin/api/users/bulk", json={"action": "deactivate", "user_ids": user_ids})
+    assert response.status_code == 400
+
+
+def test_export_rejects_junk_ids(client, admin):
+    assert client.get("/admin/api/users/export?user_id=abc").status_code == 400
+    assert client.post("/admin/api/users/export", json={"user_ids": [{"id": 1}]}).status_code == 400
+
+
+def test_bulk_update_and_export_by_id(levelup, client, admin):
+    response = client.post("/admin/api/users/bulk", json={"action": "deactivate", "user_ids": ["1"]})
+    assert response.get_json()["updated"] == 1
+
+    export = client.get("/admin/api/users/export?user_id=2").get_data(as_text=True)
+    assert "user2@example.com" in export and "user1@example.com" not in export
+
+
+def test_dashboard_rejects_junk_paging(client, admin):
+    assert client.get("/admin_dashboard?page=abc").status_code == 400
@@ -0,0 +1,59 @@
+import pytest
+
+BODY = {"type": "worksheet", "topic": "Fractions", "age_group": "8", "count": 5}
+
+
+@pytest.fixture
+def member(levelup, client):
+    """A logged-in user without a plan, whose worksheet is already in the library."""
+    user = levelup.User(google_id="g-1", email="asha@example.com", name="Asha")
+    levelup.db.session.add(user)
+    levelup.db.session.commit()
+    levelup.save_resource(user.id, "worksheet", "Fractions", "8", 5, {"data": ["1/2 + 1/4?"]})
+    with client.session_transaction() as sess:
+        sess["email"] = "asha@example.com"
+    return user
+
+
+def subscribe(levelup):
+    levelup.db.session.add(levelup.Payment(email="asha@example.com", name="Asha", plan_name="Pro", amount=499, txnid="TXN-PLAN"))
+    levelup.db.session.commit()
+    levelup.transition_payment("TXN-PLAN", "Success")
+
+
+def test_generate_needs_a_login(levelup, client):
+    assert client.post("/generate", json=BODY).status_code == 401
+
+
+def test_generate_needs_an_active_plan(levelup, client, member):
+    response = client.post("/generate", json=BODY)
+    assert response.status_code == 402
+    assert response.get_json() == {"error": "An active subscription is required"}
+
+    subscribe(levelup)
+    response = client.post("/generate", json=BODY)
+    assert response.status_code == 200
+    assert response.get_json()["data"] == {"data": ["1/2 + 1/4?"]}
+
+
+def test_chatbot_after_subscribe_redirects_unpaid_users(levelup, client, member):
+    with client.session_transaction() as sess:
+        sess["next_url"] = "pay"
+    response = client.get("/chatbot")
+    assert response.status_code == 302 and response.headers["Location"] == "/"
+
+    subscribe(levelup)
+    with client.session_transaction() as sess:
+        sess["next_url"] = "pay"
+    assert client.get("/chatbot").status_code == 200
+
+
+def test_async_generate_is_gated_too(levelup, client, member):
+    asgi = pytest.importorskip("asgi")
+    from werkzeug.test import EnvironBuilder
+
+    cookie = client.get_cookie(levelup.app.config.get("SESSION_COOKIE_NAME", "session"))
+    environ = EnvironBuilder(path="/generate", method="POST", json=BODY, headers={"Cookie": f"{cookie.key}={cookie.value}"}).get_environ()
+
+    response, job = asgi.prepare_generate_request(environ)
+    assert job is None and response.status_code == 402
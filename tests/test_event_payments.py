@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from test_payu_callbacks import signed_callback
+
+EMAIL = "asha@example.com"
+
+
+@pytest.fixture
+def buyer(levelup, client):
+    """A logged-in user and a paid event with seats left; returns (user_id, event_id)."""
+    user = levelup.User(google_id="g-1", email=EMAIL, name="Asha")
+    event = levelup.Event(title="Robotics Workshop", starts_at=datetime.utcnow() + timedelta(days=3), price=250, capacity=10)
+    levelup.db.session.add_all([user, event])
+    levelup.db.session.commit()
+    with client.session_transaction() as sess:
+        sess["email"], sess["name"] = EMAIL, "Asha"
+    return user.id, event.id
+
+
+def start_checkout(levelup, client, event_id):
+    assert client.get(f"/pay?event_id={event_id}&amount=1.00").status_code == 200
+    return levelup.EventPayment.query.filter_by(event_id=event_id).one().txnid
+
+
+def enrolled(levelup, user_id, event_id):
+    levelup.db.session.expire_all()
+    return levelup.Enrollment.query.filter_by(user_id=user_id, event_id=event_id).count() == 1
+
+
+def test_paid_event_requires_payment(levelup, client, buyer):
+    _, event_id = buyer
+    assert client.post("/enroll", json={"event_ids": [event_id]}).get_json() == {"requires_payment": [event_id]}
+
+
+def test_checkout_charges_the_event_price(levelup, client, buyer):
+    _, event_id = buyer
+    txnid = start_checkout(levelup, client, event_id)
+
+    payment = levelup.Payment.query.filter_by(txnid=txnid).one()
+    assert payment.amount == 250 and payment.plan_name == "Event: Robotics Workshop"
+
+
+def test_success_callback_enrolls_without_granting_a_plan(levelup, client, buyer):
+    user_id, event_id = buyer
+    txnid = start_checkout(levelup, client, event_id)
+
+    assert client.post("/success", data=signed_callback(txnid, "success", amount="250.00")).status_code == 200
+    assert enrolled(levelup, user_id, event_id)
+    assert levelup.db.session.get(levelup.Event, event_id).enrolled_count == 1
+    assert not levelup.has_paid(EMAIL)
+
+    # Re-enrolling after the payment is a no-op, and checkout is closed
+    assert client.post("/enroll", json={"event_ids": [event_id]}).get_json() == {"already_enrolled": [event_id]}
+    assert client.get(f"/pay?event_id={event_id}").status_code == 409
+
+
+def test_reconciled_event_payment_enrolls(levelup, client, buyer, monkeypatch):
+    user_id, event_id = buyer
+    txnid = start_checkout(levelup, client, event_id)
+    levelup.Payment.query.filter_by(txnid=txnid).one().created_at = datetime.utcnow() - timedelta(hours=1)
+    levelup.db.session.commit()
+
+    verifier = levelup.LocalPaymentVerifier()
+    verifier.statuses = {txnid: {"status": "success", "amt": "250.00"}}
+    monkeypatch.setattr(levelup, "payment_verifier", verifier)
+    levelup.reconcile_payments()
+
+    assert enrolled(levelup, user_id, event_id)
+    assert not levelup.has_paid(EMAIL)
+
+
+def test_paid_user_can_re_enroll_after_unenrolling(levelup, client, buyer):
+    user_id, event_id = buyer
+    txnid = start_checkout(levelup, client, event_id)
+    levelup.transition_payment(txnid, "Success")
+
+    client.post("/unenroll", json={"event_ids": [event_id]})
+    assert not enrolled(levelup, user_id, event_id)
+    assert client.post("/enroll", json={"event_ids": [event_id]}).get_json() == {"enrolled": [event_id]}
+
+
+def test_subscription_does_not_unlock_paid_events(levelup, client, buyer):
+    _, event_id = buyer
+    levelup.db.session.add(levelup.Payment(email=EMAIL, name="Asha", plan_name="Pro", amount=499, txnid="TXN-PLAN"))
+    levelup.db.session.commit()
+    levelup.transition_payment("TXN-PLAN", "Success")
+
+    assert levelup.has_paid(EMAIL)
+    assert client.post("/enroll", json={"event_ids": [event_id]}).get_json() == {"requires_payment": [event_id]}
+
+
+def test_checkout_rejects_free_and_unknown_events(levelup, client, buyer):
+    free = levelup.Event(title="Open House", starts_at=datetime.utcnow() + timedelta(days=1))
+    levelup.db.session.add(free)
+    levelup.db.session.commit()
+
+    assert client.get(f"/pay?event_id={free.id}").status_code == 404
+    assert client.get("/pay?event_id=9999").status_code == 404
+    assert client.get("/pay?event_id=abc").status_code == 404
@@ -0,0 +1,20 @@
+import pytest
+
+
+@pytest.fixture
+def expert(levelup, client, monkeypatch):
+    monkeypatch.setattr(levelup, "EXPERT_EMAILS", {"expert@example.com"})
+    with client.session_transaction() as sess:
+        sess["email"] = "expert@example.com"
+
+
+@pytest.mark.parametrize("limit", ["abc", None, [1, 2], {"n": 1}])
+def test_claim_rejects_a_junk_limit(client, expert, limit):
+    response = client.post("/expert/inbox/claim", json={"limit": limit})
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "limit must be a number"}
+
+
+def test_claim_with_an_empty_inbox(client, expert):
+    for body in ({}, {"limit": "3"}, {"limit": 500}):
+        assert client.post("/expert/inbox/claim", json=body).get_json() == {"claimed": []}
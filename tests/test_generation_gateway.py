@@ -0,0 +1,132 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from conftest import app_module
+
+REPLY = ['[{"question": ', '"2 + 2?", ', '"answer": "4"}]']
+
+
+@pytest.fixture
+def model():
+    """Local stand-in for the Gemini SSE endpoint.
+
+    Sends the first chunk straight away and the rest once `state["release"]`
+    is set, so tests can hold the leader mid-stream.
+    """
+    state = {"calls": 0, "reply": REPLY, "release": threading.Event()}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Chunked, like Gemini, so each event arrives on its own
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            state["calls"] += 1
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for i, text in enumerate(state["reply"]):
+                if i == 1:
+                    state["release"].wait(5)
+                event = {"candidates": [{"content": {"parts": [{"text": text}]}}]}
+                data = f"data: {json.dumps(event)}\n\n".encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.write(b"0\r\n\r\n")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state["gateway"] = app_module.GenerationGateway(
+        f"http://127.0.0.1:{server.server_port}/generate", "test-key", app_module.TTLCache(ttl=60)
+    )
+    yield state
+    state["release"].set()
+    server.shutdown()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_concurrent_requests_share_one_model_call(model):
+    gateway = model["gateway"]
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(gateway.generate("k", "prompt"))) for _ in range(4)]
+
+    threads[0].start()
+    wait_for(lambda: model["calls"] == 1)
+    for thread in threads[1:]:
+        thread.start()
+    model["release"].set()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == ["".join(REPLY)] * 4
+    assert model["calls"] == 1
+    assert not gateway._inflight
+
+
+def test_repeat_request_is_served_from_cache(model):
+    model["release"].set()
+    gateway = model["gateway"]
+
+    assert gateway.generate("k", "prompt") == "".join(REPLY)
+    assert gateway.generate("k", "prompt") == "".join(REPLY)
+    assert model["calls"] == 1
+
+
+def test_unparseable_reply_is_not_cached(model):
+    model["release"].set()
+    model["reply"] = ["Sorry, ", "I can't help with that."]
+    gateway = model["gateway"]
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            gateway.generate("k", "prompt")
+    assert gateway.cache.get("k") is None
+    assert model["calls"] == 2
+
+
+def test_follower_gets_reply_after_leader_disconnects(model):
+    gateway = model["gateway"]
+    leader = gateway.stream("k", "prompt")
+    assert next(leader) == REPLY[0]
+
+    results = []
+    follower = threading.Thread(target=lambda: results.append(gateway.generate("k", "prompt")))
+    follower.start()
+    model["release"].set()
+    leader.close()  # The client went away mid-stream
+    follower.join(5)
+
+    assert results == ["".join(REPLY)]
+    assert gateway.cache.get("k") == "".join(REPLY)
+    assert model["calls"] == 1
+
+
+def test_async_requests_share_one_model_call(model):
+    pytest.importorskip("httpx")
+    gateway = model["gateway"]
+
+    async def run():
+        leader = asyncio.create_task(gateway.generate_async("k", "prompt"))
+        while model["calls"] == 0:
+            await asyncio.sleep(0.01)
+        followers = [asyncio.create_task(gateway.generate_async("k", "prompt")) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        model["release"].set()
+        return await asyncio.gather(leader, *followers)
+
+    assert asyncio.run(run()) == ["".join(REPLY)] * 4
+    assert model["calls"] == 1
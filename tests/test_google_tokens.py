@@ -0,0 +1,123 @@
+import datetime
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from conftest import app_module
+
+pytest.importorskip("cryptography")
+from cryptography import x509  # noqa: E402
+from cryptography.hazmat.primitives import hashes, serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import rsa  # noqa: E402
+from cryptography.x509.oid import NameOID  # noqa: E402
+from google.auth import crypt, jwt  # noqa: E402
+
+AUDIENCE = "test-client-id"
+ISSUER = "https://accounts.google.com"
+
+
+def make_key(kid):
+    """An RSA signer plus the PEM cert Google would publish for it."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "test-signer")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name).public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    private_pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    )
+    signer = crypt.RSASigner.from_string(private_pem, key_id=kid)
+    return signer, cert.public_bytes(serialization.Encoding.PEM).decode("ascii")
+
+
+@pytest.fixture
+def certs_server():
+    """Local stand-in for Google's cert endpoint; tests swap `state["certs"]` to rotate keys."""
+    state = {"certs": {}, "fetches": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            state["fetches"] += 1
+            body = json.dumps(state["certs"]).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Cache-Control", "public, max-age=3600")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    state["url"] = f"http://127.0.0.1:{server.server_port}/certs"
+    yield state
+    server.shutdown()
+
+
+@pytest.fixture
+def signer(certs_server):
+    signer, cert = make_key("key-1")
+    certs_server["certs"] = {"key-1": cert}
+    return signer
+
+
+def make_verifier(certs_server):
+    return app_module.GoogleTokenVerifier(AUDIENCE, certs_url=certs_server["url"], issuers={ISSUER, "accounts.google.com"})
+
+
+def token(signer, **overrides):
+    now = int(time.time())
+    claims = {"iss": ISSUER, "aud": AUDIENCE, "sub": "123", "email": "asha@example.com", "iat": now, "exp": now + 600}
+    claims.update(overrides)
+    return jwt.encode(signer, claims).decode("ascii")
+
+
+def test_valid_token_is_accepted_and_certs_are_cached(certs_server, signer):
+    verifier = make_verifier(certs_server)
+
+    assert verifier.verify(token(signer))["email"] == "asha@example.com"
+    assert verifier.verify(token(signer, sub="456"))["sub"] == "456"
+    assert certs_server["fetches"] == 1
+
+
+def test_wrong_issuer_is_rejected(certs_server, signer):
+    with pytest.raises(ValueError, match="issuer"):
+        make_verifier(certs_server).verify(token(signer, iss="https://issuer.example"))
+
+
+def test_wrong_audience_is_rejected(certs_server, signer):
+    with pytest.raises(ValueError):
+        make_verifier(certs_server).verify(token(signer, aud="someone-elses-client"))
+
+
+def test_expired_token_is_rejected(certs_server, signer):
+    past = int(time.time()) - 3600
+    with pytest.raises(ValueError):
+        make_verifier(certs_server).verify(token(signer, iat=past - 600, exp=past))
+
+
+def test_token_from_unknown_signer_is_rejected(certs_server, signer):
+    stranger, _ = make_key("key-1")  # Same key id, different key
+    with pytest.raises(ValueError):
+        make_verifier(certs_server).verify(token(stranger))
+
+
+def test_rotated_key_triggers_one_refetch(certs_server, signer):
+    verifier = make_verifier(certs_server)
+    verifier.verify(token(signer))
+
+    rotated, cert = make_key("key-2")
+    certs_server["certs"] = {"key-2": cert}
+    assert verifier.verify(token(rotated))["sub"] == "123"
+    assert certs_server["fetches"] == 2
@@ -0,0 +1,118 @@
+import hashlib
+
+from conftest import app_module
+
+KEY = app_module.MERCHANT_KEY
+SALT = app_module.MERCHANT_SALT
+
+
+def signed_callback(txnid, status, amount="499.00", **extra):
+    """A PayU surl/furl POST body carrying a valid reverse hash."""
+    form = {
+        "txnid": txnid, "status": status, "amount": amount, "productinfo": "Pro",
+        "firstname": "Asha", "email": "asha@example.com", "key": KEY, **extra,
+    }
+    sequence = (
+        f"{SALT}|{status}||||||{form.get('udf5', '')}|{form.get('udf4', '')}|{form.get('udf3', '')}|"
+        f"{form.get('udf2', '')}|{form.get('udf1', '')}|{form['email']}|{form['firstname']}|"
+        f"{form['productinfo']}|{amount}|{txnid}|{KEY}"
+    )
+    if form.get("additionalCharges"):
+        sequence = f"{form['additionalCharges']}|{sequence}"
+    form["hash"] = hashlib.sha512(sequence.encode("utf-8")).hexdigest()
+    return form
+
+
+def add_pending_payment(levelup, txnid, amount=499.0):
+    payment = levelup.Payment(email="asha@example.com", name="Asha", plan_name="Pro", amount=amount, txnid=txnid)
+    levelup.db.session.add(payment)
+    levelup.db.session.commit()
+    return payment
+
+
+def payment_status(levelup, txnid):
+    levelup.db.session.expire_all()
+    return levelup.Payment.query.filter_by(txnid=txnid).one().payment_status
+
+
+def test_reverse_hash_accepts_signed_response():
+    assert app_module.verify_payu_response_hash(signed_callback("TXN1", "success"))
+
+
+def test_reverse_hash_includes_additional_charges():
+    assert app_module.verify_payu_response_hash(signed_callback("TXN1", "success", additionalCharges="10.00"))
+
+
+def test_reverse_hash_rejects_tampered_fields():
+    form = signed_callback("TXN1", "success")
+    assert not app_module.verify_payu_response_hash({**form, "amount": "1.00"})
+    assert not app_module.verify_payu_response_hash({**form, "status": "failure"})
+    assert not app_module.verify_payu_response_hash({**form, "hash": "0" * 128})
+
+
+def test_transition_applies_once(levelup):
+    add_pending_payment(levelup, "TXN2")
+
+    payment, changed = levelup.transition_payment("TXN2", "Success")
+    assert changed and payment.payment_status == "Success"
+
+    _, changed_again = levelup.transition_payment("TXN2", "Success")
+    _, failed_later = levelup.transition_payment("TXN2", "Failed")
+    assert not changed_again and not failed_later
+    assert payment_status(levelup, "TXN2") == "Success"
+    assert levelup.has_paid("asha@example.com")
+
+
+def test_repeated_success_callbacks_are_idempotent(levelup, client):
+    add_pending_payment(levelup, "TXN3")
+    form = signed_callback("TXN3", "success")
+
+    assert client.post("/success", data=form).status_code == 200
+    assert client.post("/success", data=form).status_code == 200
+    assert payment_status(levelup, "TXN3") == "Success"
+
+    # A late failure callback can't undo a settled payment
+    client.post("/failure", data=signed_callback("TXN3", "failure"))
+    assert payment_status(levelup, "TXN3") == "Success"
+    assert levelup.Entitlement.query.filter_by(email="asha@example.com").one().status == "Active"
+
+
+def test_callback_with_bad_hash_or_amount_is_rejected(levelup, client):
+    add_pending_payment(levelup, "TXN4")
+
+    forged = {**signed_callback("TXN4", "success"), "hash": "f" * 128}
+    assert client.post("/success", data=forged).status_code == 400
+
+    underpaid = signed_callback("TXN4", "success", amount="1.00")
+    assert client.post("/success", data=underpaid).status_code == 400
+    assert payment_status(levelup, "TXN4") == "Pending"
+
+
+def test_failure_callback_marks_payment_failed(levelup, client):
+    add_pending_payment(levelup, "TXN5")
+    client.post("/failure", data=signed_callback("TXN5", "failure"))
+    assert payment_status(levelup, "TXN5") == "Failed"
+    assert not levelup.has_paid("asha@example.com")
+
+
+def queued_receipts(levelup, txnid):
+    return [task for task in levelup.tasks.broker.list(limit=1000) if task["name"] == "render_receipt" and txnid in task["args"]]
+
+
+def test_receipt_is_queued_once_per_transaction(levelup, client):
+    add_pending_payment(levelup, "TXN7")
+    form = signed_callback("TXN7", "success")
+
+    client.post("/success", data=form)
+    client.post("/success", data=form)  # Duplicate callback
+    for _ in range(3):  # The user reloading the success page
+        assert client.get("/success?txnid=TXN7").status_code == 200
+
+    assert len(queued_receipts(levelup, "TXN7")) == 1
+
+
+def test_failed_payment_queues_no_receipt(levelup, client):
+    add_pending_payment(levelup, "TXN8")
+    client.post("/failure", data=signed_callback("TXN8", "failure"))
+
+    assert queued_receipts(levelup, "TXN8") == []
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import app_module
+
+
+@pytest.fixture
+def verifier(levelup, monkeypatch):
+    """A LocalPaymentVerifier whose answers each test fills in."""
+    verifier = app_module.LocalPaymentVerifier()
+    monkeypatch.setattr(levelup, "payment_verifier", verifier)
+    return verifier
+
+
+def add_pending_payment(levelup, txnid, email="asha@example.com", amount=499.0, age=timedelta(hours=1)):
+    payment = levelup.Payment(email=email, name="Asha", plan_name="Pro", amount=amount, txnid=txnid)
+    payment.created_at = datetime.utcnow() - age
+    levelup.db.session.add(payment)
+    levelup.db.session.commit()
+
+
+def statuses(levelup):
+    levelup.db.session.expire_all()
+    return {p.txnid: p.payment_status for p in levelup.Payment.query.all()}
+
+
+def test_settles_success_failure_and_abandoned_checkouts(levelup, verifier):
+    add_pending_payment(levelup, "paid", email="paid@example.com")
+    add_pending_payment(levelup, "declined", email="declined@example.com")
+    add_pending_payment(levelup, "abandoned", email="gone@example.com", age=timedelta(hours=30))
+    verifier.statuses = {
+        "paid": {"status": "success", "amt": "499.00"},
+        "declined": {"status": "failure", "amt": "499.00"},
+    }
+
+    result = levelup.reconcile_payments()
+
+    assert statuses(levelup) == {"paid": "Success", "declined": "Failed", "abandoned": "Expired"}
+    assert result == {"checked": 3, "succeeded": 1, "failed": 1, "expired": 1, "mismatched": 0, "errors": 0}
+    assert levelup.has_paid("paid@example.com")
+    assert not levelup.has_paid("declined@example.com")
+
+
+def test_leaves_young_and_unconfirmed_payments_pending(levelup, verifier):
+    add_pending_payment(levelup, "just-started", age=timedelta(minutes=1))
+    add_pending_payment(levelup, "not-found")  # Past the settle delay, not yet past expiry
+
+    result = levelup.reconcile_payments()
+
+    assert statuses(levelup) == {"just-started": "Pending", "not-found": "Pending"}
+    assert result["checked"] == 1
+    assert not levelup.has_paid("asha@example.com")
+
+
+def test_amount_mismatch_is_flagged_not_granted(levelup, verifier):
+    add_pending_payment(levelup, "short-paid")
+    verifier.statuses = {"short-paid": {"status": "success", "amt": "1.00"}}
+
+    result = levelup.reconcile_payments()
+
+    assert statuses(levelup) == {"short-paid": "Pending"}
+    assert result["mismatched"] == 1
+    assert not levelup.has_paid("asha@example.com")
+
+
+def test_late_success_revives_an_expired_payment(levelup, verifier):
+    add_pending_payment(levelup, "slow-bank", age=timedelta(hours=30))
+    levelup.reconcile_payments()
+    assert statuses(levelup) == {"slow-bank": "Expired"}
+
+    payment, changed = levelup.transition_payment("slow-bank", "Success")
+    assert changed and payment.payment_status == "Success"
+
+
+def test_verifier_errors_are_counted_not_raised(levelup, verifier, monkeypatch):
+    add_pending_payment(levelup, "paid")
+
+    def unavailable(txnids):
+        raise app_module.requests.ConnectionError("PayU is down")
+    monkeypatch.setattr(verifier, "verify", unavailable)
+
+    result = levelup.reconcile_payments()
+
+    assert result["errors"] == 1 and result["checked"] == 0
+    assert statuses(levelup) == {"paid": "Pending"}
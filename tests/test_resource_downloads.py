@@ -0,0 +1,67 @@
+import io
+
+import pytest
+
+from conftest import app_module
+
+
+@pytest.fixture
+def library(levelup):
+    """A resource generated by `creator`, plus a second user; returns (creator_id, reader_id, resource_id)."""
+    creator = levelup.User(google_id="g-1", email="creator@example.com", name="Creator")
+    reader = levelup.User(google_id="g-2", email="reader@example.com", name="Reader")
+    levelup.db.session.add_all([creator, reader])
+    levelup.db.session.commit()
+    resource = levelup.save_resource(creator.id, "worksheet", "Fractions", "8", 5, {"data": ["1/2 + 1/4?"]})
+    return creator.id, reader.id, resource.id
+
+
+def log_in(client, email):
+    with client.session_transaction() as sess:
+        sess["email"] = email
+
+
+def downloads(levelup, resource_id):
+    levelup.db.session.expire_all()
+    return levelup.db.session.get(levelup.Resource, resource_id).download_count
+
+
+def test_each_user_counts_once(levelup, library):
+    creator_id, reader_id, resource_id = library
+
+    for _ in range(3):
+        assert levelup.count_resource_download(reader_id, resource_id)
+    assert downloads(levelup, resource_id) == 1
+
+
+def test_creator_and_anonymous_downloads_do_not_count(levelup, library):
+    creator_id, _, resource_id = library
+
+    levelup.count_resource_download(creator_id, resource_id)
+    levelup.count_resource_download(None, resource_id)
+    assert downloads(levelup, resource_id) == 0
+    assert not levelup.count_resource_download(creator_id, 9999)
+
+
+def test_upload_counts_as_the_download(levelup, client, library):
+    _, _, resource_id = library
+    log_in(client, "reader@example.com")
+
+    for _ in range(2):
+        response = client.post("/upload_blob", data={
+            "file": (io.BytesIO(b"%PDF-1.4"), "Fractions.pdf"), "type": "worksheet", "resource_id": str(resource_id),
+        })
+        assert response.status_code == 202
+    assert downloads(levelup, resource_id) == 1
+    assert levelup.load_trending_resources()[0]["id"] == resource_id
+
+
+def test_download_endpoint_is_rate_limited(levelup, client, library, monkeypatch):
+    _, _, resource_id = library
+    monkeypatch.setitem(levelup.RATE_LIMITS, "resource_download", app_module.parse_rate("2/60"))
+    monkeypatch.setattr(levelup, "rate_limit_store", levelup.MemoryRateLimitStore())
+    log_in(client, "reader@example.com")
+
+    statuses = [client.post(f"/resources/{resource_id}/download").status_code for _ in range(3)]
+    assert statuses == [200, 200, 429]
+    assert downloads(levelup, resource_id) == 1
@@ -0,0 +1,63 @@
+import pytest
+
+from conftest import app_module
+
+
+@pytest.fixture
+def user_id(levelup):
+    user = levelup.User(google_id="g-1", email="asha@example.com", name="Asha")
+    levelup.db.session.add(user)
+    levelup.db.session.commit()
+    return user.id
+
+
+def add_question(levelup, user_id, bump=True):
+    levelup.db.session.add(levelup.Question(user_id=user_id, question_text="Why is the sky blue?"))
+    if bump:
+        levelup.bump_counters(user_id, forum_posts=1)
+    levelup.db.session.commit()
+
+
+def counters(levelup, user_id):
+    levelup.db.session.expire_all()
+    counter = levelup.db.session.get(levelup.UserCounter, user_id)
+    return counter.forum_posts, counter.contributions
+
+
+def test_repairs_missing_and_drifted_counters(levelup, user_id):
+    add_question(levelup, user_id, bump=False)
+    add_question(levelup, user_id, bump=False)
+    assert levelup.reconcile_user_counters() == 1
+    assert counters(levelup, user_id) == (2, 2)
+
+    levelup.UserCounter.query.filter_by(user_id=user_id).update({"forum_posts": 7, "contributions": 3})
+    levelup.db.session.commit()
+    assert levelup.reconcile_user_counters() == 1
+    assert counters(levelup, user_id) == (2, 2)
+    assert levelup.reconcile_user_counters() == 0
+
+
+def test_keeps_increments_made_while_it_runs(levelup, user_id, monkeypatch):
+    add_question(levelup, user_id)
+    count_by_user = levelup.count_by_user
+
+    def count_then_post(*models, **kwargs):
+        counts = count_by_user(*models, **kwargs)
+        if models == (levelup.Question,):  # A new post lands after the recount
+            add_question(levelup, user_id)
+        return counts
+    monkeypatch.setattr(app_module, "count_by_user", count_then_post)
+
+    assert levelup.reconcile_user_counters() == 0
+    assert counters(levelup, user_id) == (2, 2)
+
+
+def test_works_through_users_in_chunks(levelup, user_id):
+    others = [levelup.User(google_id=f"g-{n}", email=f"user{n}@example.com", name=f"User {n}") for n in range(2, 6)]
+    levelup.db.session.add_all(others)
+    levelup.db.session.commit()
+    for user in others:
+        add_question(levelup, user.id, bump=False)
+
+    assert levelup.reconcile_user_counters(chunk_size=2) == 4
+    assert [counters(levelup, user.id) for user in others] == [(1, 1)] * 4